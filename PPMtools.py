@@ -24,12 +24,27 @@ import numpy as np
 # import subprocess
 # import time
 import multiprocessing as mp
+import multiprocessing.util as mp_util
 import os
 import _pickle as cPickle
 import itertools
+import random
+import functools
+import queue
+import contextlib
+import time
 
 import house
 import person
+import events
+import inp_template
+import toolkit_engine
+import plugflow_engine
+import result_cache
+import instrument
+import pattern_store
+import worker_tuning
+import event_store
 from PPMtools_units import *
 
 
@@ -37,10 +52,176 @@ from PPMtools_units import *
 # =============================================================================
 # Monte Carlo Tools
 # =============================================================================
+def trial_rng(seed, num_people, trial):
+    '''
+    Independent random stream for a single Monte Carlo trial. The stream is
+    spawned from the root seed and keyed by the number of people and the trial
+    number, so a trial draws the same events whether it is generated in order,
+    in a process pool, or on its own.
+    seed: root seed (int), None uses the global random module
+    num_people: number of residents in the household
+    trial: trial number
+    returns random.Random, or None if no seed is given
+    '''
+    if seed is None:
+        return None
+    seq = np.random.SeedSequence(seed, spawn_key=(num_people, trial))
+    state = seq.generate_state(8)
+    return random.Random(sum(int(x) << (32*i) for i, x in enumerate(state)))
+
+
+def generate_trial(wn, home, days_in_week, rng=None, patterns=True):
+    '''
+    Simulate the water usage of a single trial for a household
+    wn: water network model
+    home: household with residents and their routines
+    days_in_week: the schedule of days to simulate water usage
+    rng: random.Random for the trial (see trial_rng), None uses the global 
+        random module
+    patterns: build the pattern dictionary, False to only keep the events
+    returns pattern dictionary (None if not built) and event table of the 
+        trial
+    '''
+    with instrument.stage('generation'):
+        home.new_trial(rng)
+        home.simulate_usage(days_in_week)
+    if not patterns:
+        return None, home.event_table
+    with instrument.stage('pattern build'):
+        patterns = build_pattern_dict(wn, home)
+    return patterns, home.event_table
+
+
+_trial_setup = {}
+
+def _init_trial_worker(wn, home, days_in_week, patterns=True):
+    # sends the network and household to each worker once
+    _trial_setup['wn'] = wn
+    _trial_setup['home'] = home
+    _trial_setup['days'] = days_in_week
+    _trial_setup['patterns'] = patterns
+
+
+def _trial_worker(trial_key):
+    # trial_key: (seed, num_people, trial)
+    return generate_trial(_trial_setup['wn'], _trial_setup['home'],
+                          _trial_setup['days'], trial_rng(*trial_key),
+                          _trial_setup['patterns'])
+
+
 def monte_carlo_setup(wn, fixture_info, routine, changes_obj, main_dir,
                       num_trials=1, PPM_name='PPM_runs', 
-                      household_routine=False):
+                      household_routine=False, seed=None, num_proc=1,
+                      write_inp=True, cache=None, progress=None,
+                      pattern_mode='array'):
+    '''
+    Generate the Monte Carlo trials and EPANET input files for all combinations
+        of household size, fixture flows, and network changes
+    wn: water network model
+    fixture_info: list of fixtures, or dictionary of fixture lists by flow type
+    routine: resident routine, list or dictionary with 'weekday', 'weekend'
+        and 'modeled week'
+    changes_obj: dictionary of 'num people', 'hwh volume', 'pipe diam', and
+        'pipe scaling' values to loop over
+    main_dir: directory to store the folder structure in
+    num_trials: number of trials for each household size
+    PPM_name: name of the run, used for the top folder and file names
+    household_routine: routine of household actions, False if none
+    seed: root seed for the trials, each trial gets its own stream (see 
+        trial_rng). None uses the global random module
+    num_proc: number of processes for generating trials. Without a seed a 
+        random root seed is drawn, so that workers do not repeat trials
+    write_inp: write an INP file for every trial. If False, only the network
+        of each combination is written (base name + '.inp'), for running the
+        trials in memory with mp_run_epanet(available, toolkit=True)
+    cache: result_cache.ResultCache, INP files of runs that are already 
+        cached are not written. The key of every run is stored in available.
+    progress: progress callback (see instrument.Progress), defaults to 
+        printing the number of INP files written every 10 seconds. Stages are
+        recorded when instrument.start() was called.
+    pattern_mode: how the patterns of the trials are kept (see 
+        pattern_store). 'array' keeps them as one float32 array in memory, 
+        'memmap' maps that array to a .npy file in the folder of each 
+        household size, and 'sparse' only keeps the events and rasterizes
+        a trial when its patterns are read.
+    returns list of available runs and the pattern dictionary 
+        {trial ID: {'patname':[pattern]}} of the last flow type, as a 
+        pattern_store.PatternStore or SparsePatterns
+    
+    All runs are written before returning, see iter_monte_carlo for 
+        producing runs just in time. The runs are saved to available.pickle 
+        in the top folder, see load_available.
+    '''
+    runs = iter_monte_carlo(wn, fixture_info, routine, changes_obj, main_dir,
+                            num_trials, PPM_name, household_routine, seed, 
+                            num_proc, write_inp, cache, progress, 
+                            pattern_mode)
     available = []
+    while True:
+        try:
+            available.append(next(runs))
+        except StopIteration as stop:
+            patt_dict = stop.value
+            break
+    
+    root_folder = main_dir.replace('\\','/') + '/' + PPM_name.replace(' ','_') + '/'
+    os.makedirs(root_folder, exist_ok=True)
+    with open(root_folder + 'available.pickle', 'wb') as f:
+        cPickle.dump(available, f)
+    
+    return available, patt_dict
+
+
+def load_available(root_folder):
+    '''
+    Load the runs of a campaign, from the index of iter_monte_carlo 
+        (available_runs.pickle, every run yielded so far), or from 
+        available.pickle of campaigns set up before the index
+    root_folder: top folder of the campaign, main_dir + '/' + PPM_name
+    returns list of available runs, see monte_carlo_setup
+    '''
+    root_folder = root_folder.replace('\\','/').rstrip('/') + '/'
+    if not os.path.isfile(root_folder + 'available_runs.pickle'):
+        with open(root_folder + 'available.pickle', 'rb') as f:
+            return cPickle.load(f)
+    available = []
+    with open(root_folder + 'available_runs.pickle', 'rb') as f:
+        while True:
+            try:
+                available.append(cPickle.load(f))
+            except EOFError:
+                break
+    return available
+
+
+
+def iter_monte_carlo(wn, fixture_info, routine, changes_obj, main_dir,
+                      num_trials=1, PPM_name='PPM_runs', 
+                      household_routine=False, seed=None, num_proc=1,
+                      write_inp=True, cache=None, progress=None,
+                      pattern_mode='array'):
+    '''
+    Generate the Monte Carlo trials and EPANET input files for all combinations
+        of household size, fixture flows, and network changes, one run at a 
+        time. The parameters are those of monte_carlo_setup.
+    yields each run (a row of available, see monte_carlo_setup) as soon as
+        its INP file is written, the generator returns the pattern dictionary
+        of the last flow type. Folders are created as they are used, so runs
+        can be simulated while the rest of the grid is generated, see 
+        mp_run_epanet(runs, max_pending=...).
+    
+    Each run is also appended to available_runs.pickle in the top folder as
+        it is yielded, so a streamed campaign can be analyzed or resumed from
+        the runs generated so far, see load_available.
+    '''
+    if pattern_mode not in ('array', 'memmap', 'sparse'):
+        raise ValueError('pattern_mode must be array, memmap, or sparse')
+    if seed is None and num_proc > 1:
+        seed = np.random.SeedSequence().entropy
+    if progress is None:
+        progress = instrument.Progress()
+    num_written = 0
+    num_cached = 0
   
     if type(fixture_info) == list:
         fixture_info = {'single case': fixture_info}
@@ -71,34 +252,13 @@ def monte_carlo_setup(wn, fixture_info, routine, changes_obj, main_dir,
                                    changes_obj['pipe scaling']
                                    ))
     
-    combo_folders = list(itertools.product (loop1,
-                                            loop2,
-                                            changes_obj['hwh volume'],
-                                            changes_obj['pipe diam'],
-                                            changes_obj['pipe scaling']
-                                            ))
-    
-    # Creates necessary folder structure for file storage
-    for item in combo_folders:
-        house_base = PPM_name.replace(' ','_') + '/'
-        num_people = repr(int(item[0])) + '_People/'
-        flow_type  = item[1].replace(' ','_') + '/'
-        hwh_size   = repr(round(item[2])) + '_gal/'
-        pipe_diam  = repr(round(item[3],4)).replace('.','-') + '_in/'
-        pipe_scale = repr(round(item[4],3)).replace('.','-') + 'x/'
-        
-        folder_string = house_base + num_people + flow_type + hwh_size + \
-                        pipe_diam + pipe_scale
-        
-        full_folder_path = main_dir.replace('\\', '/') + '/' + folder_string
-        os.makedirs(full_folder_path, exist_ok=True)
-    
     # Store some network characteristics that don't change
     orig_lengths = {}
     for pipe in wn.link_name_list:
         orig_lengths[pipe] = wn.get_link(pipe).length
     hwh_name = wn.tank_name_list[0]
     xs_area = np.pi * (wn.get_node(hwh_name).diameter/2.)**2 # m**2, cross sectional area of tank
+    template = inp_template.InpTemplate(wn)   # static INP sections, rendered once
     
     # Setup Scaling Factors
     scaling = {}
@@ -112,11 +272,16 @@ def monte_carlo_setup(wn, fixture_info, routine, changes_obj, main_dir,
             scaling[item][fixture_name] = curr_fix / ref_fix
     
     root_folder = main_dir.replace('\\','/') + '/' + PPM_name.replace(' ','_') + '/'           
+    events_db = None            # event store of the campaign, see event_store
+    # index of the runs yielded so far, see load_available
+    index_file = root_folder + 'available_runs.pickle'
+    os.makedirs(root_folder, exist_ok=True)
+    open(index_file, 'wb').close()
     
     for num_people in loop1:
         ref_available = False           # flag, will recalculate if False
-        event_dict    = {}              # create storage objects
-        patt_dict     = {}
+        ref_events    = {}              # reference trials, never scaled
+        ref_patt      = None
         for flow_type in loop2:
             base_folder = root_folder +\
                           repr(int(num_people)) + '_People/' +\
@@ -140,17 +305,58 @@ def monte_carlo_setup(wn, fixture_info, routine, changes_obj, main_dir,
                 home.residents = people
                 
                 base_name = home.name + '_model'
-                for trial in range(num_trials):
-                    trial_ID = base_name + '-' + str(trial)
-                    tmp_home = home._deepcopy_() # reset home for next trial
-                    tmp_home.simulate_usage(days_in_week)
-                    patt_dict[trial_ID] = build_pattern_dict(wn, tmp_home)
-                    event_list = tmp_home.event_list  
-                    event_dict[trial_ID] = event_list
+                trial_keys = [(seed, num_people, trial) 
+                              for trial in range(num_trials)]
+                build = pattern_mode != 'sparse'
+                pool = None
+                if num_proc > 1:
+                    pool = mp.Pool(num_proc, initializer=_init_trial_worker,
+                                   initargs=(wn, home, days_in_week, build))
+                    trials = pool.imap(_trial_worker, trial_keys)
+                else:
+                    trials = (generate_trial(wn, home, days_in_week, 
+                                             trial_rng(*key), build) 
+                              for key in trial_keys)
+                
+                # patterns of the reference trials, one row per pattern
+                TOT_LENGTH = int(wn.options.time.duration / 
+                                 wn.options.time.pattern_timestep)
+                names = pattern_names(wn, home)
+                if pattern_mode == 'sparse':
+                    ref_patt = pattern_store.SparsePatterns(
+                        names, TOT_LENGTH, home.source[0].name)
+                else:
+                    store_file = None
+                    if pattern_mode == 'memmap':
+                        os.makedirs(root_folder + repr(int(num_people)) + 
+                                    '_People/', exist_ok=True)
+                        store_file = root_folder + repr(int(num_people)) +\
+                                     '_People/' + base_name + '_patterns.npy'
+                    ref_patt = pattern_store.PatternStore(
+                        names, TOT_LENGTH, num_trials, store_file, 
+                        source_name=home.source[0].name + 'CP')
+                # trials of a pool are copied into the store as they arrive,
+                # the wait is recorded as generation
+                gen_stage = contextlib.nullcontext() if pool is None else \
+                            instrument.stage('generation')
+                with gen_stage:
+                    for trial, (patterns, table) in enumerate(trials):
+                        trial_ID = base_name + '-' + str(trial)
+                        if pattern_mode == 'sparse':
+                            ref_patt.add(trial_ID, table)
+                        else:
+                            ref_patt.add(trial_ID, patterns)
+                        ref_events[trial_ID] = table
+                        instrument.count('trials')
+                    if pool is not None:
+                        pool.close()
+                        pool.join()
+                if pattern_mode == 'memmap':
+                    ref_patt.flush()
                 ref_available = True     # Flags that jobs have been stored
                 
                 patt_xref = {}
-                pattern_list = list(patt_dict[trial_ID].keys())
+                pattern_list = list(ref_patt.pattern_names)
                 pattern_list.remove('SourceCP')
                 for fixID in range(len(fixture_info[job_ref])):
                     fix_name = fixture_info[job_ref][fixID][1]
@@ -161,43 +367,33 @@ def monte_carlo_setup(wn, fixture_info, routine, changes_obj, main_dir,
                                                   if (fix_name + 'H') in i ]
                     patt_xref[fix_name]['cold'] = [i for i in pattern_list 
                                                    if (fix_name + 'C') in i ]
-                
-            else:                        # use scaling to rework pattern
-                for trial_ID in event_dict.keys():
-                    for event in range(len(event_dict[trial_ID])):
-                        fix_name = event_dict[trial_ID][event][1]
-                        scale = scaling[flow_type][fix_name]
-                        if scale != 1:
-                            event_dict[trial_ID][event][3] *= scale
-                            event_dict[trial_ID][event][4] *= scale
-                    
-                    for fix_name in patt_xref.keys():
-                        scale = scaling[flow_type][fix_name]
-                        if scale != 1:
-                            pattC_name = patt_xref[fix_name]['cold']
-                            pattH_name = patt_xref[fix_name]['hot']
-                            if len(pattC_name) > 0:
-                                coldP = patt_dict[trial_ID][pattC_name[0]]
-                                coldP = list(np.array(coldP) * scale)
-                                patt_dict[trial_ID][pattC_name[0]] = coldP
-                            if len(pattH_name) > 0:
-                                hotP = patt_dict[trial_ID][pattH_name[0]]
-                                hotP = list(np.array(hotP) * scale)
-                                patt_dict[trial_ID][pattH_name[0]] = hotP
-                    
-                    df = pd.DataFrame.from_dict(patt_dict[trial_ID])
-                    cols = df.columns.drop('SourceCP')
-                    source_demand = df[cols].sum(axis='columns').values
-                    patt_dict[trial_ID]['SourceCP'] = list(source_demand)
             
-            cPickle.dump(event_dict, open(base_folder + base_name + '.pickle',
-                                          'wb'))
+            # flow type variant of the reference trials, scales are applied 
+            # to new copies so they never compound across flow types
+            fix_scaling = scaling[flow_type]
+            with instrument.stage('pattern build'):
+                scales = flow_scales(pattern_list, patt_xref, fix_scaling)
+                event_dict = {trial_ID: scaled_events(table, fix_scaling) 
+                              for trial_ID, table in ref_events.items()}
+                if pattern_mode == 'sparse':
+                    patt_dict = ref_patt.with_tables(event_dict)
+                else:
+                    patt_dict = ref_patt.scaled(pattern_list, scales)
+            os.makedirs(base_folder, exist_ok=True)
+            if events_db is None:
+                events_db = open_event_store(root_folder + 'events.db')
+            events_db.put({event_store.event_key(flow_type, trial_ID): table
+                           for trial_ID, table in event_dict.items()})
+            trial_keys = {trial_ID: result_cache.trial_key(
+                              ref_patt.pattern_names, TOT_LENGTH, table)
+                          for trial_ID, table in event_dict.items()}
             
             
             for trial in loop3:
                 sub_base = repr(round(trial[0])) + '_gal/' +\
                            repr(round(trial[1],4)).replace('.','-') + '_in/' +\
                            repr(round(trial[2],3)).replace('.','-') + 'x/'
+                os.makedirs(base_folder + sub_base, exist_ok=True)
                 
                 # Hot water heater resize if needed           
                 hwh_vol = trial[0] * m3_per_gal              # m**3     
@@ -210,30 +406,66 @@ def monte_carlo_setup(wn, fixture_info, routine, changes_obj, main_dir,
                 for pipe in wn.link_name_list:
                     wn.get_link(pipe).length = orig_lengths[pipe] * pipe_scaling
                     wn.get_link(pipe).diameter = pipe_diam * 1.
+                template.refresh_network()
+                net_key = result_cache.network_key(template)
+                if not write_inp:
+                    # network for the toolkit engine, patterns are set per trial
+                    with instrument.stage('inp write'):
+                        wntr.network.io.write_inpfile(wn, base_folder + 
+                                                      sub_base + base_name +
+                                                      '.inp', units='GPM')
+                    if instrument.active() is not None:
+                        instrument.add_bytes('inp write', written=
+                            os.path.getsize(base_folder + sub_base + 
+                                            base_name + '.inp'))
                     
                 for trial_ID in event_dict.keys():
                     inp_file = trial_ID + '.inp'
                     '''
                     Stores available files: Used for running/analyzing files
                     column1: Trial ID name
-                    column2: Where the pickled event_list is stored
+                    column2: Event store of the campaign, the events of 
+                             the trial are stored under event_store.
+                             event_key(flow type, trial ID)
                     column3: Where the actual inp file is stored
                     column4: INP file name
+                    column5: Scenario, (people, flow type, hwh gal, 
+                             pipe diam, pipe scaling)
+                    column6: Cache key of the run (see result_cache)
                     '''
-                    available.append([trial_ID, 
-                                      base_folder + base_name + '.pickle',
-                                      base_folder + sub_base, 
-                                      inp_file])
-                    
-                    update_patterns(wn, 
-                                    patt_dict[trial_ID], 
-                                    base_folder+sub_base+inp_file)
-                    print('Created: '+ base_folder + sub_base + inp_file)
+                    key = result_cache.run_key(net_key, trial_keys[trial_ID])
+                    run = [trial_ID, 
+                           root_folder + 'events.db',
+                           base_folder + sub_base, 
+                           inp_file,
+                           (int(num_people), 
+                            flow_type.replace(' ','_'),
+                            round(trial[0]), round(trial[1],4), 
+                            round(trial[2],3)),
+                           key]
                     
-    cPickle.dump(available, open(root_folder+'available.pickle','wb'))
-                    
-
-    return available, patt_dict   
+                    if cache is not None and key in cache:
+                        num_cached += 1
+                        progress('cached runs', num_cached)
+                    elif write_inp:
+                        with instrument.stage('inp write'):
+                            template.write(patt_dict[trial_ID], 
+                                           base_folder+sub_base+inp_file)
+                        if instrument.active() is not None:
+                            instrument.add_bytes('inp write', written=
+                                os.path.getsize(base_folder+sub_base+inp_file))
+                        num_written += 1
+                        progress('INP files', num_written)
+                    with open(index_file, 'ab') as f:
+                        cPickle.dump(run, f)
+                    yield run
+    
+    if num_cached > 0:
+        progress('cached runs', num_cached, final=True)
+    if write_inp:
+        progress('INP files', num_written, final=True)
+    
+    return patt_dict   
 
 # =============================================================================
 # Pattern functions
@@ -241,13 +473,26 @@ def monte_carlo_setup(wn, fixture_info, routine, changes_obj, main_dir,
 def build_pattern_dict(wn, household):
     '''
     Build the patterns for each node in the household for the .inp file 
-    {'patname':[pattern]}
+    {'patname':array}, see table_pattern_dict
     wn: water network model
     household: household object
     '''
-    # TODO: how to handle if a pattern does exist or an extra pattern exists
     # TODO: get rid of the events list in either the household or fixture objects?   
-    TOT_LENGTH = wn.options.time.duration / wn.options.time.pattern_timestep
+    TOT_LENGTH = int(wn.options.time.duration / wn.options.time.pattern_timestep)
+    patterns = pattern_names(wn, household)
+
+    return table_pattern_dict(household.event_table, patterns, TOT_LENGTH,
+                              household.source[0].name)
+
+
+def pattern_names(wn, household):
+    '''
+    Names of the patterns of a household network, the network patterns and 
+        the pattern of every fixture node (node label + 'P')
+    wn: water network model
+    household: household object
+    '''
+    # TODO: how to handle if a pattern does exist or an extra pattern exists
     patterns = wn.pattern_name_list
 
     # Check that all needed patterns exist
@@ -255,37 +500,86 @@ def build_pattern_dict(wn, household):
         for node_name in fix.node_labels:
             if not node_name + 'P' in patterns:
                 patterns.append(node_name + 'P')
+    return patterns
 
-    temp_patt = {}
-    for i in patterns:
-        temp_patt[i] = [0] * int(TOT_LENGTH)
+
+def table_pattern_dict(table, patterns, TOT_LENGTH, source_name='Source'):
+    '''
+    Build the patterns from an event table {'patname':array}
+    All patterns are rows of a single 2-D array (patterns x steps). Fixture 
+    patterns are filled by slice assignment, the source pattern accumulates 
+    the flow of every event.
+    table: EventTable of the household
+    patterns: names of the patterns, including the fixture patterns 
+        (fixture name + 'CP'/'HP') of every event
+    TOT_LENGTH: number of pattern steps
+    source_name: name of the source fixture
+    '''
+    patt_array = np.zeros((len(patterns), TOT_LENGTH))
+    patt_idx = {name: row for row, name in enumerate(patterns)}
+    pattern_store.rasterize(table, patt_idx, patt_array, source_name)
     
-    fix_source = household.source[0]
-    patt_source_name = fix_source.name + 'CP'
-    test = 0
-    for fix in household.fixtures:
-        if fix != fix_source:
-            for event in fix.schedule:
-                test+=1
-                start = int(event.times[0])
-                end = int(event.times[1])
-                if end > TOT_LENGTH: end = TOT_LENGTH
-                idx = range(int(start), int(end + 1))
-                cold_rate = event.cold_rate
-                hot_rate = event.hot_rate
-                if cold_rate != 0:
-                    patt_name = fix.name + 'CP'
-                    for j in idx:
-                        temp_patt[patt_name][j] = cold_rate
-                        temp_patt[patt_source_name][j] += cold_rate
-                if hot_rate != 0:
-                    patt_name = fix.name + 'HP'
-                    for j in idx:
-                        temp_patt[patt_name][j] = hot_rate
-                        temp_patt[patt_source_name][j] += hot_rate
+    temp_patt = {name: patt_array[row] for name, row in patt_idx.items()}
     
     return temp_patt
 
+
+def flow_scales(pattern_list, patt_xref, fix_scaling):
+    '''
+    Scale of each pattern for a flow type, 1 for patterns of fixtures that 
+        keep the reference flow and patterns of no fixture
+    pattern_list: names of the patterns, without the source pattern
+    patt_xref: hot and cold pattern names of each fixture
+    fix_scaling: flow scale of each fixture, relative to the reference
+    '''
+    scales = np.ones(len(pattern_list))
+    index = {name: row for row, name in enumerate(pattern_list)}
+    for fix_name, xref in patt_xref.items():
+        for side in ('cold', 'hot'):
+            if len(xref[side]) > 0:
+                scales[index[xref[side][0]]] = fix_scaling[fix_name]
+    return scales
+
+
+def scaled_patterns(patterns, pattern_list, scales, source_name='SourceCP'):
+    '''
+    Patterns of a flow type from the reference patterns, the reference 
+        patterns are not changed and unscaled patterns are shared. The source
+        pattern is the scale weighted sum of all other patterns.
+    patterns: reference pattern dictionary {'patname':array}
+    pattern_list: names of the patterns, without the source pattern
+    scales: scale of each pattern of pattern_list, see flow_scales
+    source_name: name of the source pattern
+    '''
+    if not (scales != 1).any():
+        return patterns
+    patt_array = np.stack([patterns[name] for name in pattern_list])
+    scaled = dict(zip(pattern_list, patt_array))
+    for row in np.flatnonzero(scales != 1):
+        scaled[pattern_list[row]] = patt_array[row] * scales[row]
+    scaled[source_name] = scales @ patt_array
+    return {name: scaled[name] for name in patterns}
+
+
+def scaled_events(table, fix_scaling):
+    '''
+    Event table of a flow type from the reference event table, rates of 
+        each fixture are scaled on a copy
+    table: reference EventTable
+    fix_scaling: flow scale of each fixture, relative to the reference
+    '''
+    if all(scale == 1 for scale in fix_scaling.values()):
+        return table
+    table = table.copy()
+    scale = np.ones(len(table.fixture_names))
+    for fix_name, fix_scale in fix_scaling.items():
+        if fix_name in table.fixture_names:
+            scale[table.fixture_names.index(fix_name)] = fix_scale
+    event_scale = scale[table['fixture']]
+    table['hot_rate'][:] *= event_scale
+    table['cold_rate'][:] *= event_scale
+    return table
+
 def update_patterns(wntr_obj, patterns, outfile):
     '''
     Update the patterns in the water network
@@ -299,7 +593,7 @@ def update_patterns(wntr_obj, patterns, outfile):
         
     for patt in patterns.keys():
         if patt in curr_patt:
-            wntr_obj.patterns[patt].multipliers = np.array(patterns[patt])
+            wntr_obj.patterns[patt].multipliers = np.asarray(patterns[patt])
         else:
             wntr_obj.add_pattern(patt, patterns[patt])
     
@@ -310,180 +604,200 @@ def update_patterns(wntr_obj, patterns, outfile):
 # =============================================================================
 # Data summary functions
 # =============================================================================
-def by_user_dataframe(summary_pd, qual_type='chem'):
+def by_user_dataframe(summary_pd, qual_type='chem', long_format=False):
     '''
     summary_pd: dataframe of summary results
     qual_type: 'chem' or 'age', designates what type of WQ simulation was run
+    long_format: return one row per usage with a 'User' column, instead of 
+                 the wide layout with a block of columns for every user
     
+    Users are categorical codes, each user's block of the wide layout takes 
+    the long format values where the code matches, and 0 elsewhere.
     '''
     datastruct = ['MassCold','VolumeCold','AveConcCold','MassHot',
                   'VolumeHot','AveConcHot','UseType','Fixture']
     
-    resname = list(set([summary_pd['patternInfo'][x][2] 
-                        for x in range(len(summary_pd['patternInfo']))]))
+    info = list(summary_pd['patternInfo'])
+    resname = list(set([k[2] for k in info]))
     
-    level1 = [x for x in resname for y in datastruct]
-    level2 = datastruct*len(resname)
+    use = pd.Series([k[5] for k in info], dtype=object)
+    use[use.str.contains('Sample|sample', regex=True)] = 'Sample'
+    cM = summary_pd['coldMass'].to_numpy(dtype=float)
+    cV = summary_pd['coldVolume'].to_numpy(dtype=float)
+    hM = summary_pd['hotMass'].to_numpy(dtype=float)
+    hV = summary_pd['hotVolume'].to_numpy(dtype=float)
+    avC = np.zeros(len(info))
+    avH = np.zeros(len(info))
+    if qual_type.lower() == 'chem':
+        avC[cV > 0.] = cM[cV > 0.] / cV[cV > 0.]
+        avH[hV > 0.] = hM[hV > 0.] / hV[hV > 0.]
+    elif qual_type.lower() == 'age': 
+        # Age considers only average, not mass/volume
+        # Age returned in hours, wntr returns as seconds
+        if 'coldMean' in summary_pd.columns:
+            mean_c = summary_pd['coldMean'].to_numpy(dtype=float)
+            mean_h = summary_pd['hotMean'].to_numpy(dtype=float)
+        else:
+            mean_c = np.array([np.mean(x) if v > 0. else 0. for x, v in 
+                               zip(summary_pd['coldConc'], cV)])
+            mean_h = np.array([np.mean(x) if v > 0. else 0. for x, v in 
+                               zip(summary_pd['hotConc'], hV)])
+        avC[cV > 0.] = mean_c[cV > 0.] / sec_per_hr
+        avH[hV > 0.] = mean_h[hV > 0.] / sec_per_hr
+    else:
+        print('Error: qual_type supplied does not match chem or age')
+    
+    break_down = pd.DataFrame({'User': pd.Categorical([k[2] for k in info], 
+                                                      categories=resname),
+                               'MassCold': cM, 'VolumeCold': cV, 
+                               'AveConcCold': avC, 'MassHot': hM, 
+                               'VolumeHot': hV, 'AveConcHot': avH, 
+                               'UseType': use.to_numpy(), 
+                               'Fixture': [k[1] for k in info]})
+    if long_format:
+        return break_down
     
-    tuples = list(zip(level1, level2))
+    tuples = [(x, y) for x in resname for y in datastruct]
     col_val = pd.MultiIndex.from_tuples(tuples, names=['User','Data'])
-        
-    tmp_store = []
-    
-    for i in range(len(summary_pd.index)):
-        j = summary_pd.loc[i]
-        k = j['patternInfo']
-        res = k[2]
-        res_idx = resname.index(res)
-        fix = k[1]
-        use = k[5]
-        if 'Sample' in use or 'sample' in use:
-            use = 'Sample'
-        cMtmp = j['coldMass']
-        cVtmp = j['coldVolume']
-        hMtmp = j['hotMass']
-        hVtmp = j['hotVolume']
-        avCtmp = 0.
-        avHtmp = 0.
-        if qual_type.lower() == 'chem':
-            if cVtmp > 0.:
-                avCtmp = cMtmp / cVtmp
-            if hVtmp > 0.:
-                avHtmp = hMtmp / hVtmp
-        elif qual_type.lower() == 'age': 
-            # Age considers only average, not mass/volume
-            # Age returned in hours, wntr returns as seconds
-            if cVtmp > 0.:
-                avCtmp = np.mean(j['coldConc'])/sec_per_hr
-            if hVtmp > 0.:
-                avHtmp = np.mean(j['hotConc'])/sec_per_hr
-        else:
-            print('Error: qual_type supplied does not match chem or age')
-        
-        line = res_idx*[0,0,0,0,0,0,0,0]+\
-               [cMtmp, cVtmp, avCtmp, hMtmp, hVtmp, avHtmp, use, fix] +\
-               (len(resname)-(res_idx+1))*[0,0,0,0,0,0,0,0]
-        tmp_store.append(line)
-
-    break_down = pd.DataFrame(tmp_store, 
-                              index=range(len(summary_pd)), 
-                              columns=col_val)
+    codes = break_down['User'].cat.codes.to_numpy()
+    wide = {}
+    for res_idx, res in enumerate(resname):
+        rows = codes == res_idx
+        for data in datastruct:
+            values = break_down[data].to_numpy()
+            if values.dtype == object:
+                wide[(res, data)] = np.where(rows, values, 0)
+            else:
+                wide[(res, data)] = np.where(rows, values, 0.)
+    
+    break_down = pd.DataFrame(wide, index=range(len(info)), columns=col_val)
     
     return break_down
 
-def generate_summary(use_list, conc_pd, timestep, shift=0, qual_type='chem'):
+def summary_nodes(fix_name):
+    '''
+    Nodes that generate_summary reads for a fixture, as (hot node, cold node),
+        None where the fixture does not use that line
+    fix_name: name of the fixture
     '''
-    use_list: provides a list of usages, categorized by type, flow, etc
+    # Sample ports and Hot water Heater nodes  
+    # These are special cases, used for experimental rig
+    if fix_name == 'SPS':
+        return None, fix_name
+    elif fix_name == 'HWS':
+        return fix_name, None
+    elif 'DW' in fix_name:
+        # per US standard, plumbed to hot, 
+        # may need to be changed for international use
+        return fix_name + 'H', None
+    #Cold water only nodes
+    elif any(x in fix_name for x in ['TOL', 'SP', 'RE', 'HU']):
+        return None, fix_name + 'C'
+    #Cold and Hot Water nodes
+    return fix_name + 'H', fix_name + 'C'
+
+
+def generate_summary(use_list, conc_pd, timestep, shift=0, qual_type='chem',
+                     conc_lists=True):
+    '''
+    use_list: provides a list of usages, categorized by type, flow, etc, or 
+              the EventTable of the household
     conc_pd:  dataframe that stores the concentrations by fixture/faucet
     timestep: length of pattern timestep
     shift:    number of days to shift analysis
+    qual_type: 'chem' or 'age', age sums are not weighted by flow rate
+    conc_lists: include the concentrations of each event (hotConc/coldConc)
     
+    Each fixture is resolved to its quality rows once (see summary_nodes), 
+    and the sums of every event are taken from prefix sums of the quality of 
+    each row. hotMean/coldMean are the mean concentrations of each event, NaN
+    for a line the fixture does not use.
     '''
-    results_table = []
-
-    for i in use_list:
-        # shifts the analysis by 1 full day 
-        start = i[0][0] + shift * sec_per_day/timestep 
-        # shifts the analysis by 1 full day
-        end = i[0][1] + shift * sec_per_day/timestep 
-        #adjust for reporting timestep 
-        st = start * timestep + 1           
-        length = (end - start) + 1 #+1 makes the 
-        en = st + length * timestep # + 1 #+1 here?
-        rng = np.arange(st, en)
-        # set the total mass variable, and concentration lists
-        cold_sum = 0.0
-        hot_sum = 0.0
-        hot_temp = []
-        cold_temp = []
-       
-        if i[4] != None:
-            vol_c_used = i[4] * gpm_to_Lps*float(length)*float(timestep)*1.
-            vol_c_rate = i[4] * gpm_to_Lps
-        else:
-            vol_c_used = 0.
-            vol_c_rate = 0.
-            
-        if i[3] != None:
-            vol_h_used = i[3] * gpm_to_Lps*float(length)*float(timestep)*1.
-            vol_h_rate = i[3] * gpm_to_Lps
-        else:
-            vol_h_used = 0.
-            vol_h_rate = 0.     
-        if qual_type.lower() == 'age':
-            vol_c_rate = 1.
-            vol_h_rate = 1.
-        
-        if vol_h_used + vol_c_used > 0:             
-            # Sample ports and Hot water Heater nodes  
-            # These are special cases, used for experimental rig
-            if i[1] == 'SPS' or i[1] == 'HWS':
-                if i[1] == 'SPS':
-                    usename = i[1]
-                    cold_temp = list(conc_pd.loc[usename][rng]) #### revisit
-                    cold_sum = (conc_pd.loc[usename][rng]*vol_c_rate).sum()                      
-                if i[1] == 'HWS':
-                    usename = i[1]
-                    hot_temp = list(conc_pd.loc[usename][rng])
-                    hot_sum = (conc_pd.loc[usename][rng]*vol_h_rate).sum()
-               
-            elif 'DW' in i[1]:
-                usename = i[1]+'H' 
-                        # per US standard, plumbed to hot, 
-                        # may need to be changed for international use
-                hot_temp = list(conc_pd.loc[usename][rng])
-                hot_sum = (conc_pd.loc[usename][rng]*vol_h_rate).sum()
-               
-            #Cold water only nodes
-            elif 'TOL'in i[1]:
-                usename = i[1]+'C'
-                cold_temp = list(conc_pd.loc[usename][rng])
-                cold_sum = (conc_pd.loc[usename][rng]*vol_c_rate).sum()
-            elif 'SP' in i[1]:
-                usename = i[1]+'C'
-                cold_temp = list(conc_pd.loc[usename][rng])
-                cold_sum = (conc_pd.loc[usename][rng]*vol_c_rate).sum()
-            elif 'RE' in i[1]:
-                usename = i[1]+'C'
-                cold_temp = list(conc_pd.loc[usename][rng])
-                cold_sum = (conc_pd.loc[usename][rng]*vol_c_rate).sum()
-            elif 'HU' in i[1]:
-                usename = i[1]+'C'
-                cold_temp = list(conc_pd.loc[usename][rng])
-                cold_sum = (conc_pd.loc[usename][rng]*vol_c_rate).sum()
-            #Cold and Hot Water nodes
-            elif 'WA' in i[1]:
-                # this doesn't seem different than else, revisit
-                nameh = i[1] + 'H'
-                namec = i[1] + 'C'
-                cold_temp = list(conc_pd.loc[namec][rng])
-                hot_temp = list(conc_pd.loc[nameh][rng])
-                cold_sum = (conc_pd.loc[namec][rng]*vol_c_rate).sum()
-                hot_sum = (conc_pd.loc[nameh][rng]*vol_h_rate).sum()
-            else:
-                nameh = i[1] + 'H'
-                namec = i[1] + 'C'
-                cold_temp = list(conc_pd.loc[namec][rng])
-                hot_temp = list(conc_pd.loc[nameh][rng])
-                cold_sum = (conc_pd.loc[namec][rng]*vol_c_rate).sum()
-                hot_sum = (conc_pd.loc[nameh][rng]*vol_h_rate).sum()
-           
-            results_table.append([i, 
-                                 hot_sum, 
-                                 vol_h_used, 
-                                 cold_sum, 
-                                 vol_c_used, 
-                                 hot_temp, 
-                                 cold_temp])
-            
-    summary_pd = pd.DataFrame(data=results_table, columns=['patternInfo', 
-                                                             'hotMass',
-                                                             'hotVolume',
-                                                             'coldMass',
-                                                             'coldVolume',
-                                                             'hotConc',
-                                                             'coldConc'])
-    return summary_pd
+    if isinstance(use_list, events.EventTable):
+        use_list = use_list.to_event_list()
+    columns = ['patternInfo', 'hotMass', 'hotVolume', 'coldMass', 
+               'coldVolume', 'hotConc', 'coldConc', 'hotMean', 'coldMean']
+    if not conc_lists:
+        columns.remove('hotConc')
+        columns.remove('coldConc')
+    
+    # shifts the analysis by full days
+    day_shift = shift * sec_per_day/timestep
+    start = np.array([i[0][0] for i in use_list], dtype=float) + day_shift
+    end = np.array([i[0][1] for i in use_list], dtype=float) + day_shift
+    hot_rate = np.array([0. if i[3] is None else i[3] for i in use_list])
+    cold_rate = np.array([0. if i[4] is None else i[4] for i in use_list])
+    
+    #adjust for reporting timestep 
+    st = start * timestep + 1           # first reporting time of each event
+    length = (end - start) + 1
+    count = (length * timestep).astype(int)   # reporting times of each event
+    vol_h_used = hot_rate * gpm_to_Lps*length*float(timestep)*1.
+    vol_c_used = cold_rate * gpm_to_Lps*length*float(timestep)*1.
+    if qual_type.lower() == 'age':
+        vol_h_rate = np.ones(len(use_list))
+        vol_c_rate = np.ones(len(use_list))
+    else:
+        vol_h_rate = hot_rate * gpm_to_Lps
+        vol_c_rate = cold_rate * gpm_to_Lps
+    
+    keep = np.nonzero(vol_h_used + vol_c_used > 0)[0]
+    if len(keep) == 0:
+        return pd.DataFrame(columns=columns)
+    
+    # rows of the quality array for the hot and cold node of each event
+    row_idx = {name: row for row, name in enumerate(conc_pd.index)}
+    lookup = {}
+    hot_row = np.full(len(keep), -1)
+    cold_row = np.full(len(keep), -1)
+    for k, x in enumerate(keep):
+        fix_name = use_list[x][1]
+        if fix_name not in lookup:
+            lookup[fix_name] = [-1 if name is None else row_idx[name] 
+                                for name in summary_nodes(fix_name)]
+        hot_row[k], cold_row[k] = lookup[fix_name]
+    
+    # columns of the first reporting time of each event
+    times = np.asarray(conc_pd.columns, dtype=float)
+    first = np.searchsorted(times, st[keep])
+    last = first + count[keep] - 1
+    if (last >= len(times)).any() or \
+       (times[np.minimum(first, len(times)-1)] != st[keep]).any() or \
+       (times[np.minimum(last, len(times)-1)] != st[keep] + count[keep] - 1).any():
+        raise KeyError('Event times are not in the reporting times of conc_pd')
+    
+    # prefix sums of the quality of each row in use
+    quality = conc_pd.values
+    rows = np.unique(np.concatenate([hot_row, cold_row]))
+    rows = rows[rows >= 0]
+    prefix = np.zeros((len(quality), len(times) + 1))
+    prefix[rows, 1:] = np.cumsum(quality[rows], axis=1, dtype=np.float64)
+    
+    def event_sums(row):
+        sums = prefix[row, last + 1] - prefix[row, first]
+        sums[row < 0] = 0.
+        return sums
+    hot_sum = event_sums(hot_row)
+    cold_sum = event_sums(cold_row)
+    # mean concentrations, NaN where the fixture does not use the line
+    hot_mean = np.where(hot_row < 0, np.nan, hot_sum / count[keep])
+    cold_mean = np.where(cold_row < 0, np.nan, cold_sum / count[keep])
+    
+    summary_pd = pd.DataFrame({'patternInfo': [use_list[x] for x in keep],
+                               'hotMass': hot_sum * vol_h_rate[keep],
+                               'hotVolume': vol_h_used[keep],
+                               'coldMass': cold_sum * vol_c_rate[keep],
+                               'coldVolume': vol_c_used[keep],
+                               'hotMean': hot_mean,
+                               'coldMean': cold_mean})
+    if conc_lists:
+        def event_lists(row):
+            return [list(quality[r, a:b+1]) if r >= 0 else [] 
+                    for r, a, b in zip(row, first, last)]
+        summary_pd['hotConc'] = event_lists(hot_row)
+        summary_pd['coldConc'] = event_lists(cold_row)
+    
+    return summary_pd[columns]
 
 
 
@@ -491,27 +805,152 @@ def generate_summary(use_list, conc_pd, timestep, shift=0, qual_type='chem'):
 # =============================================================================
 # EPANET and Multiprocessor Operation Functions
 # =============================================================================
-def BinReader_Quality(filename):
+def BinReader_Quality(filename, nodes=None, window=None):
     '''
-    Binary reader function calls WNTR's binary reader. Returns dataframe object.
-    Relies on WNTR so changes to EPANET can be more centrally addressed in future.
+    Binary reader function for node quality, see BinReader_NodeQuality. 
+    Returns dataframe object, in the same layout as WNTR's node quality 
+    results transposed (nodes x report times).
 
     Parameters
     ----------
     filename : string
         filename for binary file to read in.
+    nodes : list of strings, optional
+        names of the nodes to read, all nodes if None
+    window : (start, end), optional
+        first and last report times to read, in seconds
 
     Returns
     -------
     df : nodal quality dataframe
-        See WNTR documentation for more details.
-        returns df object that stores link and node characteristics as 
-        df.node and df.link, which are true pandas dataframes
+        rows are nodes, columns are report times (seconds)
     '''
-    df = (wntr.epanet.io.BinFile().read(filename)).node['quality'].transpose()
+    quality, nodes, times = BinReader_NodeQuality(filename, nodes, window)
+    df = pd.DataFrame(quality, index=nodes, columns=times)
     
     return df  
 
+def BinReader_Prolog(filename):
+    '''
+    Read the prolog and network section of an EPANET binary file, without 
+    reading the simulation results.
+
+    Parameters
+    ----------
+    filename : string
+        filename for binary file to read in.
+
+    Returns
+    -------
+    info : dictionary
+        node_names, num_nodes, num_links, quality_type, flow_units, 
+        mass_units, report_times, and results_offset (bytes from the start 
+        of the file to the first reporting period)
+    '''
+    idlen = 32
+    with open(filename, 'rb') as fin:
+        prolog = np.fromfile(fin, dtype=np.int32, count=15)
+        nnodes, ntanks, nlinks, npumps = [int(x) for x in prolog[2:6]]
+        reportstart, reportstep, duration = [int(x) for x in prolog[12:15]]
+        fin.seek(240 + 260 + 260 + idlen, 1)   # title, file names, chemical
+        wqunits = fin.read(idlen).decode().replace('\x00', '')
+        nodenames = [fin.read(idlen).decode().replace('\x00', '') 
+                     for _ in range(nnodes)]
+    
+    mass = wqunits.split('/', 1)[0]
+    if mass in ['mg', 'ug']:
+        massunits = wntr.epanet.util.MassUnits[mass]
+    else:
+        massunits = wntr.epanet.util.MassUnits.mg
+    
+    reporttimes = np.arange(reportstart, 
+                            duration+reportstep-(duration%reportstep), 
+                            reportstep)
+    if prolog[11] != 0:     # statistics only, a single reporting period
+        reporttimes = np.array([reportstart + reportstep])
+    
+    # prolog and ids, link nodes and types, tank indices and areas, node 
+    # elevations, link lengths and diameters, then pump energy
+    offset = 15*4 + 240 + 260 + 260 + 2*idlen + idlen*(nnodes + nlinks) +\
+             3*4*nlinks + 2*4*ntanks + 4*nnodes + 2*4*nlinks +\
+             npumps*(4 + 6*4) + 4
+    
+    info = {'node_names': nodenames,
+            'num_nodes': nnodes,
+            'num_links': nlinks,
+            'quality_type': wntr.epanet.util.QualType(int(prolog[7])),
+            'flow_units': wntr.epanet.util.FlowUnits(int(prolog[9])),
+            'mass_units': massunits,
+            'report_times': reporttimes,
+            'results_offset': offset}
+    return info
+
+
+def BinReader_NodeQuality(filename, nodes=None, window=None):
+    '''
+    Memory-mapped reader for the node quality of an EPANET binary file. Only
+    the requested nodes and reporting periods are read, in single precision 
+    and the same units as WNTR's binary reader (age in seconds, 
+    concentration in kg/m3).
+
+    Parameters
+    ----------
+    filename : string
+        filename for binary file to read in.
+    nodes : list of strings, optional
+        names of the nodes to read, all nodes if None
+    window : (start, end), optional
+        first and last report times to read, in seconds
+
+    Returns
+    -------
+    quality : float32 array (nodes x report times)
+    nodes : list of node names, rows of quality
+    times : array of report times, columns of quality
+    '''
+    info = BinReader_Prolog(filename)
+    nnodes = info['num_nodes']
+    times = info['report_times']
+    period = 4*nnodes + 8*info['num_links']      # values per reporting period
+    
+    # a simulation that did not finish has fewer reporting periods
+    num_periods = min(len(times), (os.path.getsize(filename) - 
+                                   info['results_offset']) // (4*period))
+    if num_periods < len(times):
+        print('Warning: ' + filename + ' ends at time ' + 
+              str(times[num_periods-1] if num_periods > 0 else 0))
+        times = times[:num_periods]
+    
+    first, last = 0, num_periods
+    if window is not None:
+        first = np.searchsorted(times, window[0], side='left')
+        last = np.searchsorted(times, window[1], side='right')
+    times = times[first:last]
+    
+    if nodes is None:
+        nodes = info['node_names']
+    node_idx = {name: i for i, name in enumerate(info['node_names'])}
+    columns = [3*nnodes + node_idx[name] for name in nodes]   # quality values
+    
+    if num_periods == 0 or last <= first:
+        quality = np.zeros((len(nodes), len(times)), dtype=np.float32)
+    else:
+        data = np.memmap(filename, dtype='<f4', mode='r', 
+                         offset=info['results_offset'], 
+                         shape=(num_periods, period))
+        quality = np.array(data[first:last, columns].T)
+        del data
+    
+    if info['quality_type'] is wntr.epanet.util.QualType.Chem:
+        quality = wntr.epanet.util.QualParam.Concentration._to_si(
+            info['flow_units'], quality, mass_units=info['mass_units'])
+    elif info['quality_type'] is wntr.epanet.util.QualType.Age:
+        quality = wntr.epanet.util.QualParam.WaterAge._to_si(
+            info['flow_units'], quality, mass_units=info['mass_units'])
+    
+    return quality, list(nodes), times
+
+
 def BinReader(filename):
     '''
     Binary reader function calls WNTR's binary reader. Returns dataframe object.
@@ -535,25 +974,64 @@ def BinReader(filename):
     return df  
 
 def runepanet(infile):
-    print('Running: ' + infile)
     mp.freeze_support()
-    wntr.epanet.toolkit.runepanet(infile)
+    with instrument.stage('epanet solve'):
+        wntr.epanet.toolkit.runepanet(infile)
+    if instrument.active() is not None:
+        runID = infile.split('.')[0]
+        instrument.add_bytes('epanet solve', read=os.path.getsize(infile),
+                             written=sum(os.path.getsize(runID + ext) 
+                                         for ext in ['.bin', '.rpt'] 
+                                         if os.path.isfile(runID + ext)))
 
-def mp_read(in_data):
+def fixture_nodes(use_list, node_names):
+    '''
+    Names of the network nodes that generate_summary reads for the fixtures
+        of a household (see summary_nodes)
+    use_list: EventTable or list of usages of the household
+    node_names: names of the network nodes
+    '''
+    if isinstance(use_list, events.EventTable):
+        fixture_names = use_list.fixture_names
+    else:
+        fixture_names = list(dict.fromkeys(i[1] for i in use_list))
+    node_names = set(node_names)
+    nodes = []
+    for fix_name in fixture_names:
+        nodes.extend(x for x in summary_nodes(fix_name) 
+                     if x in node_names and x not in nodes)
+    return nodes
+
+
+def mp_read(in_data, store=None, scenario=None, keep_summary=True):
+    '''
+    Process the binary file of a run and save its summary, then remove the 
+        run files
+    in_data: [input file name, event list]
+    store: result_store.ResultStore to append the summary to, None saves a 
+        json file next to the input file
+    scenario: partition of the run in the store, see monte_carlo_setup
+    keep_summary: save the summary, False when only aggregates are kept
+    returns dataframe of summary results
+    '''
     infile, event_list = in_data    
     runID = infile.split('.')[0]
     outbin = runID+'.bin'
-    print ("Analyzing ", runID)
     mp.freeze_support()
     # while not os.path.isfile(outbin):
     #     print('working')
     #     time.sleep(1)
-    conc_pd = BinReader_Quality(outbin)   # should just be a water quality dataframe
+    # only the nodes of the household fixtures are read
+    with instrument.stage('bin read'):
+        nodes = fixture_nodes(event_list, 
+                              BinReader_Prolog(outbin)['node_names'])
+        conc_pd = BinReader_Quality(outbin, nodes)   # water quality dataframe
+    instrument.add_bytes('bin read', read=conc_pd.values.nbytes)
     
-    summary_pd = generate_summary(event_list, conc_pd, tss)
-    # Save summary to json object. 
-    # Much smaller file size than binary and input files
-    summary_pd.to_json(runID+'.json')
+    with instrument.stage('summary'):
+        summary_pd = generate_summary(event_list, conc_pd, tss)
+        if keep_summary:
+            save_summary(summary_pd, runID, store, scenario)
     
     # Split file delete actions per file for clearer error handling
     try:
@@ -568,66 +1046,465 @@ def mp_read(in_data):
         os.remove(runID + '.rpt')
     except:
         print('Error removing ' + runID +'.rpt')
+    
+    return summary_pd
+
+
+def save_summary(summary_pd, runID, store=None, scenario=None):
+    '''
+    Save the summary of a run, to the result store if given or else to a 
+        json file (much smaller file size than binary and input files)
+    summary_pd: dataframe of summary results
+    runID: run file name without extension
+    store: result_store.ResultStore, optional
+    scenario: partition of the run in the store, see monte_carlo_setup
+    '''
+    if store is None:
+        path = runID + '.json'
+        summary_pd.to_json(path)
+    else:
+        path = store.append(scenario, summary_pd, runID.rsplit('/', 1)[-1])
+    if instrument.active() is not None:
+        instrument.add_bytes('summary', written=os.path.getsize(path))
+
+
+_event_cache = {}
+_event_stores = {}
+
+def load_event_list(run):
+    '''
+    Load the event table of a run from the event store of its campaign, 
+        only the events of the trial are read. Each process keeps its stores
+        open, with a small LRU cache of recently used trials.
+    Runs set up before the event store (column2 is a pickle file of the 
+        event dictionary) read the pickle file, the last pickle file read is
+        kept in memory.
+    run: row of available, [trial ID, event store, folder, inp file, 
+        scenario]
+    '''
+    if run[1].endswith('.pickle'):
+        pckl = run[1]                # Pickle file location
+        if pckl not in _event_cache:
+            _event_cache.clear()
+            with open(pckl, 'rb') as f:
+                _event_cache[pckl] = cPickle.load(f)
+        return _event_cache[pckl][run[0]]
+    key = event_store.event_key(run_scenario(run)[1], run[0])
+    return open_event_store(run[1]).get(key)
+
+
+def open_event_store(filename):
+    '''
+    Event store of a campaign, opened once per process. The campaign setup 
+        writes through the same store its runs are read from, so trials it
+        replaces are never read from the cache.
+    filename: SQLite file of the store, column2 of available
+    '''
+    if filename not in _event_stores:
+        _event_stores[filename] = event_store.EventStore(filename)
+    return _event_stores[filename]
+
+
+def run_and_read(run, store=None, aggregator=None, keep_summary=True, 
+                 cache=None):
+    '''
+    Run the EPANET simulation of a single run, then process the binary file 
+        and save the summary (see mp_read)
+    run: row of available, [trial ID, event store, folder, inp file, scenario]
+    store: result_store.ResultStore to append the summary to, optional
+    aggregator: campaign_stats.CampaignAggregator, the events of the run are
+        added to an empty copy of it
+    keep_summary: save the summary, False when only aggregates are kept
+    cache: result_cache.ResultCache to store the summary in, under the key 
+        of the run
+    returns input file name, error message (None if successful), and the 
+        partial aggregator of the run (None if not aggregating)
+    '''
+    infile = run[2] + run[3]     # Input file to consider
+    try:
+        runepanet(infile)
+        scenario = None
+        if store is not None or aggregator is not None:
+            scenario = run_scenario(run)
+        summary_pd = mp_read([infile, load_event_list(run)], store, scenario,
+                             keep_summary)
+        if cache is not None and len(run) > 5:
+            cache.put(run[5], summary_pd)
+        partial = aggregate_summary(summary_pd, aggregator, scenario)
+        instrument.count('runs')
+    except Exception as e:
+        return infile, repr(e), None
+    return infile, None, partial
+
+
+def aggregate_summary(summary_pd, aggregator, scenario):
+    '''
+    Add the events of a run to an empty copy of the aggregator
+    returns the partial aggregator, None if aggregator is None
+    '''
+    if aggregator is None:
+        return None
+    partial = aggregator.empty()
+    partial.update(summary_pd, scenario)
+    return partial
+
+
+def run_scenario(run):
+    '''
+    Scenario of a run, (people, flow type, hwh gal, pipe diam, pipe scaling).
+        Rows of available from older setups have no scenario column, it is 
+        taken from the run folder names instead.
+    run: row of available
+    '''
+    if len(run) > 4:
+        return run[4]
+    folders = run[2].replace('\\', '/').rstrip('/').split('/')[-5:]
+    people, flow, gal, diam, scale = folders
+    return (int(people.split('_')[0]), flow, int(gal.split('_')[0]),
+            float(diam.split('_')[0].replace('-', '.')),
+            float(scale[:-1].replace('-', '.')))
 
 
-def mp_run_epanet(available):
-    def chunks(lst, n):
-        a = []
-        for i in range(0, len(lst), n):
-             a.append(lst[i:i+n])
-        return a
+_engine_cache = {}
+
+def load_engine(run, screening=False):
+    '''
+    Open the network of a run with the EPANET toolkit. The last network 
+        opened is kept, since runs of the same network come in order.
+    run: row of available, [trial ID, event store, folder, inp file]
+    screening: open the network with the plug flow water age engine 
+        (plugflow_engine.PlugFlowEngine) instead of EPANET
+    '''
+    base_name = run[0].rsplit('-', 1)[0]
+    key = (run[2] + base_name + '.inp', screening)
+    if key not in _engine_cache:
+        close_engines()
+        if screening:
+            _engine_cache[key] = plugflow_engine.PlugFlowEngine(key[0])
+        else:
+            _engine_cache[key] = toolkit_engine.ToolkitEngine(key[0])
+    return _engine_cache[key]
+
+
+def close_engines():
+    '''
+    Close the engine kept by load_engine. EPANET removes its hydraulics 
+        scratch file from the working directory when the engine is closed.
+    '''
+    for engine in _engine_cache.values():
+        engine.close()
+    _engine_cache.clear()
+
+
+def _init_engine_worker():
+    # pool workers exit without running atexit, a finalizer closes the 
+    # engine of the worker when the pool shuts it down
+    mp_util.Finalize(None, close_engines, exitpriority=10)
+
+
+def toolkit_run_and_read(run, store=None, aggregator=None, 
+                         keep_summary=True, cache=None, screening=False):
+    '''
+    Run a single trial in memory with the EPANET toolkit and save the summary,
+        without writing INP or binary files
+    run: row of available, [trial ID, event store, folder, inp file, scenario]
+    store, aggregator, keep_summary, cache: see run_and_read
+    screening: route water age with the plug flow engine instead of EPANET,
+        much faster for screening campaigns of tree networks (see 
+        plugflow_engine and PPMtools_validate)
+    returns input file name, error message (None if successful), and the 
+        partial aggregator of the run (None if not aggregating)
+    '''
+    infile = run[2] + run[3]
+    try:
+        engine = load_engine(run, screening)
+        table = load_event_list(run)
+        patterns = list(engine.pattern_names)
+        for fix_name in table.fixture_names:
+            patterns.extend(x for x in [fix_name + 'CP', fix_name + 'HP'] 
+                            if x not in patterns)
+        TOT_LENGTH = int(engine.duration / engine.pattern_step)
+        engine.set_nodes(fixture_nodes(table, engine.node_names))
+        with instrument.stage('pattern build'):
+            patt_dict = table_pattern_dict(table, patterns, TOT_LENGTH)
+        with instrument.stage('plug flow solve' if screening else 
+                              'epanet solve'):
+            conc_pd = engine.quality_frame(patt_dict)
+        scenario = None
+        if store is not None or aggregator is not None:
+            scenario = run_scenario(run)
+        with instrument.stage('summary'):
+            summary_pd = generate_summary(table, conc_pd, tss)
+            if keep_summary:
+                save_summary(summary_pd, infile.split('.')[0], store, 
+                             scenario)
+        if cache is not None and len(run) > 5:
+            cache.put(cache_key(run, screening), summary_pd)
+        partial = aggregate_summary(summary_pd, aggregator, scenario)
+        instrument.count('runs')
+    except Exception as e:
+        return infile, repr(e), None
+    return infile, None, partial
+
+
+def cache_key(run, screening=False):
+    '''
+    Cache key of a run for the engine that simulates it, screening runs of
+        the plug flow engine are cached apart from EPANET runs (see 
+        result_cache.engine_key)
+    run: row of available, the key of the run is column 6
+    returns the key, None if the run has no key
+    '''
+    if len(run) <= 5:
+        return None
+    return result_cache.engine_key(run[5], 'plugflow' if screening 
+                                           else 'epanet')
+
+
+def recorded_task(task, run, **kwargs):
+    '''
+    Run a task (run_and_read or toolkit_run_and_read) recording its stages 
+        into a new recorder, see instrument
+    returns the result of the task and the records of the task
+    '''
+    instrument.start()
+    try:
+        result = task(run, **kwargs)
+    finally:
+        records = instrument.stop().state()
+    return result, records
+
+
+def run_batch(task, runs):
+    '''
+    Run several runs in one worker task, timing each run
+    task: run_and_read or toolkit_run_and_read, with its keyword arguments
+        set (see functools.partial)
+    runs: list of rows of available
+    returns list of task results, and the measurements of the task for 
+        worker_tuning.ConcurrencyTuner.update: the duration of each run and
+        the memory each run added to the worker (see instrument.run_rss)
+    '''
+    results = []
+    seconds = []
+    rss = []
+    for run in runs:
+        start = time.perf_counter()
+        result, run_rss = instrument.run_rss(task, run)
+        seconds.append(time.perf_counter() - start)
+        results.append(result)
+        if run_rss is not None:
+            rss.append(run_rss)
+    return results, {'pid': os.getpid(), 'seconds': seconds, 'rss': rss}
+
+
+def use_cached_summary(run, cache, store=None, aggregator=None, 
+                       keep_summary=True, screening=False):
+    '''
+    Save and aggregate the cached summary of a run instead of simulating it
+    run: row of available, the key of the run is column 6
+    cache: result_cache.ResultCache
+    store, aggregator, keep_summary: see run_and_read, the aggregator is 
+        updated in place
+    screening: use the cached summary of the plug flow engine instead of 
+        EPANET, see cache_key
+    returns True if the run was cached
+    '''
+    key = cache_key(run, screening)
+    summary_pd = None if key is None else cache.get(key)
+    if summary_pd is None:
+        return False
+    scenario = None
+    if store is not None or aggregator is not None:
+        scenario = run_scenario(run)
+    if keep_summary:
+        save_summary(summary_pd, (run[2] + run[3]).split('.')[0], store, 
+                     scenario)
+    if aggregator is not None:
+        aggregator.update(summary_pd, scenario)
+    return True
+
+
+def mp_run_epanet(available, num_proc=None, toolkit=False, store=None,
+                  aggregator=None, keep_summaries=True, cache=None,
+                  max_pending=None, progress=None, memory_budget=None,
+                  tuning_file=None, screening=False):
+    '''
+    Run and process all available runs. A single pool of workers runs each 
+        simulation and processes its output in the same task, results are 
+        collected as soon as each run finishes.
+    available: list of runs, as returned by monte_carlo_setup, or a 
+        generator of runs from iter_monte_carlo. Runs are taken from it only
+        when a worker is free, so generation and simulation overlap.
+    num_proc: number of processes, defaults to the number of cores. 1 runs 
+        everything in this process. Without a num_proc or with a 
+        memory_budget the number of concurrent runs is adaptive, see 
+        memory_budget.
+    toolkit: run the trials in memory with the EPANET toolkit (see 
+        toolkit_run_and_read), for runs set up with write_inp=False
+    store: result_store.ResultStore to append the summaries to, partitioned 
+        by scenario. None saves a json file per run.
+    aggregator: campaign_stats.CampaignAggregator, updated in place with the 
+        events of every run. Each task sketches its own run, the partials are
+        merged here as runs finish.
+    keep_summaries: save the summary of each run, False keeps only the 
+        aggregator
+    cache: result_cache.ResultCache. Runs already in the cache are not 
+        simulated, their cached summary is saved and aggregated instead. New
+        summaries are added to the cache.
+    max_pending: most runs taken from available and not yet finished, which
+        bounds the input files on disk when available is a generator. 
+        Defaults to twice the number of processes.
+    progress: progress callback (see instrument.Progress), defaults to 
+        printing the number of runs finished every 10 seconds
+    memory_budget: bytes the concurrent runs may use together, defaults to
+        80% of the physical memory. The memory each run adds to its worker
+        (peak RSS above the RSS before the run) and the duration of the 
+        latest runs set how many runs are simulated at once (at most 
+        num_proc) and how many runs are handed to a worker in one task. Both
+        are raised or lowered as runs finish, see 
+        worker_tuning.ConcurrencyTuner.
+    tuning_file: JSON file of the adaptive settings. If it exists the 
+        settings start from it, and the chosen settings are written to it
+        at the end, for later campaigns.
+    screening: route water age with the plug flow engine instead of EPANET
+        (see toolkit_run_and_read), for runs set up with write_inp=False. 
+        Its summaries are cached apart from EPANET summaries, see cache_key.
     
-    # Calculate how many cores to use
-    num_proc = int(mp.cpu_count()*.75) # not max due to memory constraints
-    # if 'win' in sys.platform:
-    #     num_proc = 1
+    When instrument.start() was called, every task records its stages and 
+        the records are merged into the active recorder by worker.
+    returns list of input files that failed
+    '''
+    # Calculate how many cores to use, adaptive unless a fixed number is set
+    tuner = None
+    if num_proc is None or memory_budget is not None:
+        if num_proc is None:
+            num_proc = mp.cpu_count()
+        if tuning_file is not None and os.path.isfile(tuning_file):
+            tuner = worker_tuning.load_tuner(tuning_file, num_proc, 
+                                             memory_budget)
+        else:
+            tuner = worker_tuning.ConcurrencyTuner(num_proc, memory_budget)
+    if max_pending is None:
+        max_pending = 2 * num_proc
     
-    # num_proc = 1 # temporary reset, until multiprocessing is working correctly
+    if progress is None:
+        progress = instrument.Progress()
+    total = len(available) if hasattr(available, '__len__') else None
+    recorder = instrument.active()
     
+    task = toolkit_run_and_read if toolkit or screening else run_and_read
+    sketch = None if aggregator is None else aggregator.empty()
+    kwargs = {'store': store, 'aggregator': sketch, 
+              'keep_summary': keep_summaries, 'cache': cache}
+    if screening:
+        kwargs['screening'] = True
+    if recorder is None:
+        task = functools.partial(task, **kwargs)
+    else:
+        task = functools.partial(recorded_task, task, **kwargs)
+    
+    failed = []
+    num_cached = 0
+    num_done = 0
+    pool = None
     if num_proc > 1:
-        run_sets = chunks(available, num_proc)
-        # if __name__ == 'main':
-        for group in run_sets:
-
-            
-            to_run = [x[2] + x[3] for x in group]
-            
-            pool = mp.Pool(processes=num_proc)
-            res = pool.map(runepanet, to_run)
+        pool = mp.Pool(processes=num_proc, initializer=_init_engine_worker)
+    finished = queue.Queue()     # results of the pool, in order of finishing
+    num_pending = 0              # runs handed to the pool and not finished
+    num_tasks = 0
+    
+    def collect(result):
+        nonlocal num_done
+        if recorder is not None:
+            result, records = result
+            recorder.merge(records)
+        infile, error, partial = result
+        if partial is not None:
+            aggregator.merge(partial)
+        if error is not None:
+            print('Error running ' + infile + ': ' + error)
+            failed.append(infile)
+        num_done += 1
+        progress('runs', num_done, total)
+    
+    def batch_error(e, batch):
+        results = []
+        for run in batch:
+            result = (run[2] + run[3], repr(e), None)
+            if recorder is not None:
+                result = (result, {'workers': {}, 'counts': {}})
+            results.append(result)
+        finished.put((results, {'seconds': []}))
+    
+    def collect_batch():
+        nonlocal num_pending, num_tasks
+        results, stats = finished.get()
+        for result in results:
+            collect(result)
+        num_pending -= len(results)
+        num_tasks -= 1
+        if tuner is not None and len(stats['seconds']) > 0:
+            tuner.update(stats)
+    
+    def busy(batch):
+        # the pool is full, or the batch does not fit under max_pending
+        if num_tasks == 0:
+            return False
+        if tuner is not None and num_tasks >= tuner.concurrency:
+            return True
+        return num_pending + len(batch) > max_pending
+    
+    def submit(batch):
+        nonlocal num_pending, num_tasks
+        while busy(batch):
+            collect_batch()
+        pool.apply_async(run_batch, (task, batch), callback=finished.put,
+                         error_callback=lambda e, batch=batch: 
+                             batch_error(e, batch))
+        num_pending += len(batch)
+        num_tasks += 1
+    
+    batch = []
+    try:
+        for run in available:
+            if cache is not None and use_cached_summary(run, cache, store, 
+                                                        aggregator,
+                                                        keep_summaries,
+                                                        screening):
+                num_cached += 1
+                num_done += 1
+                progress('runs', num_done, total)
+                continue
+            if pool is None:
+                collect(task(run))
+                continue
+            batch.append(run)
+            if len(batch) >= (1 if tuner is None else tuner.chunk):
+                submit(batch)
+                batch = []
+        if len(batch) > 0:
+            submit(batch)
+        while num_tasks > 0:
+            collect_batch()
+    finally:
+        if pool is not None:
             pool.close()
             pool.join()
-            
-            # MP reader
-            
-            read_obj = [] # need iterable for multiprocess
-            for run in group:
-                base = run[0]
-                infile = run[2] + run[3]
-                events = cPickle.load(open(run[1], 'rb'))
-                event_list = events[base]
-                read_obj.append([infile, event_list])
-            
-            pool2 = mp.Pool(processes=num_proc)
-            res2 = pool2.map(mp_read, read_obj)
-            pool2.close()
-            pool2.join()
-            
-
-    else:
-        for run in available:
-            try:
-                base = run[0]            # Base name
-                # Run EPANET simulation
-                infile = run[2] + run[3] # Input file to consider
-                runepanet(infile)       
-                # Get Event List information
-                pckl = run[1]            # Pickle file location
-                pickle_obj = cPickle.load(open(pckl, 'rb'))
-                event_list = pickle_obj[base]
-                # Process binary file, save json
-                mp_read(infile, event_list)
-            except:
-                print('Error running ' + infile)
+        close_engines()
+    
+    progress('runs', num_done, total, final=True)
+    if cache is not None:
+        progress('cached runs', num_cached, final=True)
+    if tuner is not None and pool is not None:
+        settings = tuner.settings()
+        print('Concurrency: ' + str(settings['concurrency']) + ' runs, ' + 
+              str(settings['chunk']) + ' runs per task, ' + 
+              str(round((settings['run_rss'] or 0) / 2**20)) + ' MB per run')
+        if tuning_file is not None:
+            tuner.save(tuning_file)
+    
+    return failed
             
                 
 
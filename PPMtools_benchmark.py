@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+PPMtools benchmark suite.
+
+Times trial generation, pattern building and writing, binary reading, and
+summaries on the houses in INP_Files, for growing numbers of residents,
+simulated days, and trials. EPANET is not needed: the binary file read by
+BinReader_Quality and generate_summary is written synthetically, in the
+EPANET 2.2 output format, for the same network and report times as a real
+run. Results are written as JSON for comparing commits.
+
+Usage:
+    python PPMtools_benchmark.py [--quick] [--output results.json]
+                                 [--compare previous.json]
+
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import numpy as np
+import wntr
+
+import PPMtools
+import house
+import person
+from PPMtools_units import *
+
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+HOUSES = {'House1': FOLDER + '/INP_Files/House1_House_Age.inp',
+          'House2': FOLDER + '/INP_Files/House2_House_Age.inp',
+          'House3': FOLDER + '/INP_Files/House3_House_Age.inp'}
+
+# fixture type and max rate (gal/min, gal per cycle for appliances) by
+# node name prefix
+FIXTURE_TYPES = {'SP':  ['spigot', 5.0],
+                 'SH':  ['shower', 2.0],
+                 'TOL': ['toilet', 1.6],
+                 'F':   ['faucet', 1.5],
+                 'WA':  ['washer', 30.],
+                 'DW':  ['dishwasher', 6.],
+                 'RE':  ['fridge', 0.5],
+                 'HU':  ['humidifier', 0.5]}
+
+WEEKDAY = [['shower', 'AM', 1, 60], ['toilet', 'AM_PM', 4, 6],
+           ['hands', 'all_day', 6, 3], ['drink', 'day2', 3, 1],
+           ['teeth', 'AM_PM', 2, 12], ['humidify', 'PM', 1, 30]]
+WEEKEND = WEEKDAY + [['lawn', 'day', 1, 120], ['laundry', 'day2', 1, 360]]
+HOUSEHOLD = [['dishes', 'day2', 0, 10]]
+
+# synthetic binary files (one report per second) are only written for up to
+# bin_days, about 200 MB per day for House1
+FULL = {'residents': [1, 2, 4], 'days': [1, 2, 7], 'trials': [1, 10],
+        'bin_days': 2, 'repeat': 5}
+QUICK = {'residents': [1, 2], 'days': [1], 'trials': [1, 4], 'bin_days': 1,
+         'repeat': 2}
+
+
+def house_fixtures(wn):
+    """
+    Fixture list of a house from its node names (e.g. SH1C and SH1H are
+        shower SH1), see FIXTURE_TYPES
+    wn: water network model
+    """
+    fixture_info = []
+    for node in wn.junction_name_list:
+        if node[-1] not in 'CH':
+            continue
+        name = node[:-1]
+        prefix = name.rstrip('0123456789')
+        if prefix in FIXTURE_TYPES and \
+           name not in [fix[1] for fix in fixture_info]:
+            fix_type, rate = FIXTURE_TYPES[prefix]
+            fixture_info.append([fix_type, name, rate])
+    return fixture_info
+
+
+def load_network(inpfile, days):
+    """
+    Load a house network for a run of the given number of days, with the 
+        time steps of House2 (tss, quality and reports every second). The 
+        network runs two hours longer, for events that are moved past the 
+        end of the last day.
+    """
+    wn = wntr.network.WaterNetworkModel(inpfile)
+    wn.options.time.duration = days * sec_per_day + 2 * sec_per_hr
+    wn.options.time.hydraulic_timestep = tss
+    wn.options.time.quality_timestep = 1
+    wn.options.time.pattern_timestep = tss
+    wn.options.time.report_timestep = 1
+    wn.options.time.report_start = 0
+    return wn
+
+
+def routine_for(home, routine):
+    """
+    Drop the actions of a routine that have no fixture in the house
+    """
+    return [task for task in routine if task[0] not in person.ACTIONS or
+            len(getattr(home, person.ACTIONS[task[0]][0])) > 0]
+
+
+def make_household(wn, num_people, days):
+    """
+    Household of a house network with num_people residents following the
+        standard routines, and the days of the modeled week
+    """
+    fixture_info = house_fixtures(wn)
+    home = house.Household('Bench-P' + str(num_people), fixture_info)
+    days_in_week = (['wd', 'wd', 'wd', 'wd', 'wd', 'we', 'we'] * days)[:days]
+    weekday = routine_for(home, WEEKDAY)
+    weekend = routine_for(home, WEEKEND)
+    people = []
+    for p in range(1, num_people + 1):
+        routine = PPMtools.week_routine_person(days_in_week, weekday, weekend)
+        people.append(person.Resident('P' + str(p), home, routine))
+    routine = PPMtools.week_routine_home(days_in_week,
+                                         routine_for(home, HOUSEHOLD))
+    people.append(person.Resident('Home', home, routine))
+    home.residents = people
+    return home, days_in_week
+
+
+def write_synthetic_bin(filename, wn, quality, qual_type=2, flow_units=1):
+    """
+    Write an EPANET 2.2 binary output file for a network with the given node
+        quality, readable by BinReader_Quality and WNTR's BinFile. Flows,
+        heads, and link results are zero.
+    filename: name of the binary file
+    wn: water network model, sets the node and link names and report times
+    quality: array of node quality (report times x nodes), in the units of
+        the file (hours for age)
+    qual_type: EPANET quality code, 2 is age
+    flow_units: EPANET flow units code, 1 is GPM
+    """
+    idlen = 32
+    nodes = wn.node_name_list
+    links = wn.link_name_list
+    nnodes, nlinks = len(nodes), len(links)
+    tanks = wn.tank_name_list + wn.reservoir_name_list
+    ntanks = len(tanks)
+    npumps = len(wn.pump_name_list)
+    nvalves = len(wn.valve_name_list)
+    times = wn.options.time
+    duration = int(times.duration)
+    report_step = int(times.report_timestep)
+    report_start = int(times.report_start)
+    num_periods = len(range(report_start, duration + 1, report_step))
+    quality = np.asarray(quality, dtype='<f4')
+    if quality.shape != (num_periods, nnodes):
+        raise ValueError('quality must be (report times x nodes), ' +
+                         str((num_periods, nnodes)))
+
+    def text(value, size):
+        return value.encode()[:size].ljust(size, b'\x00')
+
+    node_index = {name: i + 1 for i, name in enumerate(nodes)}
+    with open(filename, 'wb') as f:
+        np.array([516114521, 20012, nnodes, ntanks, nlinks, npumps, nvalves,
+                  qual_type, 0, flow_units, 0, 0, report_start, report_step,
+                  duration], dtype='<i4').tofile(f)
+        f.write(b'\x00' * (3 * 80 + 2 * 260))          # title, file names
+        f.write(text('', idlen) + text('hrs', idlen))   # chemical, units
+        for name in nodes:
+            f.write(text(name, idlen))
+        for name in links:
+            f.write(text(name, idlen))
+        ends = [(node_index[wn.get_link(name).start_node_name],
+                 node_index[wn.get_link(name).end_node_name])
+                for name in links]
+        np.array([x[0] for x in ends], dtype='<i4').tofile(f)
+        np.array([x[1] for x in ends], dtype='<i4').tofile(f)
+        np.ones(nlinks, dtype='<i4').tofile(f)          # all pipes
+        np.array([node_index[name] for name in tanks], dtype='<i4').tofile(f)
+        np.zeros(ntanks, dtype='<f4').tofile(f)         # tank areas
+        np.zeros(nnodes, dtype='<f4').tofile(f)         # elevations
+        np.zeros(nlinks, dtype='<f4').tofile(f)         # lengths
+        np.zeros(nlinks, dtype='<f4').tofile(f)         # diameters
+        f.write(b'\x00' * (npumps * (4 + 6 * 4) + 4))   # energy
+        period = np.zeros((num_periods, 4 * nnodes + 8 * nlinks), dtype='<f4')
+        period[:, 3 * nnodes:4 * nnodes] = quality
+        period.tofile(f)
+        np.zeros(4, dtype='<f4').tofile(f)              # reaction rates
+        np.array([num_periods, 0, 516114521], dtype='<i4').tofile(f)
+
+
+def synthetic_quality(wn, seed=0):
+    """
+    Water age (hours) of each node for a synthetic binary file, growing with
+        time and reset at a random interval of each node
+    """
+    times = wn.options.time
+    report_times = np.arange(times.report_start, times.duration + 1,
+                             times.report_timestep)
+    rng = np.random.default_rng(seed)
+    num_nodes = len(wn.node_name_list)
+    interval = rng.uniform(1., 48., num_nodes) * sec_per_hr
+    offset = rng.uniform(0., 1., num_nodes) * interval
+    age = (report_times[:, None] + offset[None, :]) % interval[None, :]
+    return age / sec_per_hr
+
+
+def time_call(func, repeat=5, number=1):
+    """
+    Time a function call
+    func: function without arguments
+    repeat: number of timings
+    number: calls per timing
+    returns dictionary of min, median, and mean seconds per call
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    return {'min': min(timings), 'median': float(np.median(timings)),
+            'mean': float(np.mean(timings)), 'repeat': repeat,
+            'number': number}
+
+
+def bench_house(name, inpfile, settings, folder, seed=0):
+    """
+    Benchmark every function on a single house, for each combination of
+        residents and days (and trials for trial generation)
+    returns list of result dictionaries
+    """
+    results = []
+    repeat = settings['repeat']
+
+    def record(benchmark, func, number=1, **params):
+        result = {'benchmark': benchmark, 'house': name}
+        result.update(params)
+        result.update(time_call(func, repeat, number))
+        results.append(result)
+        print('{:22s} {:8s} {} {:.6f} s'.format(benchmark, name, params,
+                                                result['min']))
+
+    for days in settings['days']:
+        wn = load_network(inpfile, days)
+        binfile = None
+        if days <= settings['bin_days']:
+            binfile = folder + '/' + name + '-' + str(days) + '.bin'
+            write_synthetic_bin(binfile, wn, synthetic_quality(wn, seed))
+        for num_people in settings['residents']:
+            params = {'residents': num_people, 'days': days}
+            home, days_in_week = make_household(wn, num_people, days)
+            resident = home.residents[0]
+            home.new_trial(random.Random(seed))
+
+            def build_queue():
+                for day in range(len(days_in_week)):
+                    resident.build_queue(day)
+            record('build_queue', build_queue, **params)
+
+            def simulate_usage():
+                home.new_trial(random.Random(seed))
+                home.simulate_usage(days_in_week)
+            record('simulate_usage', simulate_usage, **params)
+
+            # busy windows of a full trial for available_times
+            fix = max((x for x in home.fixtures if len(x.busy_starts) > 0),
+                      key=lambda x: len(x.busy_starts), default=None)
+            if fix is not None:
+                rng = random.Random(seed)
+                last = int(days * sec_per_day / tss)
+                proposals = [list(range(start, start + 30)) for start in
+                             [rng.randrange(last) for _ in range(1000)]]
+
+                def available_times():
+                    for times in proposals:
+                        fix.available_times(times)
+                record('available_times', available_times, number=1,
+                       calls=len(proposals), **params)
+
+            record('build_pattern_dict',
+                   lambda: PPMtools.build_pattern_dict(wn, home), **params)
+            patterns = PPMtools.build_pattern_dict(wn, home)
+            inpfile_out = folder + '/' + name + '.inp'
+            record('update_patterns',
+                   lambda: PPMtools.update_patterns(wn, patterns,
+                                                    inpfile_out), **params)
+
+            if binfile is not None:
+                nodes = PPMtools.fixture_nodes(home.event_table,
+                                               wn.node_name_list)
+                record('BinReader_Quality',
+                       lambda: PPMtools.BinReader_Quality(binfile, nodes),
+                       **params)
+                conc_pd = PPMtools.BinReader_Quality(binfile, nodes)
+                record('generate_summary',
+                       lambda: PPMtools.generate_summary(home.event_table,
+                                                         conc_pd, tss),
+                       **params)
+
+            for num_trials in settings['trials']:
+                def generate_trials():
+                    for trial in range(num_trials):
+                        PPMtools.generate_trial(wn, home, days_in_week,
+                                                PPMtools.trial_rng(seed,
+                                                                   num_people,
+                                                                   trial))
+                record('generate_trial', generate_trials, trials=num_trials,
+                       **params)
+        if binfile is not None:
+            os.remove(binfile)
+    return results
+
+
+def git_commit():
+    """
+    Commit of the working tree, None if not in a git repository
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=FOLDER, stderr=subprocess.DEVNULL
+                                       ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(houses=None, settings=FULL, seed=0):
+    """
+    Run the benchmarks on the bundled houses
+    houses: names of the houses, None for all of HOUSES
+    settings: residents, days, trials, and repeat to benchmark, see FULL
+    returns dictionary of metadata and results
+    """
+    if houses is None:
+        houses = list(HOUSES)
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for name in houses:
+            results.extend(bench_house(name, HOUSES[name], settings, folder,
+                                       seed))
+    metadata = {'commit': git_commit(),
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'wntr': wntr.__version__,
+                'platform': platform.platform(),
+                'settings': settings}
+    return {'metadata': metadata, 'results': results}
+
+
+def compare_results(old, new):
+    """
+    Print the ratio of new to old minimum times of matching benchmarks
+    old, new: dictionaries from run_benchmarks (or their JSON files)
+    """
+    def key(result):
+        return tuple((k, v) for k, v in sorted(result.items())
+                     if k not in ['min', 'median', 'mean', 'repeat',
+                                  'number'])
+    old_min = {key(x): x['min'] for x in old['results']}
+    for result in new['results']:
+        before = old_min.get(key(result))
+        if before:
+            print('{:22s} {:8s} {:40s} {:6.2f}x'.format(
+                result['benchmark'], result['house'],
+                str({k: v for k, v in key(result)
+                     if k not in ['benchmark', 'house']}),
+                before / result['min']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='PPMtools benchmarks')
+    parser.add_argument('--quick', action='store_true',
+                        help='fewer residents, days, trials, and repeats')
+    parser.add_argument('--houses', nargs='*', choices=list(HOUSES),
+                        help='houses to benchmark, default all')
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='JSON file of results')
+    parser.add_argument('--compare', help='JSON file of earlier results')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.houses, QUICK if args.quick else FULL)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('Results written to ' + args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""
+PPMtools work queue.
+
+Spreads the runs of a campaign over several machines through a SQLite job
+queue on a shared filesystem, no external service is needed. Runs from
+monte_carlo_setup (or iter_monte_carlo) are submitted once, then workers
+started on any number of hosts claim runs one at a time, hold a lease on
+each run while they simulate it and extend it with heartbeats, and record
+the result. Runs of a worker that dies are queued again when their lease
+expires. Workers run the same tasks as mp_run_epanet, so summaries, the
+result store, and the result cache work as before, and the partial
+campaign sketch of every run is kept in the queue for merging.
+
+Paths (INP files, pickles, store, cache) must be the same on every host.
+SQLite locking needs a filesystem with working POSIX locks, e.g. a local
+disk or NFS with locking enabled.
+
+Usage:
+    python PPMtools_queue.py worker queue.db [--poll 5] [--lease 120]
+                                             [--max-jobs N] [--exit-when-idle]
+    python PPMtools_queue.py status queue.db
+
+
+"""
+
+import os
+import sys
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import functools
+import _pickle as cPickle
+
+import PPMtools
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id          INTEGER PRIMARY KEY,
+    infile      TEXT UNIQUE,
+    run         BLOB,
+    status      TEXT DEFAULT 'pending',
+    worker      TEXT,
+    lease_until REAL,
+    attempts    INTEGER DEFAULT 0,
+    error       TEXT,
+    partial     BLOB,
+    updated     REAL);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+CREATE TABLE IF NOT EXISTS settings (
+    name        TEXT PRIMARY KEY,
+    value       BLOB);
+'''
+
+STATUSES = ['pending', 'running', 'done', 'failed']
+
+
+def worker_name():
+    """
+    Name of this worker process, host name and process ID
+    """
+    return socket.gethostname() + ':' + str(os.getpid())
+
+
+class JobQueue:
+    """
+    SQLite queue of the runs of a campaign
+    """
+    def __init__(self, filename, lease=120., max_attempts=3, timeout=60.):
+        """
+        Open the queue, the database is created if needed
+        filename: SQLite database file, on a filesystem shared by the hosts
+        lease: seconds a claimed run is held without a heartbeat before it
+            is queued again
+        max_attempts: claims of a run before it is marked failed, for runs
+            that keep killing their worker
+        timeout: seconds to wait for the database lock
+        """
+        self.filename = filename
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+
+    def _connect(self):
+        # a connection per call, so threads and processes never share one
+        conn = sqlite3.connect(self.filename, timeout=self.timeout,
+                               isolation_level=None)
+        return _Transaction(conn)
+
+
+    def submit(self, available, toolkit=False, store=None, aggregator=None,
+               keep_summaries=True, cache=None, screening=False):
+        """
+        Add runs to the queue. The first submit sets how workers run them 
+            (see mp_run_epanet), later submits only add runs. Runs already 
+            in the queue are not added again.
+        available: list of runs from monte_carlo_setup, or a generator of
+            runs from iter_monte_carlo
+        toolkit, store, keep_summaries, cache, screening: see mp_run_epanet
+        aggregator: campaign_stats.CampaignAggregator, workers sketch every
+            run with an empty copy of it, see JobQueue.aggregator
+        returns number of runs added
+        """
+        settings = {'toolkit': toolkit, 'screening': screening, 
+                    'store': store,
+                    'keep_summaries': keep_summaries, 'cache': cache,
+                    'aggregator': None if aggregator is None
+                                  else aggregator.empty()}
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for name, value in settings.items():
+                conn.execute('INSERT OR IGNORE INTO settings VALUES (?, ?)',
+                             (name, cPickle.dumps(value)))
+        added = 0
+        batch = []
+        for run in available:
+            batch.append((run[2] + run[3], cPickle.dumps(run), time.time()))
+            if len(batch) == 100:
+                added += self._insert(batch)
+                batch = []
+        added += self._insert(batch)
+        return added
+
+
+    def _insert(self, batch):
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            before = conn.total_changes
+            conn.executemany('INSERT OR IGNORE INTO jobs (infile, run, '
+                             'updated) VALUES (?, ?, ?)', batch)
+            return conn.total_changes - before
+
+
+    def settings(self):
+        """
+        How workers run the runs, as set by submit
+        """
+        with self._connect() as conn:
+            rows = conn.execute('SELECT name, value FROM settings').fetchall()
+        return {name: cPickle.loads(value) for name, value in rows}
+
+
+    def claim(self, worker):
+        """
+        Claim the next pending run, atomically. Runs with an expired lease
+            are queued again first.
+        worker: name of the worker, see worker_name
+        returns (job ID, run), None if no run is pending
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute("UPDATE jobs SET status = 'failed', error = "
+                         "'lease expired ' || attempts || ' times', "
+                         "updated = ? WHERE status = 'running' AND "
+                         "lease_until < ? AND attempts >= ?",
+                         (now, now, self.max_attempts))
+            conn.execute("UPDATE jobs SET status = 'pending', worker = NULL, "
+                         "updated = ? WHERE status = 'running' AND "
+                         "lease_until < ?", (now, now))
+            row = conn.execute("SELECT id, run FROM jobs WHERE status = "
+                               "'pending' ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE jobs SET status = 'running', worker = ?, "
+                         "lease_until = ?, attempts = attempts + 1, "
+                         "updated = ? WHERE id = ?",
+                         (worker, now + self.lease, now, row[0]))
+        return row[0], cPickle.loads(row[1])
+
+
+    def heartbeat(self, job_id, worker):
+        """
+        Extend the lease of a claimed run
+        returns False if the worker no longer holds the run
+        """
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE jobs SET lease_until = ?, "
+                                  "updated = ? WHERE id = ? AND worker = ? "
+                                  "AND status = 'running'",
+                                  (now + self.lease, now, job_id, worker))
+            return cursor.rowcount == 1
+
+
+    def complete(self, job_id, worker, error=None, partial=None):
+        """
+        Record the result of a claimed run, ignored if the worker no longer
+            holds the run
+        error: error message if the run failed
+        partial: campaign sketch of the run
+        returns False if the worker no longer holds the run
+        """
+        status = 'done' if error is None else 'failed'
+        partial = None if partial is None else cPickle.dumps(partial)
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE jobs SET status = ?, error = ?, "
+                                  "partial = ?, lease_until = NULL, "
+                                  "updated = ? WHERE id = ? AND worker = ? "
+                                  "AND status = 'running'",
+                                  (status, error, partial, time.time(),
+                                   job_id, worker))
+            return cursor.rowcount == 1
+
+
+    def counts(self):
+        """
+        Number of runs by status
+        """
+        with self._connect() as conn:
+            rows = conn.execute('SELECT status, COUNT(*) FROM jobs '
+                                'GROUP BY status').fetchall()
+        counts = dict.fromkeys(STATUSES, 0)
+        counts.update(dict(rows))
+        return counts
+
+
+    def failed(self):
+        """
+        Input files and errors of the failed runs
+        """
+        with self._connect() as conn:
+            return conn.execute("SELECT infile, error FROM jobs WHERE "
+                                "status = 'failed' ORDER BY id").fetchall()
+
+
+    def requeue_failed(self):
+        """
+        Queue the failed runs again
+        returns number of runs queued
+        """
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE jobs SET status = 'pending', "
+                                  "worker = NULL, attempts = 0, error = NULL, "
+                                  "updated = ? WHERE status = 'failed'",
+                                  (time.time(),))
+            return cursor.rowcount
+
+
+    def aggregator(self):
+        """
+        Campaign aggregator of all finished runs, merged from the sketches
+            of each run. None if the runs were submitted without one.
+        """
+        total = self.settings().get('aggregator')
+        if total is None:
+            return None
+        with self._connect() as conn:
+            rows = conn.execute("SELECT partial FROM jobs WHERE status = "
+                                "'done' AND partial IS NOT NULL")
+            for (partial,) in rows:
+                total.merge(cPickle.loads(partial))
+        return total
+
+
+    def wait(self, poll=10., progress=None):
+        """
+        Wait until no run is pending or running
+        poll: seconds between checks
+        progress: progress callback, see instrument.Progress
+        returns counts of the runs by status
+        """
+        while True:
+            counts = self.counts()
+            finished = counts['done'] + counts['failed']
+            if progress is not None:
+                progress('runs', finished, sum(counts.values()))
+            if counts['pending'] + counts['running'] == 0:
+                return counts
+            time.sleep(poll)
+
+
+class _Transaction:
+    # closes the connection, and rolls back an open transaction on errors
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, kind, value, traceback):
+        try:
+            if self.conn.in_transaction:
+                self.conn.execute('COMMIT' if kind is None else 'ROLLBACK')
+        finally:
+            self.conn.close()
+
+
+def run_worker(filename, worker=None, poll=5., lease=120., max_jobs=None,
+               exit_when_idle=False):
+    """
+    Claim and run runs from a queue until it is empty or max_jobs runs are
+        done. A heartbeat thread extends the lease of the current run.
+    filename: SQLite database file of the queue
+    worker: name of the worker, defaults to host name and process ID
+    poll: seconds to wait when no run is pending
+    lease: seconds a claimed run is held without a heartbeat
+    max_jobs: number of runs to do before exiting, None for no limit
+    exit_when_idle: exit as soon as no run is pending, otherwise wait while
+        other workers still run runs, since their runs are queued again if
+        a lease expires. Either way the worker exits once no run is pending
+        or running, runs submitted later need a new worker.
+    returns number of runs done
+    """
+    if worker is None:
+        worker = worker_name()
+    jobs = JobQueue(filename, lease=lease)
+    settings = jobs.settings()
+    task = PPMtools.run_and_read
+    if settings.get('screening'):
+        task = functools.partial(PPMtools.toolkit_run_and_read, 
+                                 screening=True)
+    elif settings.get('toolkit'):
+        task = PPMtools.toolkit_run_and_read
+    store = settings.get('store')
+    cache = settings.get('cache')
+    keep_summaries = settings.get('keep_summaries', True)
+    empty = settings.get('aggregator')
+
+    num_done = 0
+    try:
+        while max_jobs is None or num_done < max_jobs:
+            claimed = jobs.claim(worker)
+            if claimed is None:
+                counts = jobs.counts()
+                if exit_when_idle or counts['pending'] + counts['running'] == 0:
+                    break
+                time.sleep(poll)
+                continue
+            job_id, run = claimed
+            infile = run[2] + run[3]
+
+            stop = threading.Event()
+            def beat():
+                while not stop.wait(lease / 3.):
+                    if not jobs.heartbeat(job_id, worker):
+                        print('Lost the lease of ' + infile)
+                        return
+            heart = threading.Thread(target=beat, daemon=True)
+            heart.start()
+            try:
+                sketch = None if empty is None else empty.empty()
+                if cache is not None and PPMtools.use_cached_summary(
+                        run, cache, store, sketch, keep_summaries,
+                        settings.get('screening', False)):
+                    error, partial = None, sketch
+                else:
+                    infile, error, partial = task(run, store=store,
+                                                  aggregator=sketch,
+                                                  keep_summary=keep_summaries,
+                                                  cache=cache)
+            except Exception as e:
+                error, partial = repr(e), None
+            finally:
+                stop.set()
+                heart.join()
+            if error is not None:
+                print('Error running ' + infile + ': ' + error)
+            jobs.complete(job_id, worker, error, partial)
+            num_done += 1
+    finally:
+        # EPANET removes its scratch file when the engine is closed
+        PPMtools.close_engines()
+    return num_done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='PPMtools work queue')
+    commands = parser.add_subparsers(dest='command', required=True)
+    work = commands.add_parser('worker', help='run runs from a queue')
+    work.add_argument('queue', help='SQLite database file of the queue')
+    work.add_argument('--name', help='worker name, default host:pid')
+    work.add_argument('--poll', type=float, default=5.,
+                      help='seconds to wait when no run is pending')
+    work.add_argument('--lease', type=float, default=120.,
+                      help='seconds a run is held without a heartbeat')
+    work.add_argument('--max-jobs', type=int, help='runs to do, then exit')
+    work.add_argument('--exit-when-idle', action='store_true',
+                      help='exit as soon as no run is pending')
+    status = commands.add_parser('status', help='count runs by status')
+    status.add_argument('queue', help='SQLite database file of the queue')
+    args = parser.parse_args(argv)
+
+    if args.command == 'worker':
+        num_done = run_worker(args.queue, args.name, args.poll, args.lease,
+                              args.max_jobs, args.exit_when_idle)
+        print('Worker done: ' + str(num_done) + ' runs')
+    else:
+        jobs = JobQueue(args.queue)
+        print(jobs.counts())
+        for infile, error in jobs.failed():
+            print('Failed ' + infile + ': ' + str(error))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
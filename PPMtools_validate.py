@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+PPMtools plug flow validation.
+
+Compares the water age of the plug flow screening engine (plugflow_engine)
+to EPANET (toolkit_engine) on the houses in INP_Files. The same trials are
+run by both engines, with the time steps of PPMtools_benchmark.load_network
+and water age as the quality parameter. The age at the fixture nodes is
+compared at every report time, and the mean age of every event is compared
+from the summaries of generate_summary. Results and timings are written as
+JSON.
+
+Usage:
+    python PPMtools_validate.py [--houses House1 House2] [--residents 2]
+                                [--days 2] [--trials 2]
+                                [--output validation_results.json]
+
+
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import wntr
+
+import PPMtools
+import toolkit_engine
+import plugflow_engine
+from PPMtools_benchmark import HOUSES, load_network, make_household
+from PPMtools_units import *
+
+
+def event_errors(summary_epanet, summary_screen, column):
+    """
+    Absolute error of the mean age of each event (hours), events without
+        flow of the column are skipped
+    """
+    epanet = summary_epanet[column].astype(float).values
+    screen = summary_screen[column].astype(float).values
+    both = np.isfinite(epanet) & np.isfinite(screen)
+    return np.abs(epanet[both] - screen[both]) / sec_per_hr
+
+
+def error_stats(errors):
+    """
+    Maximum, mean, and 99th percentile of errors, None if there are none
+    """
+    if len(errors) == 0:
+        return {'max': None, 'mean': None, 'p99': None}
+    return {'max': float(np.max(errors)), 'mean': float(np.mean(errors)),
+            'p99': float(np.percentile(errors, 99))}
+
+
+def validate_trial(wn, inpfile, home, days_in_week, rng):
+    """
+    Run a single trial with EPANET and the plug flow engine and compare them
+    wn: water network model of the house, modeling water age
+    inpfile: EPANET input file of wn
+    home, days_in_week: household and days of the trial, see
+        PPMtools_benchmark.make_household
+    rng: random.Random of the trial
+    returns dictionary of errors (hours) and timings (seconds)
+    """
+    patterns, table = PPMtools.generate_trial(wn, home, days_in_week, rng)
+    nodes = PPMtools.fixture_nodes(table, wn.node_name_list)
+
+    start = time.perf_counter()
+    epanet = toolkit_engine.ToolkitEngine(inpfile, nodes)
+    conc_epanet = epanet.quality_frame(patterns)
+    epanet.close()
+    epanet_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    screen = plugflow_engine.PlugFlowEngine(wn, nodes)
+    conc_screen = screen.quality_frame(patterns)
+    screen_seconds = time.perf_counter() - start
+
+    age_errors = np.abs(conc_epanet.values - conc_screen.values) / sec_per_hr
+    summary_epanet = PPMtools.generate_summary(table, conc_epanet, tss)
+    summary_screen = PPMtools.generate_summary(table, conc_screen, tss)
+    return {'events': len(table),
+            'nodes': len(nodes),
+            'age': error_stats(age_errors.ravel()),
+            'hot_mean': error_stats(event_errors(summary_epanet,
+                                                 summary_screen, 'hotMean')),
+            'cold_mean': error_stats(event_errors(summary_epanet,
+                                                  summary_screen,
+                                                  'coldMean')),
+            'epanet_seconds': epanet_seconds,
+            'screen_seconds': screen_seconds,
+            'speedup': epanet_seconds / screen_seconds}
+
+
+def validate_house(name, inpfile, num_people, days, num_trials, folder,
+                   seed=0):
+    """
+    Compare the engines on trials of a single house
+    returns list of result dictionaries, one per trial
+    """
+    wn = load_network(inpfile, days)
+    wn.options.quality.parameter = 'AGE'
+    house_inp = os.path.join(folder, name + '.inp')
+    wntr.network.io.write_inpfile(wn, house_inp, units='GPM')
+    home, days_in_week = make_household(wn, num_people, days)
+    results = []
+    for trial in range(num_trials):
+        result = {'house': name, 'residents': num_people, 'days': days,
+                  'trial': trial}
+        result.update(validate_trial(wn, house_inp, home, days_in_week,
+                                     PPMtools.trial_rng(seed, num_people,
+                                                        trial)))
+        results.append(result)
+        print('{:8s} trial {:d}: age error max {:.3f} h mean {:.4f} h, '
+              'event mean error hot {:.4f} h cold {:.4f} h, '
+              '{:.1f}x faster'.format(name, trial, result['age']['max'],
+                                      result['age']['mean'],
+                                      result['hot_mean']['mean'] or 0.,
+                                      result['cold_mean']['mean'] or 0.,
+                                      result['speedup']))
+    return results
+
+
+def run_validation(houses=None, num_people=2, days=2, num_trials=2, seed=0):
+    """
+    Compare the engines on the houses in INP_Files
+    returns dictionary of settings and results
+    """
+    if houses is None:
+        houses = list(HOUSES)
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for name in houses:
+            results.extend(validate_house(name, HOUSES[name], num_people,
+                                          days, num_trials, folder, seed))
+    settings = {'residents': num_people, 'days': days, 'trials': num_trials,
+                'seed': seed,
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'wntr': wntr.__version__}
+    return {'settings': settings, 'results': results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Plug flow engine '
+                                     'validation against EPANET')
+    parser.add_argument('--houses', nargs='*', choices=list(HOUSES),
+                        help='houses to validate, default all')
+    parser.add_argument('--residents', type=int, default=2,
+                        help='number of residents')
+    parser.add_argument('--days', type=int, default=2,
+                        help='number of simulated days')
+    parser.add_argument('--trials', type=int, default=2,
+                        help='number of trials per house')
+    parser.add_argument('--output', default='validation_results.json',
+                        help='JSON file of results')
+    args = parser.parse_args(argv)
+
+    results = run_validation(args.houses, args.residents, args.days,
+                             args.trials)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('Results written to ' + args.output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
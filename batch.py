@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+PPMtools batch trial generator.
+
+Generates many Monte Carlo household trials in one pass. The start times and
+fixture choices of every trial are drawn together as arrays, fixture
+conflicts are resolved for all trials at once with the same rule as
+Fixture.available_times, and the patterns of all trials are returned as a
+single (trials x patterns x steps) array.
+
+The trials follow the same rules as the serial simulation of
+PPMtools.monte_carlo_setup, but are drawn from one NumPy stream rather than
+the per-trial streams of PPMtools.trial_rng. The same seed therefore gives
+different trials than monte_carlo_setup: the two agree in distribution, not
+draw for draw. monte_carlo_setup does not use this generator.
+
+
+"""
+
+import numpy as np
+
+import house
+import person
+import events
+from PPMtools_units import *
+
+
+def generate_trials(wn, fixture_info, routines, num_trials, seed=None,
+                    dtype=np.float64, out=None, chunk_size=32):
+    '''
+    Generate the water usage of many household trials at once
+    wn: water network model, sets the pattern names and length
+    fixture_info: list of fixtures containing fixture type, name, and max rate
+    routines: dictionary of {resident name: week routine}, as built by
+              PPMtools.week_routine_person or PPMtools.week_routine_home
+    num_trials: number of trials to generate
+    seed: seed for the NumPy random generator, the trials differ from those
+          of PPMtools.monte_carlo_setup with the same seed
+    dtype: data type of the pattern array
+    out: optional zero filled, preallocated (or memory mapped) array for the
+         patterns
+    chunk_size: number of trials rasterized together, bounds scratch memory
+
+    Returns the (trials x patterns x steps) pattern array, the list of
+    pattern names for its rows, and the EventTable of each trial.
+    '''
+    rng = np.random.default_rng(seed)
+    home = house.Household('batch', fixture_info)
+    table = home.event_table
+    for name in routines.keys():
+        table.code('person', name)
+
+    slots = build_slots(routines)
+    occupancy = {}
+    slot_events = []
+    for day_of_week, name, action, sched, duration in slots:
+        if action not in person.ACTIONS:
+            continue
+        group = getattr(home, person.ACTIONS[action][0])
+        if not group:
+            raise ValueError(name + ' wants to ' + action + ', but there '
+                             'are no ' + person.ACTIONS[action][0] + 
+                             ' in the household')
+        starts = draw_starts(rng, person.valid_starts(sched, duration), num_trials)
+        starts += day_of_week * steps_per_day
+        choice = rng.integers(len(group), size=num_trials)
+        for fix_idx, fix in enumerate(group):
+            trials = np.flatnonzero(choice == fix_idx)
+            if len(trials) == 0:
+                continue
+            template = action_template(home, action, fix, name, duration)
+            if fix.name not in occupancy:
+                occupancy[fix.name] = Occupancy(num_trials)
+            fix_starts = occupancy[fix.name].place(trials, starts[trials],
+                                                   duration,
+                                                   template['start'].min(),
+                                                   template['end'].max())
+            slot_events.append((trials, fix_starts, template))
+
+    data, bounds = collect_events(slot_events, num_trials)
+    tables = split_events(table, data, bounds)
+    pattern_names, rows = pattern_rows(wn, home)
+    TOT_LENGTH = int(wn.options.time.duration / wn.options.time.pattern_timestep)
+    if out is None:
+        out = np.zeros((num_trials, len(pattern_names), TOT_LENGTH), dtype=dtype)
+    fix_rows = {}
+    for suffix in ('C', 'H'):
+        fix_rows[suffix] = np.array([rows.get(x + suffix, -1) 
+                                     for x in table.fixture_names])
+    source_row = rows[home.source[0].name + 'C']
+    source_code = table.code('fixture', home.source[0].name)
+    for first in range(0, num_trials, chunk_size):
+        last = min(first + chunk_size, num_trials)
+        chunk = data[bounds[first]:bounds[last]]
+        trial = np.repeat(np.arange(last - first), np.diff(bounds[first:last + 1]))
+        chunk_rows = rasterize(chunk, trial, fix_rows, source_code, 
+                               table.fixture_names, TOT_LENGTH)
+        fill, fill_rates, source, source_rates = chunk_rows
+        patt = out[first:last]
+        patt.reshape(-1)[fill] = fill_rates
+        patt[:, source_row] = np.bincount(source, weights=source_rates, 
+                                          minlength=(last - first) * TOT_LENGTH
+                                          ).reshape(last - first, TOT_LENGTH)
+
+    return out, pattern_names, tables
+
+
+def build_slots(routines):
+    '''
+    List every routine task occurrence in the order Household.simulate_usage
+    performs them: by day, then resident, then task.
+    routines: dictionary of {resident name: week routine}
+    '''
+    slots = []
+    num_days = max(len(x) for x in routines.values())
+    for day_of_week in range(num_days):
+        for name, routine in routines.items():
+            if day_of_week >= len(routine):
+                continue
+            for task in routine[day_of_week]:
+                for n in range(task[2]):
+                    slots.append((day_of_week, name, task[0], task[1], task[3]))
+    return slots
+
+
+def draw_starts(rng, starts, size):
+    '''
+    Draw start times uniformly from a list of disjoint ranges
+    starts: list of ranges, as returned by person.valid_starts
+    '''
+    lengths = np.array([len(x) for x in starts])
+    first = np.array([x.start for x in starts])
+    offsets = np.cumsum(lengths) - lengths
+    pick = rng.integers(lengths.sum(), size=size)
+    which = np.searchsorted(offsets, pick, side='right') - 1
+    return first[which] + (pick - offsets[which])
+
+
+def action_template(home, action, fix, name, duration):
+    '''
+    Events of one action on one fixture, with times relative to its start.
+    Uses person.run_action, like Resident, so notes, rates and cycles match 
+    the serial simulation.
+    '''
+    table = home.event_table
+    fix.reset_schedule()
+    person.run_action(action, fix, name, [0, duration - 1])
+    template = table.rows().copy()
+    fix.reset_schedule()
+    return template
+
+
+class Occupancy:
+    """
+    Busy windows of one fixture for every trial, padded to a common width
+    """
+    def __init__(self, num_trials, capacity=8):
+        self.starts = np.full((num_trials, capacity), np.iinfo(np.int64).max)
+        self.ends = np.full((num_trials, capacity), -1, dtype=np.int64)
+        self.count = np.zeros(num_trials, dtype=np.int64)
+
+
+    def place(self, trials, starts, duration, busy_first, busy_last):
+        """
+        Move each proposed start to the earliest start at or after it whose
+            window does not overlap a busy window of its trial, then mark the
+            events as busy. Jumping past the latest conflicting window never
+            skips a free start, so the result matches Fixture.available_times.
+        trials: trial indices using the fixture
+        starts: proposed start times for those trials
+        duration: length of the window in timesteps
+        busy_first/busy_last: busy window of the events relative to the start
+        """
+        width = self.count[trials].max()
+        busy_starts = self.starts[trials, :width]
+        busy_ends = self.ends[trials, :width]
+        todo = np.arange(len(trials))
+        while len(todo) > 0 and width > 0:
+            conflict = (starts[todo, None] <= busy_ends[todo]) & \
+                       (starts[todo, None] + duration - 1 >= busy_starts[todo])
+            hit = conflict.any(axis=1)
+            todo = todo[hit]
+            starts[todo] = np.where(conflict[hit], busy_ends[todo], -1).max(axis=1) + 1
+
+        if self.count[trials].max() == self.starts.shape[1]:
+            pad = self.starts.shape[1]
+            self.starts = np.pad(self.starts, ((0, 0), (0, pad)),
+                                 constant_values=np.iinfo(np.int64).max)
+            self.ends = np.pad(self.ends, ((0, 0), (0, pad)), constant_values=-1)
+        self.starts[trials, self.count[trials]] = starts + busy_first
+        self.ends[trials, self.count[trials]] = starts + busy_last
+        self.count[trials] += 1
+        return starts
+
+
+def collect_events(slot_events, num_trials):
+    '''
+    Gather the placed events of every slot into one array, with the rows of
+    each trial grouped by fixture in the order of use, like 
+    Household.build_event_list. Returns the rows and the row bounds of 
+    each trial.
+    '''
+    parts = []
+    for trials, starts, template in slot_events:
+        for row in template:
+            part = np.empty(len(trials), dtype=template.dtype)
+            part[:] = row
+            part['start'] += starts
+            part['end'] += starts
+            parts.append((trials, part))
+    if not parts:
+        return np.zeros(0, dtype=events.EVENT_DTYPE), np.zeros(num_trials + 1, dtype=int)
+    trial_idx = np.concatenate([x[0] for x in parts])
+    data = np.concatenate([x[1] for x in parts])
+    order = np.lexsort((data['fixture'], trial_idx))
+    bounds = np.searchsorted(trial_idx[order], np.arange(num_trials + 1))
+    return data[order], bounds
+
+
+def split_events(table, data, bounds):
+    '''
+    Build the EventTable of each trial, sharing the codes of table
+    '''
+    table.clear()
+    tables = []
+    for trial in range(len(bounds) - 1):
+        rows = data[bounds[trial]:bounds[trial + 1]]
+        trial_table = table.copy()
+        trial_table.extend(rows['fixture'], rows['person'], rows['note'],
+                           rows['start'], rows['end'],
+                           rows['cold_rate'], rows['hot_rate'])
+        tables.append(trial_table)
+    return tables
+
+
+def pattern_rows(wn, home):
+    '''
+    Pattern names in the order used by PPMtools.build_pattern_dict, and the
+    row of each fixture node label
+    '''
+    patterns = wn.pattern_name_list
+    for fix in home.fixtures:
+        for node_name in fix.node_labels:
+            if not node_name + 'P' in patterns:
+                patterns.append(node_name + 'P')
+    rows = {name[:-1]: row for row, name in enumerate(patterns)}
+    return patterns, rows
+
+
+def rasterize(data, trial, fix_rows, source_code, fixture_names, TOT_LENGTH):
+    '''
+    Flat indices and rates of the nonzero pattern steps of a chunk of trials.
+    Placed events of one fixture only touch within a cycle, where the later
+    event keeps the shared steps as in PPMtools.build_pattern_dict. The
+    source steps are listed in the order build_pattern_dict adds them, so
+    summing them with np.bincount gives the same SourceCP.
+    data: event rows of the chunk, grouped by trial and fixture
+    trial: trial of each row, counted from the start of the chunk
+    fix_rows: {'C': array, 'H': array} pattern row of each fixture code
+    source_code: fixture code of the source
+    fixture_names: fixture name of each code
+    TOT_LENGTH: number of pattern steps
+    '''
+    data = data[data['fixture'] != source_code]
+    trial = trial[data['fixture'] != source_code] if len(trial) else trial
+    num_patt = max(fix_rows['C'].max(), fix_rows['H'].max()) + 1
+    # one cold and one hot line per event, in the order they are added
+    rates = np.stack([data['cold_rate'], data['hot_rate']], axis=1).ravel()
+    rows = np.stack([fix_rows['C'][data['fixture']], 
+                     fix_rows['H'][data['fixture']]], axis=1).ravel()
+    codes = np.repeat(data['fixture'], 2)
+    trial = np.repeat(trial, 2)
+    start = np.repeat(data['start'].astype(np.int64), 2)
+    end = np.repeat(data['end'].astype(np.int64) + 1, 2)    # inclusive times
+    use = rates != 0
+    rates, rows, codes, trial, start, end = (x[use] for x in 
+                                             (rates, rows, codes, trial, start, end))
+    if (rows < 0).any():
+        code = codes[rows < 0][0]
+        suffix = 'C' if fix_rows['C'][code] < 0 else 'H'
+        raise KeyError(fixture_names[code] + suffix + 'P')
+    end = np.minimum(end, TOT_LENGTH)
+    
+    source, source_rates = expand(trial * TOT_LENGTH, start, end, rates)
+    
+    # later events keep the steps shared with the event before them
+    key = trial * num_patt + rows
+    order = np.argsort(key, kind='stable')
+    same = (key[order][1:] == key[order][:-1]) & \
+           (start[order][1:] >= start[order][:-1])
+    clipped = end[order]
+    clipped[:-1][same] = np.minimum(clipped[:-1][same], start[order][1:][same])
+    end = np.empty_like(end)
+    end[order] = clipped
+    fill, fill_rates = expand(key * TOT_LENGTH, start, end, rates)
+    return fill, fill_rates, source, source_rates
+
+
+def expand(base, start, end, rates):
+    '''
+    Flat step indices base + [start, end) of each interval and their rates
+    '''
+    lengths = np.maximum(end - start, 0)
+    total = lengths.sum()
+    offsets = np.repeat(base + start - (np.cumsum(lengths) - lengths), lengths)
+    return offsets + np.arange(total), np.repeat(rates, lengths)
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+PPMtools campaign statistics classes and associated functions.
+
+Aggregates the summaries of a Monte Carlo campaign as they are produced,
+instead of reloading and concatenating every run summary. Event values are
+added to mergeable quantile sketches, one per (scenario, fixture, use type,
+user) and summary column. Sketches have a fixed relative accuracy and a size
+that grows only with the range of the values, so partial results of workers
+merge exactly and campaign percentiles need bounded memory.
+
+
+"""
+
+import _pickle as cPickle
+
+import numpy as np
+import pandas as pd
+
+KEY_NAMES = ['scenario', 'fixture', 'use', 'user']
+METRICS = ['hotMean', 'coldMean', 'hotMass', 'coldMass']
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with log-spaced buckets. Quantiles are within
+    the relative accuracy of the true values, values at or below min_value
+    are counted as zero.
+    """
+    def __init__(self, relative_accuracy=0.01, min_value=1e-12):
+        """
+        Initialize an empty sketch
+        relative_accuracy: relative error of the quantiles
+        min_value: smallest value kept apart from zero
+        """
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1. + relative_accuracy) / (1. - relative_accuracy)
+        self._log_gamma = np.log(self.gamma)
+        self.offset = 0                 # bucket index of counts[0]
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.
+        self.min = np.inf
+        self.max = -np.inf
+
+
+    def __getstate__(self):
+        # only pickle the buckets in use, partials of a run are mostly empty
+        state = self.__dict__.copy()
+        used = np.flatnonzero(self.counts)
+        state['counts'] = (used, self.counts[used])
+        return state
+
+
+    def __setstate__(self, state):
+        used, counts = state['counts']
+        state['counts'] = np.zeros(used[-1] + 1 if len(used) else 0,
+                                   dtype=np.int64)
+        state['counts'][used] = counts
+        self.__dict__.update(state)
+
+
+    def _grow(self, low, high):
+        # extend the bucket range to cover indices low..high
+        if len(self.counts) == 0:
+            self.offset = low
+            self.counts = np.zeros(high - low + 1, dtype=np.int64)
+            return
+        new_low = min(low, self.offset)
+        new_high = max(high, self.offset + len(self.counts) - 1)
+        if new_low == self.offset and new_high - new_low + 1 == len(self.counts):
+            return
+        counts = np.zeros(new_high - new_low + 1, dtype=np.int64)
+        start = self.offset - new_low
+        counts[start:start + len(self.counts)] = self.counts
+        self.offset = new_low
+        self.counts = counts
+
+
+    def add(self, values):
+        """
+        Add values to the sketch, NaN values are ignored
+        values: array of values
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.sum += values.sum()
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        positive = values[values > self.min_value]
+        self.zero_count += len(values) - len(positive)
+        if len(positive) == 0:
+            return
+        index = np.ceil(np.log(positive) / self._log_gamma).astype(np.int64)
+        low, high = index.min(), index.max()
+        self._grow(low, high)
+        self.counts += np.bincount(index - self.offset,
+                                   minlength=len(self.counts))
+
+
+    def merge(self, other):
+        """
+        Add the values of another sketch with the same accuracy, in place
+        other: QuantileSketch
+        """
+        if other.gamma != self.gamma:
+            raise ValueError('Sketches with different accuracy cannot merge')
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.zero_count += other.zero_count
+        if len(other.counts) == 0:
+            return self
+        self._grow(other.offset, other.offset + len(other.counts) - 1)
+        start = other.offset - self.offset
+        self.counts[start:start + len(other.counts)] += other.counts
+        return self
+
+
+    @property
+    def mean(self):
+        """
+        Exact mean of the values added
+        """
+        if self.count == 0:
+            return np.nan
+        return self.sum / self.count
+
+
+    def quantile(self, q):
+        """
+        Estimate quantiles of the values added
+        q: quantile or array of quantiles, between 0 and 1
+        returns float or array of floats, NaN if the sketch is empty
+        """
+        q = np.asarray(q, dtype=float)
+        if self.count == 0:
+            return np.full(q.shape, np.nan)[()]
+        rank = q * (self.count - 1)
+        cum = self.zero_count + np.cumsum(self.counts)
+        bucket = np.searchsorted(cum, rank, side='right')
+        bucket = np.minimum(bucket, len(self.counts) - 1)
+        values = 2. * self.gamma ** (bucket + self.offset) / (self.gamma + 1.)
+        values = np.where(rank < self.zero_count, 0., values)
+        return np.clip(values, self.min, self.max)[()]
+
+
+class CampaignAggregator:
+    """
+    Quantile sketches of the events of a campaign, by scenario, fixture, use
+    type, user, and summary column
+    """
+    def __init__(self, metrics=METRICS, relative_accuracy=0.01):
+        """
+        Initialize an empty aggregator
+        metrics: summary columns to sketch, e.g. 'hotMean' (water age in
+            seconds for age runs) or 'hotMass'
+        relative_accuracy: relative error of the quantiles
+        """
+        self.metrics = list(metrics)
+        self.relative_accuracy = relative_accuracy
+        self.sketches = {}
+        self.runs = 0
+
+
+    def empty(self):
+        """
+        New empty aggregator with the same settings, for worker partials
+        """
+        return CampaignAggregator(self.metrics, self.relative_accuracy)
+
+
+    def sketch(self, key, metric):
+        """
+        Sketch of a key and metric, created if new
+        key: (scenario, fixture, use type, user)
+        metric: summary column
+        """
+        if (key, metric) not in self.sketches:
+            self.sketches[(key, metric)] = QuantileSketch(self.relative_accuracy)
+        return self.sketches[(key, metric)]
+
+
+    def update(self, summary_pd, scenario=None):
+        """
+        Add the events of a run summary
+        summary_pd: dataframe of summary results, see generate_summary
+        scenario: scenario of the run, see monte_carlo_setup
+        """
+        info = list(summary_pd['patternInfo'])
+        use = pd.Series([k[5] for k in info], dtype=object)
+        use[use.str.contains('Sample|sample', regex=True)] = 'Sample'
+        groups = pd.Series(list(zip([k[1] for k in info], use,
+                                    [k[2] for k in info])))
+        codes, uniques = pd.factorize(groups)
+        for metric in self.metrics:
+            if metric not in summary_pd.columns:
+                continue
+            values = summary_pd[metric].to_numpy(dtype=float)
+            for idx, (fixture, use_type, user) in enumerate(uniques):
+                key = (scenario, fixture, use_type, user)
+                self.sketch(key, metric).add(values[codes == idx])
+        self.runs += 1
+
+
+    def merge(self, other):
+        """
+        Add the sketches of another aggregator, in place
+        other: CampaignAggregator
+        """
+        for (key, metric), sketch in other.sketches.items():
+            self.sketch(key, metric).merge(sketch)
+        self.runs += other.runs
+        return self
+
+
+    def quantiles(self, q=(0.05, 0.25, 0.5, 0.75, 0.95), by=KEY_NAMES,
+                  metrics=None):
+        """
+        Campaign quantiles, sketches of keys that only differ in the fields
+            not listed in by are merged
+        q: quantiles to estimate
+        by: key fields to group by, from 'scenario', 'fixture', 'use', 'user'
+        metrics: summary columns to report, None for all
+        returns dataframe, one row per group and metric
+        """
+        if metrics is None:
+            metrics = self.metrics
+        fields = [KEY_NAMES.index(name) for name in by]
+        merged = {}
+        for (key, metric), sketch in self.sketches.items():
+            if metric not in metrics:
+                continue
+            group = tuple(key[i] for i in fields) + (metric,)
+            if group not in merged:
+                merged[group] = QuantileSketch(self.relative_accuracy)
+            merged[group].merge(sketch)
+        rows = []
+        for group, sketch in merged.items():
+            rows.append(list(group) + [sketch.count, sketch.mean] +
+                        list(np.atleast_1d(sketch.quantile(q))))
+        columns = list(by) + ['metric', 'count', 'mean'] + \
+                  ['q' + repr(x) for x in q]
+        return pd.DataFrame(rows, columns=columns)
+
+
+    def save(self, filename):
+        """
+        Pickle the aggregator, e.g. the partial result of a worker
+        """
+        with open(filename, 'wb') as f:
+            cPickle.dump(self, f)
+
+
+def load_aggregator(filename):
+    """
+    Load a pickled CampaignAggregator
+    """
+    with open(filename, 'rb') as f:
+        return cPickle.load(f)
+
+
+def merge_aggregators(aggregators):
+    """
+    Merge aggregators (or pickled aggregator files) into a new aggregator
+    aggregators: list of CampaignAggregator objects or file names
+    """
+    total = None
+    for agg in aggregators:
+        if isinstance(agg, str):
+            agg = load_aggregator(agg)
+        if total is None:
+            total = agg.empty()
+        total.merge(agg)
+    return total
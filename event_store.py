@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+PPMtools event store class and associated functions.
+
+Keeps the event tables of every trial of a campaign in a single indexed
+SQLite file. Each trial is stored under its own key as the raw rows of its
+EventTable, with the fixture, person, and note names shared between trials,
+so reading one trial never deserializes the others. Readers keep a small LRU
+cache of recently used trials, and the file can be read by workers while
+monte_carlo_setup is still adding flow types to it. The events of a key are
+written once per campaign, so cached trials stay valid while other keys are
+added, until the file is replaced.
+
+
+"""
+
+import os
+import json
+import sqlite3
+from collections import OrderedDict
+
+import numpy as np
+
+import events
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS names (
+    id      INTEGER PRIMARY KEY,
+    names   TEXT UNIQUE);
+CREATE TABLE IF NOT EXISTS trials (
+    key     TEXT PRIMARY KEY,
+    names   INTEGER,
+    size    INTEGER,
+    rows    BLOB);
+'''
+
+
+def event_key(flow_type, trial_ID):
+    """
+    Key of the events of a trial, trials of each flow type have their own
+        scaled events
+    """
+    return flow_type.replace(' ', '_') + '/' + trial_ID
+
+
+class EventStore:
+    """
+    Event tables of the trials of a campaign, by key
+    """
+    def __init__(self, filename, cache_size=64, timeout=60.):
+        """
+        Open the store, the file is created if needed
+        filename: SQLite file of the store
+        cache_size: number of trials kept in memory after they are read
+        timeout: seconds to wait for the database lock
+        """
+        self.filename = filename
+        self.cache_size = cache_size
+        self.timeout = timeout
+        self._cache = OrderedDict()     # LRU of {key: EventTable}
+        self._names = {}                # {names id: name lists}
+        self._stamp = None              # file the cache belongs to
+        conn = self._connect()
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+
+    def _connect(self):
+        return sqlite3.connect(self.filename, timeout=self.timeout)
+
+
+    def put(self, tables):
+        """
+        Add or replace the event tables of trials, in one transaction
+        tables: dictionary of {key: EventTable}, see event_key
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                names_ids = {}
+                for key, table in tables.items():
+                    names = json.dumps([table.fixture_names,
+                                        table.person_names, table.notes])
+                    if names not in names_ids:
+                        conn.execute('INSERT OR IGNORE INTO names (names) '
+                                     'VALUES (?)', (names,))
+                        names_ids[names] = conn.execute(
+                            'SELECT id FROM names WHERE names = ?',
+                            (names,)).fetchone()[0]
+                    rows = table.rows()
+                    conn.execute('INSERT OR REPLACE INTO trials VALUES '
+                                 '(?, ?, ?, ?)',
+                                 (key, names_ids[names], len(table),
+                                  rows.tobytes()))
+        finally:
+            conn.close()
+        for key in tables:
+            self._cache.pop(key, None)
+
+
+    def _check_cache(self):
+        # the cache is dropped when the file is replaced, e.g. a new campaign
+        # in the same folder. Adding keys keeps it, stored keys do not change.
+        stat = os.stat(self.filename)
+        stamp = (stat.st_dev, stat.st_ino)
+        if stamp != self._stamp:
+            self._cache.clear()
+            self._names.clear()
+            self._stamp = stamp
+
+
+    def get(self, key):
+        """
+        Event table of a trial, read from the cache if it was used recently.
+            The table is a copy, changing it does not change the store.
+        key: key of the trial, see event_key
+        """
+        self._check_cache()
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key].copy()
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT names, size, rows FROM trials '
+                               'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            names_id, size, rows = row
+            if names_id not in self._names:
+                self._names[names_id] = json.loads(conn.execute(
+                    'SELECT names FROM names WHERE id = ?',
+                    (names_id,)).fetchone()[0])
+        finally:
+            conn.close()
+        fixture_names, person_names, notes = self._names[names_id]
+        table = events.EventTable.from_rows(
+            np.frombuffer(rows, dtype=events.EVENT_DTYPE, count=size),
+            fixture_names, person_names, notes)
+        self._cache[key] = table
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return table.copy()
+
+
+    def __contains__(self, key):
+        conn = self._connect()
+        try:
+            return conn.execute('SELECT 1 FROM trials WHERE key = ?',
+                                (key,)).fetchone() is not None
+        finally:
+            conn.close()
+
+
+    def keys(self):
+        """
+        Keys of all stored trials
+        """
+        conn = self._connect()
+        try:
+            return [x[0] for x in conn.execute('SELECT key FROM trials '
+                                               'ORDER BY key')]
+        finally:
+            conn.close()
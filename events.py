@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+PPMtools event table and associated functions.
+
+Stores the water usage events of a household in columns, with integer codes
+for the fixture, person, and note of each event. Fixtures write their events
+into the table, and the pattern builder and summary functions read from it.
+
+
+"""
+
+import numpy as np
+
+EVENT_DTYPE = np.dtype([('fixture',   np.int16),
+                        ('person',    np.int16),
+                        ('note',      np.int16),
+                        ('start',     np.int32),
+                        ('end',       np.int32),
+                        ('cold_rate', np.float64),
+                        ('hot_rate',  np.float64)])
+
+
+class EventTable:
+    """
+    Columnar store of water usage events
+    fixture/person/note: integer codes into fixture_names/person_names/notes
+    start/end: first and last timestep of the event (inclusive)
+    cold_rate/hot_rate: flow rates for cold and hot water lines
+    """
+    def __init__(self, capacity=64):
+        """
+        Initialize an empty event table
+        capacity: number of rows to allocate before growing
+        """
+        self.fixture_names = []
+        self.person_names = []
+        self.notes = []
+        self._codes = {'fixture': {}, 'person': {}, 'note': {}}
+        self._data = np.zeros(capacity, dtype=EVENT_DTYPE)
+        self.size = 0
+
+
+    def __len__(self):
+        return self.size
+
+
+    def __getitem__(self, column):
+        """
+        Return a column of the table as an array view, e.g. table['start']
+        """
+        return self._data[column][:self.size]
+
+
+    def rows(self):
+        """
+        Return the events in use as an array of EVENT_DTYPE, a view into the
+            table
+        """
+        return self._data[:self.size]
+
+
+    def __getstate__(self):
+        # only pickle the rows in use, codes are rebuilt from the name lists
+        state = self.__dict__.copy()
+        state['_data'] = self._data[:self.size].copy()
+        del state['_codes']
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._codes = {kind: {name: code for code, name in enumerate(self.names(kind))}
+                       for kind in ('fixture', 'person', 'note')}
+
+
+    def code(self, kind, name):
+        """
+        Return the integer code of a fixture, person or note, adding it if new
+        kind: 'fixture', 'person' or 'note'
+        name: the name to look up
+        """
+        codes = self._codes[kind]
+        if name not in codes:
+            codes[name] = len(codes)
+            self.names(kind).append(name)
+        return codes[name]
+
+
+    def names(self, kind):
+        """
+        Return the list of names for the codes of 'fixture', 'person' or 'note'
+        """
+        if kind == 'fixture':
+            return self.fixture_names
+        elif kind == 'person':
+            return self.person_names
+        return self.notes
+
+
+    def append(self, note, fixture, person, times, cold_rate, hot_rate):
+        """
+        Add a water usage event to the table
+        note: a note saying what happened, e.g., 'brushed teeth'
+        fixture: name of the fixture for the water usage
+        person: name of the individual using the fixture
+        times: [start, end] timesteps of the event (inclusive)
+        cold_rate/hot_rate: flow rates for cold and hot water lines
+        """
+        if self.size == len(self._data):
+            self._grow(2 * len(self._data) + 1)
+        row = self._data[self.size]
+        row['fixture'] = self.code('fixture', fixture)
+        row['person'] = self.code('person', person)
+        row['note'] = self.code('note', note)
+        row['start'] = times[0]
+        row['end'] = times[1]
+        row['cold_rate'] = cold_rate
+        row['hot_rate'] = hot_rate
+        self.size += 1
+
+
+    def extend(self, fixture, person, note, start, end, cold_rate, hot_rate):
+        """
+        Add many events at once from arrays of equal length
+        fixture/person/note: arrays of codes, already registered with code()
+        start/end: arrays of first and last timesteps (inclusive)
+        cold_rate/hot_rate: arrays of flow rates for cold and hot water lines
+        """
+        count = len(start)
+        if self.size + count > len(self._data):
+            self._grow(max(2 * len(self._data), self.size + count))
+        rows = self._data[self.size:self.size + count]
+        rows['fixture'] = fixture
+        rows['person'] = person
+        rows['note'] = note
+        rows['start'] = start
+        rows['end'] = end
+        rows['cold_rate'] = cold_rate
+        rows['hot_rate'] = hot_rate
+        self.size += count
+
+
+    def _grow(self, capacity):
+        data = np.zeros(capacity, dtype=EVENT_DTYPE)
+        data[:self.size] = self._data[:self.size]
+        self._data = data
+
+
+    def clear(self):
+        """
+        Remove all events, keeping the registered names and codes
+        """
+        self.size = 0
+
+
+    def discard(self, mask):
+        """
+        Remove the events where mask is True
+        """
+        keep = self._data[:self.size][~np.asarray(mask)]
+        self.size = len(keep)
+        self._data[:self.size] = keep
+
+
+    def copy(self):
+        """
+        Create a distinct copy of the event table
+        """
+        table = EventTable(0)
+        table.fixture_names = list(self.fixture_names)
+        table.person_names = list(self.person_names)
+        table.notes = list(self.notes)
+        table._codes = {kind: dict(codes) for kind, codes in self._codes.items()}
+        table._data = self._data[:self.size].copy()
+        table.size = self.size
+        return table
+
+
+    def fixture_mask(self, fixture):
+        """
+        Boolean mask of the events that use the named fixture
+        """
+        if fixture not in self._codes['fixture']:
+            return np.zeros(self.size, dtype=bool)
+        return self['fixture'] == self._codes['fixture'][fixture]
+
+
+    def fixture_order(self):
+        """
+        Row order grouping the events by fixture code, keeping the order the
+            events were added within each fixture
+        """
+        return np.argsort(self['fixture'], kind='stable')
+
+
+    def sort_by_fixture(self):
+        """
+        Reorder the rows in place so they are grouped by fixture code
+        """
+        self._data[:self.size] = self._data[:self.size][self.fixture_order()]
+
+
+    def to_event_list(self):
+        """
+        Return the events as human readable rows,
+            [times, fixture name, person name, hot rate, cold rate, note]
+        """
+        data = self._data[:self.size]
+        fixture = [self.fixture_names[x] for x in data['fixture'].tolist()]
+        person = [self.person_names[x] for x in data['person'].tolist()]
+        note = [self.notes[x] for x in data['note'].tolist()]
+        times = zip(data['start'].tolist(), data['end'].tolist())
+        return [[list(t), f, p, h, c, n] for t, f, p, h, c, n in
+                zip(times, fixture, person, data['hot_rate'].tolist(),
+                    data['cold_rate'].tolist(), note)]
+
+
+    @classmethod
+    def from_event_list(cls, event_list):
+        """
+        Build an event table from human readable rows,
+            [times, fixture name, person name, hot rate, cold rate, note]
+        """
+        table = cls(len(event_list) + 1)
+        for times, fixture, person, hot_rate, cold_rate, note in event_list:
+            table.append(note, fixture, person, times, cold_rate, hot_rate)
+        return table
+
+
+    @classmethod
+    def from_rows(cls, data, fixture_names, person_names, notes):
+        """
+        Build an event table from rows of EVENT_DTYPE and the name lists 
+            their codes refer to, the rows are copied
+        """
+        table = cls(0)
+        table.__setstate__({'fixture_names': list(fixture_names),
+                            'person_names': list(person_names),
+                            'notes': list(notes),
+                            '_data': np.array(data, dtype=EVENT_DTYPE),
+                            'size': len(data)})
+        return table
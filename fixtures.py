@@ -8,22 +8,22 @@ features or limiations.
 
 """
 
+import bisect
+import math
+import events
 from PPMtools_units import *
 
 class Event:
     """
-    Water usage event class to add to the schedule for each fixture
+    Water usage event, as returned by the schedule of each fixture
     note: a note saying what happened, e.g., 'brushed teeth'
     fixture: the fixture for the water usage
-    person: individual using the fixture
+    person: name of the individual using the fixture
     times: array representing window of time active (inclusive)
     cold_rate/hot_rate: flow rates for cold and hot water lines
     """
-    # TODO: Can this be placed into either the Fixture/Household classes?
-    # TODO: Create separate .py file for this class? usage.py/event.py/usage_events.py
-    # TODO: Currently appended to the fixture schedule upon generation
-    # TODO: Consider storing the fixture name rather than the fixture object
-    # TODO: Consider storing the person name rather than the person object
+    # Events are stored in the fixture's EventTable (events.py); Event objects
+    #    are only built on request by Fixture.schedule
     def __init__(self, note, fixture, person, times, cold_rate, hot_rate):
         self.note = note     
         self.fixture = fixture
@@ -42,22 +42,69 @@ class Fixture:
         Initialize a fixture
         name: name of Fixture
         max_rate: flow rate of fixture
-        initialize schedule, nodes, labels, and flushability
+        initialize event table, nodes, labels, and flushability
         """
         # TODO: set default max rates for each fixture type?
         self.name = name
         self.max_rate = max_rate
-        self.schedule = []
+        # event table and busy windows are replaced by the household trial state
+        self.event_table = events.EventTable()
+        self.event_table.code('fixture', name)
+        self.busy_starts = []   # sorted, non-overlapping busy windows built
+        self.busy_ends = []     # from the schedule, used by available_times
         self.nodes = ['cold', 'hot']
         self.node_labels = [name + 'C', name + 'H']
         self.continuous_flushability = True
 
 
+    @property
+    def schedule(self):
+        """
+        Water usage events of the fixture, as Event objects built from the 
+            event table
+        """
+        table = self.event_table
+        rows = table.fixture_mask(self.name).nonzero()[0]
+        return [Event(table.notes[table['note'][i]], 
+                      self, 
+                      table.person_names[table['person'][i]], 
+                      [int(table['start'][i]), int(table['end'][i])],
+                      float(table['cold_rate'][i]), 
+                      float(table['hot_rate'][i])) for i in rows]
+
+
     def reset_schedule(self):
         """
         Clear all water usage events for the fixture
         """
-        self.schedule = []
+        self.event_table.discard(self.event_table.fixture_mask(self.name))
+        self.busy_starts.clear()
+        self.busy_ends.clear()
+
+
+    def add_event(self, note, person, times, cold_rate, hot_rate):
+        """
+        Add a water usage event for the fixture to the event table and mark its
+            window as busy. Overlapping busy windows are merged so the busy 
+            lists stay sorted and disjoint.
+        note: a note saying what happened, e.g., 'brushed teeth'
+        person: individual using the fixture, or their name
+        times: array representing window of time active (inclusive)
+        cold_rate/hot_rate: flow rates for cold and hot water lines
+        """
+        if type(person) != str:
+            person = person.name
+        self.event_table.append(note, self.name, person, times, cold_rate, hot_rate)
+        start_time, end_time = times[0], times[1]
+        first = bisect.bisect_left(self.busy_ends, start_time)
+        last = first
+        while last < len(self.busy_starts) and self.busy_starts[last] <= end_time:
+            last += 1
+        if last > first:
+            start_time = min(start_time, self.busy_starts[first])
+            end_time = max(end_time, self.busy_ends[last - 1])
+        self.busy_starts[first:last] = [start_time]
+        self.busy_ends[first:last] = [end_time]
 
 
     def run_water(self, note, person, times, cold_rel, hot_rel):
@@ -75,8 +122,7 @@ class Fixture:
             print('WARNING: cold + hot rates exceed max rate for ' + self.name)
         cold_rate = cold_rel * self.max_rate
         hot_rate = hot_rel * self.max_rate
-        event = Event(note, self, person, times, cold_rate, hot_rate)
-        self.schedule.append(event)
+        self.add_event(note, person, times, cold_rate, hot_rate)
 
 
     def rinse_pipes(self, start_time, duration, node):
@@ -104,29 +150,24 @@ class Fixture:
                 hot_rate = self.max_rate
         times = [start_time, start_time + duration]
 
-        event = Event(note, self, person, times, cold_rate, hot_rate)
-        self.schedule.append(event)
+        self.add_event(note, person, times, cold_rate, hot_rate)
 
 
     def available_times(self, times):
         """
         Check if the proposed times for the action conflict with the current
-            schedule of the fixture. If conflict is found, increment proposed times
-            by 1 minute/timestep?? and recheck times.
+            schedule of the fixture. If conflict is found, shift the proposed 
+            times by whole timesteps to just past the blocking event and recheck
+            against the next busy window. Returns the earliest non-overlapping 
+            times at or after the proposed times.
         """
         # TODO: do we increment one step or one minute (6 steps)
         # TODO: currently returns time immediately prior to another event, okay?
-        busy = True
-        while busy == True:
-            busy = False
-            for event in self.schedule:
-                # fix_times = event.times
-                # if times[0] <= fix_times[-1] and times[-1] >= fix_times[0]:
-                start_time, end_time = event.times
-                if times[0] <= end_time and times[-1] >= start_time:
-                    times = [x + 1 for x in times]
-                    busy = True
-                    break
+        idx = bisect.bisect_left(self.busy_ends, times[0])
+        while idx < len(self.busy_starts) and times[-1] >= self.busy_starts[idx]:
+            shift = math.floor(self.busy_ends[idx] - times[0]) + 1
+            times = [x + shift for x in times]
+            idx += 1
         return times
 
 
@@ -180,8 +221,7 @@ class Dishwasher(Fixture):
             if end_time > times[1]: end_time = times[1]
             times_step = [start_time, end_time]
             note_step = note + '-' + step_name
-            event_step = Event(note_step, self, person, times_step, cold_rate, hot_rate)
-            self.schedule.append(event_step)
+            self.add_event(note_step, person, times_step, cold_rate, hot_rate)
             start_time = end_time
 
 
@@ -220,14 +260,12 @@ class Dishwasher(Fixture):
         # wash use event at start of cycle
         times_wash = [times[0], 
                       times[0] + duration_fill]
-        event_wash = Event(note + '-wash', self, person, times_wash, cold_rate, hot_rate)
-        self.schedule.append(event_wash)
+        self.add_event(note + '-wash', person, times_wash, cold_rate, hot_rate)
         
         # rinse use event at halfway point of cycle
         times_rinse = [times[0] + duration_cycle / 2, 
                        times[0] + duration_cycle / 2 + duration_fill]
-        event_rinse = Event(note + '-rinse', self, person, times_rinse, cold_rate, hot_rate)
-        self.schedule.append(event_rinse)
+        self.add_event(note + '-rinse', person, times_rinse, cold_rate, hot_rate)
 
 
     def add_cycle(self, cycle_name, steps=[]):
@@ -279,8 +317,7 @@ class Dishwasher(Fixture):
             duration_step = step[1]
             times_step_flow = [times_start, times_start + duration_flow]
             note_step = note + '-' + step_name
-            event_step = Event(note_step, self, person, times_step_flow, cold_rate, hot_rate)
-            self.schedule.append(event_step)
+            self.add_event(note_step, person, times_step_flow, cold_rate, hot_rate)
             times_start += duration_step
 
         if times_start != times[1]:
@@ -404,8 +441,7 @@ class Toilet(Fixture):
         times_fill = times
         hot_rate = 0
         cold_rate = self.max_rate
-        event = Event(note, self, person, times_fill, cold_rate, hot_rate)
-        self.schedule.append(event)
+        self.add_event(note, person, times_fill, cold_rate, hot_rate)
 
 
     def rinse_pipes(self, start_time, duration, node):
@@ -484,8 +520,7 @@ class Washer(Fixture):
             if end_time > times[1]: end_time = times[1]
             times_step = [start_time, end_time]
             note_step = note + '-' + step_name
-            event_step = Event(note_step, self, person, times_step, cold_rate, hot_rate)
-            self.schedule.append(event_step)
+            self.add_event(note_step, person, times_step, cold_rate, hot_rate)
             start_time = end_time
 
 
@@ -568,6 +603,5 @@ class Washer(Fixture):
                 cold_rate = 0
                 hot_rate = self.max_rate
 
-            event_step = Event(note_step, self, person, times_step, cold_rate, hot_rate)
-            self.schedule.append(event_step)
+            self.add_event(note_step, person, times_step, cold_rate, hot_rate)
             times_start += step[3] # move the start time to the end of the current step
\ No newline at end of file
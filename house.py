@@ -9,7 +9,41 @@ water usage events are added
 """
 
 import fixtures
+import events
 import copy
+import random
+
+
+class UsageState:
+    """
+    Water usage state of a single trial: the event table of the household,
+    the busy windows of each fixture and the random stream of the trial. The
+    household layout (fixtures, residents, routines) is shared by all trials,
+    only this state changes.
+    """
+    def __init__(self, fixture_names, rng=None):
+        """
+        Initialize an empty state
+        fixture_names: names of the household fixtures, in household order
+        rng: random.Random for the trial, None uses the global random module
+        """
+        self.rng = rng
+        self.event_table = events.EventTable()
+        self.busy = {}
+        for name in fixture_names:
+            self.event_table.code('fixture', name)
+            self.busy[name] = ([], [])
+
+
+    def reset(self):
+        """
+        Clear all water usage events and busy windows, in place
+        """
+        self.event_table.clear()
+        for busy_starts, busy_ends in self.busy.values():
+            busy_starts.clear()
+            busy_ends.clear()
+
 
 class Household:
     """
@@ -26,9 +60,9 @@ class Household:
         self.name = name
         self.fixtures = []
         self.residents = []
-        self.events = []
+        self.state = None
         self.init_fixture_lists(model)
-        self.event_list = []
+        self.new_trial()
         
     def _deepcopy_(self):
         """
@@ -102,6 +136,57 @@ class Household:
         self.fixtures.append(fix_add)
 
 
+    def new_trial(self, rng=None):
+        """
+        Start a new trial with an empty UsageState. Fixtures write their 
+            events and busy windows into the state, fixture codes of its event
+            table follow the order of self.fixtures. Returns the state.
+        rng: random.Random for the trial, None uses the global random module
+        """
+        names = [fix.name for fix in self.fixtures 
+                 if isinstance(fix, fixtures.Fixture)]
+        self.attach_state(UsageState(names, rng))
+        return self.state
+
+
+    def attach_state(self, state):
+        """
+        Point the household fixtures at the event table and busy windows of 
+            a UsageState
+        state: the UsageState to use
+        """
+        self.state = state
+        for fix in self.fixtures:
+            if isinstance(fix, fixtures.Fixture):
+                fix.event_table = state.event_table
+                fix.busy_starts, fix.busy_ends = state.busy[fix.name]
+
+
+    def reset_usage(self):
+        """
+        Clear the current trial's water usage in place
+        """
+        self.state.reset()
+
+
+    @property
+    def rng(self):
+        """
+        The random number generator residents draw from in the current trial
+        """
+        if self.state.rng is None:
+            return random
+        return self.state.rng
+
+
+    @property
+    def event_table(self):
+        """
+        The event table of the current trial
+        """
+        return self.state.event_table
+
+
     def simulate_usage(self, week_long):
         """
         Simulate water usage for each resident over the defined schedule(week_long)
@@ -115,32 +200,29 @@ class Household:
 
     def build_event_list(self):
         """
-        Add all events stored in the fixture schedules to the household event list
+        Group the household event table by fixture, in the order of the 
+            household fixtures and keeping the order of use for each fixture
         """
         # TODO: Should this be a user-accessible method or hidden (_build_event_list)?
-        # TODO: Consider populating this structure at simulation time instead
-        # TODO: Does the event need to be stored in two places (houehold.events and fixture.schedule)?
-        # TODO: Have this create and store the object that PPMtools extract_event_list() already does
-        # TODO: Can event_list replace events, they seem redundant?
+        self.event_table.sort_by_fixture()
+
+
+    @property
+    def events(self):
+        """
+        All water usage events of the household as Event objects, grouped by 
+            fixture
+        """
+        household_events = []
         for fix in self.fixtures:
-            if fix.schedule:
-                self.events.extend(fix.schedule)
-        
-        # moving PPMtools.extract_events_list here
-        
-        for event in self.events:
-            # creates more human readable list, used elsewhere
-            # TODO: False is currently placeholder. Could be removed, TODO
-            if type(event.person) == str:
-                name = event.person
-            else:
-                name = event.person.name
-            self.event_list.append([event.times,
-                                    event.fixture.name,
-                                    name,
-                                    event.hot_rate,
-                                    event.cold_rate,
-                                    event.note,
-                                    ])
-        
-                
\ No newline at end of file
+            household_events.extend(fix.schedule)
+        return household_events
+
+
+    @property
+    def event_list(self):
+        """
+        Human readable list of the household events, 
+            [times, fixture name, person name, hot rate, cold rate, note]
+        """
+        return self.event_table.to_event_list()
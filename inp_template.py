@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+PPMtools INP template class and associated functions.
+
+Writes EPANET input files for many trials of the same network. The network is
+rendered by WNTR once and split into sections, only the [TANKS], [PIPES],
+[JUNCTIONS] and [PATTERNS] sections are rendered again for each file.
+Multipliers are formatted in bulk, in the same format WNTR writes them, and
+identical or all-zero demand patterns share a single pattern ID.
+
+
+"""
+
+import os
+import io
+import tempfile
+
+import numpy as np
+import wntr
+
+NUM_COLUMNS = 6         # multipliers per line, as written by WNTR
+
+
+def format_pattern(name, multipliers):
+    """
+    Format a pattern for the [PATTERNS] section, same as WNTR writes it
+    name: pattern name
+    multipliers: array of pattern multipliers
+    """
+    values = np.asarray(multipliers, dtype=float).tolist()
+    full, rest = divmod(len(values), NUM_COLUMNS)
+    name = name.replace('%', '%%')
+    line = '\n' + name + ' %f' * NUM_COLUMNS
+    fmt = line * full
+    if rest:
+        fmt += '\n' + name + ' %f' * rest
+    return fmt % tuple(values) + '\n'
+
+
+def split_sections(text):
+    """
+    Split the text of an INP file into a list of [section name, text] items,
+        in file order
+    """
+    sections = []
+    for line in text.splitlines(keepends=True):
+        if line.startswith('['):
+            sections.append([line.strip(), line])
+        elif sections:
+            sections[-1][1] += line
+    return sections
+
+
+class InpTemplate:
+    """
+    Pre-rendered EPANET input file of a water network, for writing the same
+    network with new patterns, tank sizes, and pipe sizes
+    """
+    def __init__(self, wn, units='GPM', version=2.2, dedup=True):
+        """
+        Render the network once with WNTR
+        wn: water network model
+        units: flow units of the INP file
+        version: EPANET version of the INP file
+        dedup: share one pattern ID among identical or all-zero patterns
+        """
+        self.wn = wn
+        self.version = version
+        self.dedup = dedup
+        self._inp = wntr.epanet.InpFile()
+        fd, path = tempfile.mkstemp(suffix='.inp')
+        os.close(fd)
+        try:
+            self._inp.write(path, wn, units=units, version=version)
+            with open(path, 'rb') as f:
+                text = f.read().decode()
+        finally:
+            os.remove(path)
+        self.sections = split_sections(text)
+        self._index = {name: i for i, (name, _) in enumerate(self.sections)}
+        self._parse_junctions()
+        self.fixed_patterns = self.referenced_patterns()
+        self.refresh_network()
+
+
+    def _parse_junctions(self):
+        # junction lines as [line, pattern], pattern is None if not set
+        lines = self.sections[self._index['[JUNCTIONS]']][1]
+        lines = lines.splitlines(keepends=True)
+        self._junc_header = lines[:2]
+        self._junc_lines = []
+        for line in lines[2:]:
+            tokens = line.split()
+            pattern = tokens[3] if len(tokens) == 5 else None
+            self._junc_lines.append([line, pattern])
+
+
+    def referenced_patterns(self):
+        """
+        Names of the patterns used anywhere other than as the single demand
+            pattern of a junction. These patterns are never deduplicated.
+        """
+        wn = self.wn
+        fixed = {'1', wn.options.hydraulic.pattern,
+                 wn.options.energy.global_pattern}
+        for name in wn.junction_name_list:
+            demands = wn.get_node(name).demand_timeseries_list
+            if len(demands) > 1:
+                fixed.update(demand.pattern_name for demand in demands)
+        for name in wn.reservoir_name_list:
+            fixed.add(wn.get_node(name).head_pattern_name)
+        for name in wn.pump_name_list:
+            pump = wn.get_link(name)
+            fixed.add(getattr(pump, 'speed_pattern_name', None))
+            fixed.add(getattr(pump, 'energy_pattern', None))
+        for name in wn.source_name_list:
+            fixed.add(wn.get_source(name).pattern_name)
+        fixed.discard(None)
+        return fixed
+
+
+    def refresh_network(self):
+        """
+        Render the [TANKS] and [PIPES] sections again from the network, call
+            after changing tank levels or pipe lengths and diameters
+        """
+        buf = io.BytesIO()
+        self._inp._write_tanks(buf, self.wn, version=self.version)
+        self.sections[self._index['[TANKS]']][1] = buf.getvalue().decode()
+        buf = io.BytesIO()
+        self._inp._write_pipes(buf, self.wn)
+        self.sections[self._index['[PIPES]']][1] = buf.getvalue().decode()
+
+
+    def pattern_ids(self, patterns):
+        """
+        Map each pattern name to the pattern ID written to the INP file,
+            identical or all-zero patterns map to the first of them
+        patterns: dictionary of pattern multipliers, in file order
+        """
+        ids = {}
+        seen = {}
+        for name, multipliers in patterns.items():
+            ids[name] = name
+            if not self.dedup or name in self.fixed_patterns:
+                continue
+            if not multipliers.any():
+                key = 'zero'
+            else:
+                key = multipliers.tobytes()
+            ids[name] = seen.setdefault(key, name)
+        return ids
+
+
+    def write(self, patterns, outfile):
+        """
+        Write the INP file with new patterns
+        patterns: pattern dictionary {'patname':[pattern]}, patterns that are
+            not given keep the multipliers of the network
+        outfile: name of the output file ('.inp')
+        """
+        merged = {}
+        for name in self.wn.pattern_name_list:
+            merged[name] = self.wn.get_pattern(name).multipliers
+        merged.update(patterns)
+        merged = {name: np.asarray(patt, dtype=float)
+                  for name, patt in merged.items()}
+        ids = self.pattern_ids(merged)
+
+        junctions = list(self._junc_header)
+        for line, pattern in self._junc_lines:
+            if pattern is not None and ids.get(pattern, pattern) != pattern:
+                head = line.rsplit(None, 2)[0]
+                line = head + ' {:24} {:>3s}\n'.format(ids[pattern], ';')
+            junctions.append(line)
+
+        patt_text = ['[PATTERNS]\n', '{:10s} {:10s}\n'.format(';ID',
+                                                              'Multipliers')]
+        for name, multipliers in merged.items():
+            if ids[name] == name:
+                patt_text.append(format_pattern(name, multipliers))
+        patt_text.append('\n')
+
+        with open(outfile, 'wb') as f:
+            for name, text in self.sections:
+                if name == '[TITLE]':
+                    buf = io.BytesIO()      # header has the file creation time
+                    self._inp._write_title(buf, self.wn)
+                    text = buf.getvalue().decode()
+                elif name == '[JUNCTIONS]':
+                    text = ''.join(junctions)
+                elif name == '[PATTERNS]':
+                    text = ''.join(patt_text)
+                f.write(text.encode())
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+PPMtools instrumentation classes and associated functions.
+
+Opt-in recording of the stages of a Monte Carlo campaign (generation,
+pattern build, INP write, EPANET solve, bin read, summary): wall time, CPU
+time, peak RSS, bytes read and written, and counts such as trials and runs.
+Each process records into its own Recorder, worker records are merged into
+the campaign recorder by worker, and the report is written as JSON or CSV.
+Progress is reported through a rate-limited callback instead of a print per
+file.
+
+
+"""
+
+import os
+import csv
+import json
+import time
+import contextlib
+
+try:
+    import resource             # not available on Windows
+except ImportError:
+    resource = None
+
+STAGE_FIELDS = ['calls', 'wall', 'cpu', 'peak_rss', 'bytes_read',
+                'bytes_written']
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in bytes, None if unknown
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if os.uname().sysname == 'Darwin':
+        return rss                  # bytes on macOS, kilobytes elsewhere
+    return rss * 1024
+
+
+def current_rss():
+    """
+    Resident set size of this process in bytes, from /proc/self/statm. None
+        if unknown (not Linux)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def reset_peak_rss():
+    """
+    Start a new peak RSS window of this process, see window_peak_rss. Linux
+        resets the high-water mark (VmHWM) to the current RSS, so peak_rss
+        also starts again from the current RSS.
+    returns False if the high-water mark cannot be reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def window_peak_rss():
+    """
+    Peak RSS of this process in bytes since reset_peak_rss, from VmHWM of 
+        /proc/self/status. None if unknown (not Linux)
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def run_rss(func, *args, **kwargs):
+    """
+    Call func and measure the memory it adds to this process: its peak RSS
+        above the RSS before the call. Falls back to the RSS left after the
+        call when the peak cannot be reset.
+    returns result of func, and the added RSS in bytes (None if unknown)
+    """
+    before = current_rss()
+    reset = before is not None and reset_peak_rss()
+    result = func(*args, **kwargs)
+    after = window_peak_rss() if reset else current_rss()
+    if before is None or after is None:
+        return result, None
+    return result, max(after - before, 0)
+
+
+class Recorder:
+    """
+    Stage times, bytes, and counts of a campaign, by worker process
+    """
+    def __init__(self):
+        """
+        Initialize an empty recorder, the campaign clock starts now
+        """
+        self.start_time = time.time()
+        self.end_time = None
+        self.workers = {}           # {pid: {stage: {field: value}}}
+        self.counts = {}            # {pid: {name: count}}
+
+
+    def _stage(self, stage, pid=None):
+        if pid is None:
+            pid = os.getpid()
+        stages = self.workers.setdefault(pid, {})
+        if stage not in stages:
+            stages[stage] = dict.fromkeys(STAGE_FIELDS, 0)
+            stages[stage]['peak_rss'] = None
+        return stages[stage]
+
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """
+        Context manager recording the wall time, CPU time, and peak RSS of a
+            stage, e.g. with recorder.stage('bin read'): ...
+        """
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            record = self._stage(stage)
+            record['calls'] += 1
+            record['wall'] += time.perf_counter() - wall
+            record['cpu'] += time.process_time() - cpu
+            rss = peak_rss()
+            if rss is not None:
+                record['peak_rss'] = max(record['peak_rss'] or 0, rss)
+
+
+    def add_bytes(self, stage, read=0, written=0):
+        """
+        Add bytes read and written to a stage
+        """
+        record = self._stage(stage)
+        record['bytes_read'] += int(read)
+        record['bytes_written'] += int(written)
+
+
+    def count(self, name, n=1):
+        """
+        Add to a count, e.g. 'trials' or 'runs'
+        """
+        counts = self.counts.setdefault(os.getpid(), {})
+        counts[name] = counts.get(name, 0) + n
+
+
+    def merge(self, other):
+        """
+        Add the records of another recorder (e.g. of a worker task), in place
+        other: Recorder, or the dictionary returned by Recorder.state
+        """
+        if isinstance(other, Recorder):
+            other = other.state()
+        for pid, stages in other['workers'].items():
+            for stage, values in stages.items():
+                record = self._stage(stage, pid)
+                for field in STAGE_FIELDS:
+                    if field == 'peak_rss':
+                        if values[field] is not None:
+                            record[field] = max(record[field] or 0,
+                                                values[field])
+                    else:
+                        record[field] += values[field]
+        for pid, counts in other['counts'].items():
+            total = self.counts.setdefault(pid, {})
+            for name, n in counts.items():
+                total[name] = total.get(name, 0) + n
+        return self
+
+
+    def state(self):
+        """
+        Records as plain dictionaries, small to return from workers
+        """
+        return {'workers': self.workers, 'counts': self.counts}
+
+
+    def finish(self):
+        """
+        Stop the campaign clock
+        """
+        self.end_time = time.time()
+
+
+    def report(self):
+        """
+        Campaign report: totals and per-worker breakdown of every stage,
+            counts, and throughput (count per second of campaign wall time)
+        """
+        end = self.end_time if self.end_time is not None else time.time()
+        elapsed = end - self.start_time
+        totals = Recorder()
+        for stages in self.workers.values():
+            totals.merge({'workers': {'total': stages}, 'counts': {}})
+        counts = {}
+        for worker_counts in self.counts.values():
+            for name, n in worker_counts.items():
+                counts[name] = counts.get(name, 0) + n
+        throughput = {name + '/s': (n / elapsed if elapsed > 0 else None)
+                      for name, n in counts.items()}
+        return {'start': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                       time.localtime(self.start_time)),
+                'elapsed': elapsed,
+                'counts': counts,
+                'throughput': throughput,
+                'stages': totals.workers.get('total', {}),
+                'workers': {str(pid): {'stages': stages,
+                                       'counts': self.counts.get(pid, {})}
+                            for pid, stages in self.workers.items()}}
+
+
+    def write_report(self, filename):
+        """
+        Write the campaign report, as JSON or, for a '.csv' file name, as one
+            row per worker and stage (worker 'total' for the campaign)
+        """
+        report = self.report()
+        if not filename.lower().endswith('.csv'):
+            with open(filename, 'w') as f:
+                json.dump(report, f, indent=1)
+            return
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['worker', 'stage'] + STAGE_FIELDS)
+            rows = [('total', report['stages'])]
+            rows += [(pid, worker['stages'])
+                     for pid, worker in report['workers'].items()]
+            for worker, stages in rows:
+                for stage, values in stages.items():
+                    writer.writerow([worker, stage] +
+                                    [values[x] for x in STAGE_FIELDS])
+
+
+_recorder = None        # recorder of this process, None when not recording
+_stack = []             # recorders replaced by start, restored by stop
+
+
+def start(recorder=None):
+    """
+    Start recording in this process. A recorder that is already active is 
+        set aside until stop, so a task can record on its own in the process
+        of the campaign.
+    recorder: Recorder to record into, a new one if None
+    returns the active recorder
+    """
+    global _recorder
+    _stack.append(_recorder)
+    _recorder = Recorder() if recorder is None else recorder
+    return _recorder
+
+
+def stop():
+    """
+    Stop recording in this process, the recorder set aside by start is 
+        active again
+    returns the recorder that was active, None if not recording
+    """
+    global _recorder
+    recorder = _recorder
+    _recorder = _stack.pop() if _stack else None
+    return recorder
+
+
+def active():
+    """
+    The recorder of this process, None when not recording
+    """
+    return _recorder
+
+
+def stage(name):
+    """
+    Record a stage into the active recorder, does nothing when not recording
+    """
+    if _recorder is None:
+        return contextlib.nullcontext()
+    return _recorder.stage(name)
+
+
+def add_bytes(stage, read=0, written=0):
+    """
+    Add bytes to a stage of the active recorder, if recording
+    """
+    if _recorder is not None:
+        _recorder.add_bytes(stage, read, written)
+
+
+def count(name, n=1):
+    """
+    Add to a count of the active recorder, if recording
+    """
+    if _recorder is not None:
+        _recorder.count(name, n)
+
+
+class Progress:
+    """
+    Rate-limited progress callback, prints at most once per interval for
+    each stage, and always when the stage is finished
+    """
+    def __init__(self, interval=10., printer=print):
+        """
+        interval: least seconds between reports of a stage
+        printer: function called with the progress message
+        """
+        self.interval = interval
+        self.printer = printer
+        self._start = {}
+        self._last = {}
+
+
+    def __call__(self, stage, done, total=None, final=False):
+        """
+        Report progress
+        stage: name of the stage, e.g. 'INP files' or 'runs'
+        done: number of items done so far
+        total: number of items, None if unknown
+        final: the stage is finished
+        """
+        now = time.monotonic()
+        start = self._start.setdefault(stage, now)
+        if not final and now - self._last.get(stage, start) < self.interval:
+            return
+        self._last[stage] = now
+        message = stage + ': ' + str(done)
+        if total is not None:
+            message += ' of ' + str(total)
+        if now > start:
+            message += ' ({:.1f}/s)'.format(done / (now - start))
+        self.printer(message)
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+PPMtools pattern store classes and associated functions.
+
+Keeps the demand patterns of many Monte Carlo trials as one contiguous
+(trials x patterns x steps) float32 array, in memory or memory mapped to a
+.npy file, with a name to row index. Flow type variants share the array of
+the reference trials and scale rows when they are read. SparsePatterns keeps
+only the event tables of the trials, the (start, end, rate) intervals, and
+rasterizes a trial when it is read. Both behave as the pattern dictionary
+{trial ID: {'patname':[pattern]}} returned by monte_carlo_setup, the rows
+of a trial are only read when a pattern is accessed.
+
+
+"""
+
+import json
+import copy
+from collections.abc import Mapping
+
+import numpy as np
+
+
+def rasterize(table, patt_idx, patt_array, source_name='Source'):
+    """
+    Fill the pattern rows of an event table. Fixture patterns are filled by
+        slice assignment, the source pattern accumulates the flow of every
+        event.
+    table: EventTable of the household
+    patt_idx: row of each pattern name, including the fixture patterns
+        (fixture name + 'CP'/'HP') of every event
+    patt_array: zero filled (patterns x steps) array
+    source_name: name of the source fixture
+    """
+    TOT_LENGTH = patt_array.shape[1]
+    source_code = table.code('fixture', source_name)
+    patt_source = patt_array[patt_idx[source_name + 'CP']]
+    # events are read in fixture order, as listed in the household
+    order = table.fixture_order()
+    for code, start, end, cold_rate, hot_rate in zip(table['fixture'][order].tolist(),
+                                                     table['start'][order].tolist(),
+                                                     table['end'][order].tolist(),
+                                                     table['cold_rate'][order].tolist(),
+                                                     table['hot_rate'][order].tolist()):
+        if code != source_code:
+            fix_name = table.fixture_names[code]
+            end = end + 1                       # event times are inclusive
+            if end > TOT_LENGTH: end = TOT_LENGTH
+            if start >= end:
+                continue
+            if cold_rate != 0:
+                patt_array[patt_idx[fix_name + 'CP'], start:end] = cold_rate
+                patt_source[start:end] += cold_rate
+            if hot_rate != 0:
+                patt_array[patt_idx[fix_name + 'HP'], start:end] = hot_rate
+                patt_source[start:end] += hot_rate
+    return patt_array
+
+
+class TrialPatterns(Mapping):
+    """
+    Pattern dictionary of a single trial {'patname':[pattern]}, read from its
+    store when a pattern is accessed
+    """
+    def __init__(self, store, trial_ID):
+        self.store = store
+        self.trial_ID = trial_ID
+
+
+    def __getitem__(self, name):
+        return self.store.pattern(self.trial_ID, name)
+
+
+    def __iter__(self):
+        return iter(self.store.pattern_names)
+
+
+    def __len__(self):
+        return len(self.store.pattern_names)
+
+
+    def __contains__(self, name):
+        return name in self.store.index
+
+
+    def array(self):
+        """
+        Patterns of the trial as a (patterns x steps) array, rows in the order
+            of store.pattern_names
+        """
+        return self.store.trial_array(self.trial_ID)
+
+
+class PatternStore(Mapping):
+    """
+    Patterns of many trials as one (trials x patterns x steps) array
+    """
+    def __init__(self, pattern_names, num_steps, num_trials, filename=None,
+                 dtype=np.float32, source_name='SourceCP'):
+        """
+        Initialize a zero filled store
+        pattern_names: names of the patterns, the rows of each trial
+        num_steps: number of pattern steps
+        num_trials: number of trials to allocate, the in memory array grows
+            when more trials are added
+        filename: '.npy' file to memory map the array to, None keeps the
+            array in memory. The index is written next to it by flush.
+        dtype: data type of the array
+        source_name: name of the source pattern, the flow of all others
+        """
+        self.pattern_names = list(pattern_names)
+        self.index = {name: row for row, name in enumerate(self.pattern_names)}
+        self.num_steps = int(num_steps)
+        self.source_name = source_name
+        self.filename = filename
+        self.trial_ids = []
+        self.trial_index = {}
+        self.scales = None          # row scales of a flow type variant
+        shape = (num_trials, len(self.pattern_names), self.num_steps)
+        if filename is None:
+            self.data = np.zeros(shape, dtype=dtype)
+        else:
+            self.data = np.lib.format.open_memmap(filename, mode='w+',
+                                                  dtype=dtype, shape=shape)
+
+
+    def __getitem__(self, trial_ID):
+        if trial_ID not in self.trial_index:
+            raise KeyError(trial_ID)
+        return TrialPatterns(self, trial_ID)
+
+
+    def __iter__(self):
+        return iter(self.trial_ids)
+
+
+    def __len__(self):
+        return len(self.trial_ids)
+
+
+    def __contains__(self, trial_ID):
+        return trial_ID in self.trial_index
+
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+
+    def add(self, trial_ID, patterns):
+        """
+        Copy the patterns of a trial into the next row of the array
+        trial_ID: name of the trial
+        patterns: pattern dictionary {'patname':[pattern]} of the trial,
+            patterns that are not given stay zero
+        """
+        if self.scales is not None:
+            raise ValueError('Trials are added to the reference store, '
+                             'not to a flow type variant')
+        row = len(self.trial_ids)
+        if row == len(self.data):
+            if self.filename is not None:
+                raise ValueError('Memory mapped pattern store is full (' +
+                                 str(row) + ' trials)')
+            grown = np.zeros((max(2 * row, 1),) + self.data.shape[1:],
+                             dtype=self.data.dtype)
+            grown[:row] = self.data
+            self.data = grown
+        for name, values in patterns.items():
+            self.data[row, self.index[name]] = values
+        self.trial_ids.append(trial_ID)
+        self.trial_index[trial_ID] = row
+
+
+    def scaled(self, pattern_list, scales):
+        """
+        Flow type variant of the store, sharing the array. Rows are scaled
+            when they are read and the source pattern is the scale weighted
+            sum of all other patterns, see PPMtools.scaled_patterns.
+        pattern_list: names of the patterns, without the source pattern
+        scales: scale of each pattern of pattern_list, see
+            PPMtools.flow_scales
+        """
+        scales = np.asarray(scales, dtype=float)
+        if not (scales != 1).any():
+            return self
+        variant = copy.copy(self)
+        variant.scales = np.ones(len(self.pattern_names))
+        for name, scale in zip(pattern_list, scales):
+            variant.scales[self.index[name]] = scale
+        return variant
+
+
+    def pattern(self, trial_ID, name):
+        """
+        Pattern of a trial, a view of the array unless it is scaled
+        """
+        trial = self.trial_index[trial_ID]
+        row = self.index[name]
+        if self.scales is None:
+            return self.data[trial, row]
+        if name == self.source_name:
+            return self.trial_array(trial_ID)[row]
+        if self.scales[row] == 1:
+            return self.data[trial, row]
+        return self.data[trial, row] * self.data.dtype.type(self.scales[row])
+
+
+    def trial_array(self, trial_ID):
+        """
+        Patterns of a trial as a (patterns x steps) array, rows in the order
+            of pattern_names
+        """
+        patt_array = self.data[self.trial_index[trial_ID]]
+        if self.scales is None:
+            return patt_array
+        source = self.index[self.source_name]
+        weights = self.scales.copy()
+        weights[source] = 0.
+        scaled = patt_array * self.scales[:, None].astype(patt_array.dtype)
+        scaled[source] = weights @ patt_array
+        return scaled
+
+
+    def flush(self):
+        """
+        Write the array and its index to disk, for a memory mapped store
+        """
+        if self.filename is None:
+            return
+        self.data.flush()
+        index = {'pattern_names': self.pattern_names,
+                 'num_steps': self.num_steps,
+                 'source_name': self.source_name,
+                 'trial_ids': self.trial_ids}
+        with open(index_file(self.filename), 'w') as f:
+            json.dump(index, f)
+
+
+class SparsePatterns(Mapping):
+    """
+    Patterns of many trials kept as their event tables, (start, end, rate)
+    intervals, and rasterized when a trial is read
+    """
+    def __init__(self, pattern_names, num_steps, source_name='Source',
+                 dtype=np.float64):
+        """
+        Initialize an empty store
+        pattern_names: names of the patterns, the rows of each trial
+        num_steps: number of pattern steps
+        source_name: name of the source fixture
+        dtype: data type of the rasterized patterns
+        """
+        self.pattern_names = list(pattern_names)
+        self.index = {name: row for row, name in enumerate(self.pattern_names)}
+        self.num_steps = int(num_steps)
+        self.source_name = source_name
+        self.dtype = dtype
+        self.tables = {}
+        self._last = (None, None)       # last rasterized trial
+
+
+    def __getitem__(self, trial_ID):
+        if trial_ID not in self.tables:
+            raise KeyError(trial_ID)
+        return TrialPatterns(self, trial_ID)
+
+
+    def __iter__(self):
+        return iter(self.tables)
+
+
+    def __len__(self):
+        return len(self.tables)
+
+
+    def __contains__(self, trial_ID):
+        return trial_ID in self.tables
+
+
+    def add(self, trial_ID, table):
+        """
+        Keep the event table of a trial
+        """
+        self.tables[trial_ID] = table
+
+
+    def with_tables(self, tables):
+        """
+        Store with the same patterns for other event tables, e.g. the scaled
+            tables of a flow type
+        tables: dictionary of {trial ID: EventTable}
+        """
+        variant = SparsePatterns(self.pattern_names, self.num_steps,
+                                 self.source_name, self.dtype)
+        variant.tables = dict(tables)
+        return variant
+
+
+    def pattern(self, trial_ID, name):
+        """
+        Pattern of a trial
+        """
+        return self.trial_array(trial_ID)[self.index[name]]
+
+
+    def trial_array(self, trial_ID):
+        """
+        Patterns of a trial as a (patterns x steps) array, rows in the order
+            of pattern_names. The last trial read is kept, so reading its
+            patterns one by one rasterizes it once.
+        """
+        if self._last[0] != trial_ID:
+            patt_array = np.zeros((len(self.pattern_names), self.num_steps),
+                                  dtype=self.dtype)
+            rasterize(self.tables[trial_ID], self.index, patt_array,
+                      self.source_name)
+            self._last = (trial_ID, patt_array)
+        return self._last[1]
+
+
+def index_file(filename):
+    """
+    Index file of a memory mapped store, e.g. patterns.json for patterns.npy
+    """
+    if filename.endswith('.npy'):
+        filename = filename[:-len('.npy')]
+    return filename + '.json'
+
+
+def load_pattern_store(filename, mode='r'):
+    """
+    Open a memory mapped store written by PatternStore.flush
+    filename: '.npy' file of the store
+    mode: memory map mode, 'r' read only or 'r+' to change patterns
+    """
+    with open(index_file(filename)) as f:
+        index = json.load(f)
+    store = PatternStore.__new__(PatternStore)
+    store.pattern_names = index['pattern_names']
+    store.index = {name: row for row, name in enumerate(store.pattern_names)}
+    store.num_steps = index['num_steps']
+    store.source_name = index['source_name']
+    store.filename = filename
+    store.trial_ids = index['trial_ids']
+    store.trial_index = {name: row for row, name in enumerate(store.trial_ids)}
+    store.scales = None
+    store.data = np.load(filename, mmap_mode=mode)
+    return store
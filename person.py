@@ -8,35 +8,115 @@ import random
 from PPMtools_units import *
 
 
+SCHEDULES = {'all_day': [[0, 24]],
+             'day':     [[8, 16]],
+             'day2':    [[6, 22]],
+             'AM':      [[6, 8]],
+             'PM':      [[17, 22]],
+             'AM_PM':   [[6, 8], [17, 22]]}
+
+
 def schedule_setup(schedules={}):
     """
-    Convert time periods during a day from hours to lists of timesteps
-    schedules: a dictionary of the time periods during a day in hours
+    Convert time periods during a day from hours to ranges of timesteps
+    schedules: a dictionary of the time periods during a day in hours, 
+        defaults to SCHEDULES
+    Overlapping or touching periods are merged, so each schedule is a sorted 
+        list of disjoint ranges.
     """
     # TODO: rename schedules to something more indicative of what it represents
     # TODO: calc steps_per_min directly from tss
     # TODO: add as a class method under house or resident?
     # TODO: the schedules dictionary could be put into the input file
     # TODO: each resident could have their own schedules dictionary for when they are home
+    if not schedules:
+        schedules = SCHEDULES
     
-    schedules = {'all_day': [[0, 24]],
-                 'day':     [[8, 16]],
-                 'day2':    [[6, 22]],
-                 'AM':      [[6, 8]],
-                 'PM':      [[17, 22]],
-                 'AM_PM':   [[6, 8], [17, 22]]}
-    
-    schedules_steps = dict.fromkeys(schedules,[])
+    schedules_steps = {}
     for key in schedules.keys():
         steps = []
-        for period in schedules[key]:
+        for period in sorted(schedules[key]):
             steps_start = period[0] * min_per_hr * steps_per_min
             steps_end   = period[1] * min_per_hr * steps_per_min
-            steps.extend([x for x in range(steps_start, steps_end)])
+            if steps and steps_start <= steps[-1].stop:
+                steps[-1] = range(steps[-1].start, max(steps_end, steps[-1].stop))
+            else:
+                steps.append(range(steps_start, steps_end))
         
         schedules_steps[key]= steps
 
     return schedules_steps
+
+
+# compiled once, shared by every resident
+schedule_steps = schedule_setup()
+_valid_starts = {}
+
+
+def valid_starts(sched, duration):
+    """
+    Ranges of timesteps an event of the given duration can start at, so that
+        both its start and end step fall within the scheduled time period
+    sched: name of the schedule in schedule_steps
+    duration: length of the event in timesteps
+    """
+    key = (sched, duration)
+    if key not in _valid_starts:
+        starts = []
+        for first in schedule_steps[sched]:
+            for last in schedule_steps[sched]:
+                start = max(first.start, last.start - duration + 1)
+                stop = min(first.stop, last.stop - duration + 1)
+                if start < stop:
+                    starts.append(range(start, stop))
+        if not starts:
+            raise ValueError('No start time in schedule ' + sched + 
+                             ' fits an event of ' + str(duration) + ' steps')
+        _valid_starts[key] = sorted(starts, key=lambda x: x.start)
+    return _valid_starts[key]
+
+
+def draw_start(starts, rng=random):
+    """
+    Draw a start time uniformly from a list of disjoint ranges
+    starts: list of ranges, as returned by valid_starts
+    rng: random number generator, the random module or a random.Random 
+    """
+    pick = rng.randrange(sum(len(x) for x in starts))
+    for steps in starts:
+        if pick < len(steps):
+            return steps[pick]
+        pick -= len(steps)
+
+
+# Fixture group, fixture method, note, and relative cold/hot rates of each 
+# routine action that uses water. Resident and batch.generate_trials both run
+# their actions from this table. 'food' and 'sample' do not use water yet.
+ACTIONS = {'shower':   ('showers',     'run_water',      'Shower',       (0.2, 0.8)),
+           'drink':    ('faucets',     'run_water',      'Drinking',     (1, 0)),
+           'teeth':    ('faucets',     'run_water',      'Brush Teeth',  (1, 0)),
+           'hands':    ('faucets',     'run_water',      'Wash Hands',   (0.5, 0.5)),
+           'toilet':   ('toilets',     'flush_toilet',   None,           ()),
+           'laundry':  ('washers',     'run_washer',     'Wash Clothes', (0.5, 0.5)),
+           'lawn':     ('spigots',     'run_water',      'Water Lawn',   (1., 0.)),
+           'dishes':   ('dishwashers', 'run_dishwasher', 'Dishes',       ()),
+           'ice':      ('fridges',     'run_water',      'Ice',          (1., 0.)),
+           'humidify': ('humidifiers', 'run_water',      'Humidify',     (1., 0.))}
+
+
+def run_action(action, fixture, person, times):
+    """
+    Add the water usage events of an action of ACTIONS on a fixture
+    action: name of the action, e.g. 'shower'
+    fixture: the fixture used, from the group of the action
+    person: individual performing the action, or their name
+    times: [start, end] timesteps of the action (inclusive)
+    """
+    group, method, note, rates = ACTIONS[action]
+    if note is None:
+        getattr(fixture, method)(person, times)
+    else:
+        getattr(fixture, method)(note, person, times, *rates)
    
 
 class Resident:
@@ -71,85 +151,77 @@ class Resident:
                            'humidify': self.humidify}
                             
 
+    def use_fixture(self, action, times):
+        """
+        Perform an action of ACTIONS on a randomly chosen fixture of its group,
+            delayed until the fixture is available
+        action: name of the action, e.g. 'shower'
+        times: [start, end] timesteps the action is scheduled for (inclusive)
+        """
+        fixture = self.myHouse.rng.choice(getattr(self.myHouse, ACTIONS[action][0]))
+        times = fixture.available_times(times)
+        run_action(action, fixture, self, times)
+
+
     def drink_water(self, times):
         # TODO: Remove "busy" fixtures rather than delaying the use of the fixture?
         if not self.myHouse.faucets:
             print(self.name + " wants to take a drink, but there aren't any faucets!")        
-        fixture = random.choice(self.myHouse.faucets)
-        times = fixture.available_times(times)
-        fixture.run_water('Drinking', self, times, 1, 0)
+        self.use_fixture('drink', times)
         
         
     def take_shower(self, times):
         if not self.myHouse.showers:
             print(self.name + " wants to take a shower, but there aren't any!")
-        fixture = random.choice(self.myHouse.showers)
-        times = fixture.available_times(times)
-        fixture.run_water('Shower', self, times, 0.2, 0.8)
+        self.use_fixture('shower', times)
 
     
     def brush_teeth(self, times):
         if not self.myHouse.faucets:
             print(self.name + " wants to take a brush some teeth, but there aren't any faucets!")           
-        fixture = random.choice(self.myHouse.faucets)
-        times = fixture.available_times(times)
-        fixture.run_water('Brush Teeth', self, times, 1, 0)
+        self.use_fixture('teeth', times)
     
     
     def use_toilet(self, times):
         if not self.myHouse.toilets:
             print(self.name + " has to go, but there aren't any toilets!")   
-        fixture = random.choice(self.myHouse.toilets)
-        times = fixture.available_times(times)
-        fixture.flush_toilet(self, times)
+        self.use_fixture('toilet', times)
     
     
     def wash_hands(self, times):
         if not self.myHouse.faucets:
             print(self.name + " wants to wash hands, but there aren't any faucets!")         
-        fixture = random.choice(self.myHouse.faucets)
-        times = fixture.available_times(times)
-        fixture.run_water('Wash Hands', self, times, 0.5, 0.5)
+        self.use_fixture('hands', times)
         
 
     def wash_clothes(self, times):
         if not self.myHouse.washers:
             print(self.name+" wants to wash clothes, but washer is in use.")
-        fixture = random.choice(self.myHouse.washers)
-        times = fixture.available_times(times)
-        fixture.run_washer('Wash Clothes',self, times, 0.5, 0.5)
+        self.use_fixture('laundry', times)
         
         
     def water_lawn(self, times):
         if not self.myHouse.spigots:
             print(self.name+" already watering lawn.")
-        fixture = random.choice(self.myHouse.spigots)
-        times = fixture.available_times(times)
-        fixture.run_water('Water Lawn', self, times, 1., 0.)
+        self.use_fixture('lawn', times)
         
         
     def wash_dishes(self, times):
         if not self.myHouse.dishwashers:
             print(self.name+" already washing dishes.")
-        fixture = random.choice(self.myHouse.dishwashers)
-        times = fixture.available_times(times)
-        fixture.run_dishwasher('Dishes', self, times)
+        self.use_fixture('dishes', times)
 
 
     def make_ice(self, times):
         if not self.myHouse.fridges:
             print(self.name+" Fridge in use.")
-        fixture = random.choice(self.myHouse.fridges)
-        times = fixture.available_times(times)
-        fixture.run_water('Ice', self, times,1.,0., True)
+        self.use_fixture('ice', times)
         
         
     def humidify(self, times):
         if not self.myHouse.humidifiers:
             print(self.name+" Humidifier is already in use.")
-        fixture = random.choice(self.myHouse.humidifiers)
-        times = fixture.available_times(times)
-        fixture.run_water('Humidify', self, times, 1., 0.)
+        self.use_fixture('humidify', times)
 
 
     def flush_fixture(self, times, fixture, node):
@@ -212,18 +284,16 @@ class Resident:
         day_of_week: the day of the week for the routine
         """
         queue = []
-        schedules = schedule_setup()
         for task in self.routine[day_of_week]:
             name = task[0]
             sched = task[1]
             frequency = task[2]
             duration = task[3]
             for n in range(frequency):
-                # ensure the event ends within the scheduled time period of the day
-                end_time = schedules[sched][0] + \
-                           day_of_week * steps_per_day - 1
-                while end_time - day_of_week * steps_per_day not in schedules[sched]:
-                    start_time = random.choice(schedules[sched]) + day_of_week * steps_per_day
-                    end_time = start_time + duration - 1
+                # draw only from starts that end within the scheduled time period of the day
+                start_time = draw_start(valid_starts(sched, duration), 
+                                        self.myHouse.rng) + \
+                             day_of_week * steps_per_day
+                end_time = start_time + duration - 1
                 queue.append((name, [start_time, end_time]))
-        return queue
\ No newline at end of file
+        return queue
@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+"""
+PPMtools plug flow engine class and associated functions.
+
+Screens water age runs of house networks without EPANET. A house is a tree
+network with a single tank (the water heater) or reservoir, and the Source
+junction whose negative demand brings in new water, so the flow of every
+link is the demand beyond it and no hydraulic solver is needed. Water age is
+routed as in EPANET's Lagrangian method: each pipe is a queue of plugs of
+water that leave the pipe in the order they entered, the tank is completely
+mixed, and nodes without flow take the average of the links that end at
+them. Each plug is kept as the time its water entered the network, so water
+ages without any work while fixtures are closed, and all steps of a run of
+constant demands are routed together.
+
+The engine has the same interface as toolkit_engine.ToolkitEngine, with
+results in SI units (age in seconds).
+
+
+"""
+
+import numpy as np
+import pandas as pd
+import wntr
+from scipy.signal import lfilter
+
+from PPMtools_units import *
+
+# EPANET 2.2 treats flows under 0.005 gpm as stagnant in quality routing
+Q_STAGNANT = 0.005 * m3_per_gal / sec_per_min
+
+
+class PlugFlowEngine:
+    """
+    Water age of a tree network, routed as plug flow, for running many trials
+    of the same network with new patterns
+    """
+    def __init__(self, network, nodes=None):
+        """
+        Build the tree of the network
+        network: water network model, or EPANET input file of the network
+        nodes: names of the nodes to collect water age for, None for all nodes
+        """
+        if isinstance(network, str):
+            network = wntr.network.WaterNetworkModel(network)
+        wn = network
+        if wn.options.quality.parameter.upper() != 'AGE':
+            raise ValueError('The plug flow engine only models water age, '
+                             'the network models ' +
+                             str(wn.options.quality.parameter))
+        times = wn.options.time
+        self.duration = int(times.duration)
+        self.pattern_step = int(times.pattern_timestep)
+        self.quality_step = int(times.quality_timestep)
+        self.report_step = int(times.report_timestep)
+        self.report_start = int(times.report_start)
+        if self.quality_step <= 0 or self.pattern_step % self.quality_step:
+            raise ValueError('The pattern step must be a multiple of the '
+                             'quality step')
+        # same report times as the binary file
+        self.report_times = np.arange(self.report_start,
+                                      self.duration + self.report_step -
+                                      (self.duration % self.report_step),
+                                      self.report_step)
+        self.node_names = list(wn.node_name_list)
+        self.pattern_names = list(wn.pattern_name_list)
+        self._build_tree(wn)
+        self._build_demands(wn)
+        self.set_nodes(nodes)
+
+
+    def _build_tree(self, wn):
+        # orient every link away from the tank (or reservoir), nodes in
+        # breadth first order
+        node_index = {name: i for i, name in enumerate(self.node_names)}
+        num_nodes = len(self.node_names)
+        fixed = wn.tank_name_list + wn.reservoir_name_list
+        if len(fixed) != 1:
+            raise ValueError('The plug flow engine needs a single tank or '
+                             'reservoir, the network has ' + str(len(fixed)))
+        if wn.num_links != num_nodes - 1:
+            raise ValueError('The plug flow engine needs a tree network, the '
+                             'network has ' + str(wn.num_links) + ' links '
+                             'for ' + str(num_nodes) + ' nodes')
+        adjacent = [[] for _ in range(num_nodes)]
+        link_ends = []
+        volumes = []
+        for k, name in enumerate(wn.link_name_list):
+            link = wn.get_link(name)
+            start = node_index[link.start_node_name]
+            end = node_index[link.end_node_name]
+            adjacent[start].append((k, end))
+            adjacent[end].append((k, start))
+            link_ends.append(end)
+            if isinstance(link, wntr.network.Pipe):
+                volumes.append(np.pi / 4 * link.diameter ** 2 * link.length)
+            else:
+                volumes.append(0.)
+        self.root = node_index[fixed[0]]
+        self.order = [self.root]
+        self.upstream = [-1] * num_nodes        # node toward the root
+        self.parent = [-1] * num_nodes          # link toward the root
+        self.children = [[] for _ in range(num_nodes)]
+        seen = {self.root}
+        for n in self.order:
+            for k, m in adjacent[n]:
+                if m in seen:
+                    continue
+                seen.add(m)
+                self.parent[m] = k
+                self.upstream[m] = n
+                self.children[n].append(k)
+                self.order.append(m)
+        if len(self.order) != num_nodes:
+            raise ValueError('The plug flow engine needs a connected network')
+        # ends of each link, away from the root
+        self.link_nodes = np.zeros(len(volumes), dtype=int)
+        self.link_upstream = np.zeros(len(volumes), dtype=int)
+        for n in self.order[1:]:
+            self.link_nodes[self.parent[n]] = n
+            self.link_upstream[self.parent[n]] = self.upstream[n]
+        # links that end at each node, as in the input file
+        self.ending = [[] for _ in range(num_nodes)]
+        for k, end in enumerate(link_ends):
+            self.ending[end].append(k)
+        self.volumes = np.array(volumes)
+        self.tank_volume = None                 # None for a reservoir
+        if fixed[0] in wn.tank_name_list:
+            tank = wn.get_node(fixed[0])
+            area = np.pi / 4 * tank.diameter ** 2
+            self.tank_volume = area * tank.init_level
+            self.tank_max_volume = area * tank.max_level
+        self.initial = np.array([wn.get_node(name).initial_quality or 0.
+                                 for name in self.node_names])
+        self._routes = {}
+
+
+    def _build_demands(self, wn):
+        # base demand and pattern of each junction demand, negative demands
+        # are sources of new water
+        multiplier = wn.options.hydraulic.demand_multiplier
+        default = wn.options.hydraulic.pattern
+        self._patterns = {name: np.round(np.asarray(
+                              wn.get_pattern(name).multipliers,
+                              dtype=np.float64), 6)
+                          for name in self.pattern_names}
+        self._demands = []                      # [node, base, pattern]
+        for n, name in enumerate(self.node_names):
+            if name not in wn.junction_name_list:
+                continue
+            for demand in wn.get_node(name).demand_timeseries_list:
+                if demand.base_value == 0:
+                    continue
+                pattern = demand.pattern_name
+                if pattern is None and default in self._patterns:
+                    pattern = default
+                self._demands.append([n, demand.base_value * multiplier,
+                                      pattern])
+        self._pattern_offset = int(wn.options.time.pattern_start //
+                                   self.pattern_step)
+
+
+    def set_nodes(self, nodes=None):
+        """
+        Set the nodes to collect water age for
+        nodes: names of the nodes, None for all nodes
+        """
+        if nodes is None:
+            nodes = self.node_names
+        self.nodes = list(nodes)
+        node_index = {name: i for i, name in enumerate(self.node_names)}
+        self._node_index = [node_index[name] for name in self.nodes]
+
+
+    def set_patterns(self, patterns):
+        """
+        Replace the multipliers of the network patterns, patterns that are
+            not in the network are ignored. Multipliers are rounded to the 6
+            decimals of an INP file, as in ToolkitEngine.
+        patterns: pattern dictionary {'patname':[pattern]}
+        """
+        for name, multipliers in patterns.items():
+            if name not in self._patterns:
+                continue
+            self._patterns[name] = np.round(np.asarray(multipliers,
+                                                       dtype=np.float64), 6)
+
+
+    def demands(self):
+        """
+        Demand of every node for each pattern step of the run
+        returns array of demands (nodes x pattern steps), m3/s
+        """
+        num_periods = -(-self.duration // self.pattern_step)
+        demand = np.zeros((len(self.node_names), num_periods))
+        periods = np.arange(num_periods) + self._pattern_offset
+        for n, base, pattern in self._demands:
+            values = self._patterns.get(pattern)
+            if values is None or len(values) == 0:
+                demand[n] += base
+            else:
+                demand[n] += base * values[periods % len(values)]
+        return demand
+
+
+    def hydraulics(self):
+        """
+        Flows of the network for the current patterns. Runs of pattern steps
+            with the same demands are returned together. The flow of a link
+            is the demand beyond it, and the tank or reservoir makes up the
+            difference with the negative demands. A full tank does not
+            fill, its inflow is cut to its outflow as EPANET closes the
+            links that fill it.
+        returns list of [first quality step, last quality step, flow of each
+            link away from the root (m3/s), negative demand of each node
+            (m3/s), tank volume at the first step (m3)]
+        """
+        step = self.quality_step
+        per_period = self.pattern_step // step
+        num_steps = self.duration // step
+        demand = self.demands()
+        changes = np.nonzero((demand[:, 1:] != demand[:, :-1]).any(axis=0))[0]
+        starts = np.concatenate([[0], changes + 1]).astype(int)
+        ends = np.append(starts[1:], demand.shape[1])
+        demand = demand[:, starts]
+        supply = np.where(demand < 0, -demand, 0.)
+        flows = demand.copy()
+        for n in self.order[:0:-1]:
+            flows[self.upstream[n]] += flows[n]
+        link_flows = flows[self.link_nodes]
+        link_flows[np.abs(link_flows) < Q_STAGNANT] = 0.
+
+        tank_links = self.children[self.root]
+        volume = self.tank_volume
+        periods = []
+        for period, (start, end) in enumerate(zip(starts, ends)):
+            first = start * per_period + 1
+            last = min(end * per_period, num_steps)
+            if first > last:
+                continue
+            link_flow = link_flows[:, period]
+            if volume is None:
+                periods.append([first, last, link_flow, supply[:, period],
+                                None])
+                continue
+            inflow = -sum(min(link_flow[k], 0.) for k in tank_links)
+            outflow = sum(max(link_flow[k], 0.) for k in tank_links)
+            if inflow > outflow:
+                # steps until the tank is full
+                fill = int(np.ceil(max(self.tank_max_volume - volume, 0.) /
+                                   ((inflow - outflow) * step)))
+                if fill > last - first:
+                    periods.append([first, last, link_flow, supply[:, period],
+                                    volume])
+                    volume += (last - first + 1) * (inflow - outflow) * step
+                    continue
+                if fill > 0:
+                    periods.append([first, first + fill - 1, link_flow,
+                                    supply[:, period], volume])
+                    first += fill
+                link_flow = link_flow.copy()
+                for k in tank_links:
+                    if link_flow[k] < 0:
+                        link_flow[k] *= outflow / inflow
+                link_flow[np.abs(link_flow) < Q_STAGNANT] = 0.
+                volume = self.tank_max_volume
+                periods.append([first, last, link_flow, supply[:, period],
+                                volume])
+                continue
+            periods.append([first, last, link_flow, supply[:, period], volume])
+            volume = max(volume + (last - first + 1) * (inflow - outflow) *
+                         step, 0.)
+        return periods
+
+
+    def _routing(self, link_flow):
+        # nodes in the order water reaches them, with the links into and out
+        # of each node, for the flow directions of a period
+        key = np.sign(link_flow).astype(np.int8).tobytes()
+        if key in self._routes:
+            return self._routes[key]
+        num_nodes = len(self.node_names)
+        inflows = [[] for _ in range(num_nodes)]
+        outflows = [[] for _ in range(num_nodes)]   # [link, reversed]
+        ends = {}
+        for k in np.nonzero(link_flow)[0].tolist():
+            start, end = self.link_upstream[k], self.link_nodes[k]
+            if link_flow[k] < 0:
+                start, end = end, start
+            outflows[start].append((k, bool(link_flow[k] < 0)))
+            inflows[end].append(k)
+            ends[k] = end
+        waiting = [len(x) for x in inflows]
+        order = [n for n in range(num_nodes)
+                 if waiting[n] == 0 and len(outflows[n]) > 0]
+        for n in order:
+            for k, _ in outflows[n]:
+                waiting[ends[k]] -= 1
+                if waiting[ends[k]] == 0:
+                    order.append(ends[k])
+        self._routes[key] = (order, inflows, outflows)
+        return self._routes[key]
+
+
+    def _transport(self, k, volume, births, queues, reverse=False):
+        # push one plug per step into link k and return the plugs leaving it,
+        # each step moves the same volume. Queues run from the end of the
+        # link away from the root, reversed flows enter at that end.
+        plug_volumes, plug_births = queues[k]
+        if self.volumes[k] == 0:
+            queues[k] = (plug_volumes, births[-1:])
+            return births
+        if reverse:
+            plug_volumes, plug_births = plug_volumes[::-1], plug_births[::-1]
+        n = len(births)
+        ref = births[0]
+        vols = np.concatenate([plug_volumes, np.full(n, volume)])
+        all_births = np.concatenate([plug_births, births])
+        edges = np.concatenate([[0.], np.cumsum(vols)])
+        mass = np.concatenate([[0.], np.cumsum(vols * (all_births - ref))])
+        # water leaving the link in each step, the mean of the plugs it spans
+        cuts = volume * np.arange(n + 1)
+        out = np.diff(np.interp(cuts, edges, mass)) / volume + ref
+        # the rest stays in the link, the first plug is cut at the outlet
+        first = min(np.searchsorted(edges, cuts[-1], side='right') - 1,
+                    len(vols) - 1)
+        rest = vols[first:].copy()
+        rest[0] = edges[first + 1] - cuts[-1]
+        keep = rest > 1e-12 * self.volumes[k]
+        rest = rest[keep]
+        rest *= self.volumes[k] / rest.sum()
+        rest_births = all_births[first:][keep]
+        if reverse:
+            rest, rest_births = rest[::-1], rest_births[::-1]
+        queues[k] = (rest, rest_births)
+        return out
+
+
+    def _no_flow(self, n, queues):
+        # average of the plugs at the node end of the links that end at the
+        # node, as EPANET's noflowqual. None if no link ends at the node,
+        # EPANET then keeps the water age of the node.
+        values = []
+        for k in self.ending[n]:
+            if self.link_nodes[k] == n:
+                values.append(queues[k][1][0])
+            else:
+                values.append(queues[k][1][-1])
+        if len(values) == 0:
+            return None
+        return np.mean(values)
+
+
+    def run(self):
+        """
+        Route the water age of the network for the current patterns
+        returns array of node water age (nodes x report times), in seconds
+            and single precision
+        """
+        step = self.quality_step
+        num_nodes = len(self.node_names)
+
+        # births (time the water entered the network) of nodes and plugs
+        birth = -self.initial
+        queues = []
+        for k, volume in enumerate(self.volumes):
+            value = (birth[self.link_nodes[k]] +
+                     birth[self.link_upstream[k]]) / 2
+            queues.append((np.array([volume]), np.array([value])))
+        records = {n: ([0], [birth[n:n + 1].copy()])
+                   for n in set(self._node_index)}
+        active = np.zeros(num_nodes, dtype=bool)
+        first_flow = None
+        kept = {}                   # nodes keeping their age, from a step
+
+        def keep_age(n, end):
+            # the node keeps the age of its last step until the end step
+            start = kept.pop(n)
+            age = (start - 1) * step - birth[n]
+            if n in records and end > start:
+                records[n][0].append(start)
+                records[n][1].append(np.arange(start, end) * step - age)
+            birth[n] = (end - 1) * step - age
+
+        for first, last, link_flow, supply, tank_volume in self.hydraulics():
+            order, inflows, outflows = self._routing(link_flow)
+            now_active = np.zeros(num_nodes, dtype=bool)
+            for n in order:
+                now_active[n] = len(inflows[n]) > 0 or supply[n] > 0
+            # junctions that just stopped take the average of their links
+            for n in np.nonzero(active & ~now_active)[0].tolist():
+                if n == self.root:
+                    continue
+                value = self._no_flow(n, queues)
+                if value is None:
+                    kept[n] = first
+                    continue
+                birth[n] = value
+                if n in records:
+                    records[n][0].append(first)
+                    records[n][1].append(birth[n:n + 1].copy())
+            for n in [n for n in kept if now_active[n]]:
+                keep_age(n, first)
+            active = now_active
+            if len(order) == 0:
+                continue
+            if first_flow is None:
+                first_flow = first
+            times = np.arange(first, last + 1, dtype=np.float64) * step
+            volumes = np.abs(link_flow) * step
+            outflow = {}
+            for n in order:
+                if n == self.root and self.tank_volume is None:
+                    births = times
+                elif n == self.root:
+                    # completely mixed tank, the inflow of a step joins the
+                    # water in the tank
+                    inflow = sum(volumes[k] for k in inflows[n])
+                    if inflow > 0:
+                        mixed = sum(volumes[k] * outflow.pop(k)
+                                    for k in inflows[n]) / inflow
+                        a = tank_volume / (tank_volume + inflow)
+                        births = lfilter([1 - a], [1, -a], mixed,
+                                         zi=[a * birth[n]])[0]
+                    else:
+                        births = np.full(len(times), birth[n])
+                elif active[n]:
+                    parts = [(volumes[k], outflow.pop(k)) for k in inflows[n]]
+                    if supply[n] > 0:
+                        parts.append((supply[n] * step, times))
+                    if len(parts) == 1:
+                        births = parts[0][1]
+                    else:
+                        births = (sum(v * x for v, x in parts) /
+                                  sum(v for v, x in parts))
+                else:
+                    births = np.full(len(times), birth[n])
+                if n == self.root or active[n]:
+                    birth[n] = births[-1]
+                    if n in records:
+                        records[n][0].append(first)
+                        records[n][1].append(births)
+                for k, reverse in outflows[n]:
+                    outflow[k] = self._transport(k, volumes[k], births, queues,
+                                                 reverse)
+
+        for n in list(kept):
+            keep_age(n, self.duration // step + 1)
+
+        # node births at each report time, then ages. Before water first
+        # flows EPANET reports the initial quality.
+        report_steps = self.report_times // step
+        quality = np.zeros((len(self.nodes), len(self.report_times)),
+                           dtype=np.float32)
+        for i, n in enumerate(self._node_index):
+            firsts, values = records[n]
+            steps = np.concatenate([np.arange(f, f + len(v)) for f, v in
+                                    zip(firsts, values)])
+            values = np.concatenate(values)
+            last = np.searchsorted(steps, report_steps, side='right') - 1
+            quality[i] = self.report_times - values[last]
+            if first_flow is None:
+                quality[i] = self.initial[n]
+            else:
+                quality[i, report_steps < first_flow] = self.initial[n]
+        return quality
+
+
+    def to_si(self, quality):
+        """
+        Water age is already in seconds, see ToolkitEngine.to_si
+        """
+        return quality
+
+
+    def quality_frame(self, patterns=None):
+        """
+        Run a trial and return the nodal water age dataframe, with the same
+            layout as BinReader_Quality (nodes x report times, seconds)
+        patterns: pattern dictionary to set before running, optional
+        """
+        if patterns is not None:
+            self.set_patterns(patterns)
+        quality = self.run()
+        return pd.DataFrame(quality, index=self.nodes,
+                            columns=self.report_times)
+
+
+    def close(self):
+        """
+        Nothing to free, for the interface of ToolkitEngine
+        """
+        pass
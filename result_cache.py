@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+PPMtools result cache class and associated functions.
+
+Keeps the summary of every simulated run under a content hash of its inputs:
+the rendered network (tank levels, pipe lengths and diameters, quality and
+time options, base patterns), and the events of the trial with the names
+and length of the patterns built from them. Runs whose key is already cached
+are not written or simulated again, so interrupted or extended campaigns
+resume, and campaigns that share scenario cells reuse each other's results.
+
+
+"""
+
+import os
+import uuid
+import hashlib
+
+import pandas as pd
+
+# changes when the summary of a run changes for the same inputs
+CACHE_VERSION = 'PPMtools-summary-1'
+
+
+def network_key(template):
+    """
+    Hash of a rendered network, every INP section except the [TITLE] header
+        (it has the file creation time)
+    template: inp_template.InpTemplate, refreshed after network changes
+    """
+    h = hashlib.sha1(CACHE_VERSION.encode())
+    for name, text in template.sections:
+        if name != '[TITLE]':
+            h.update(text.encode())
+    return h.hexdigest()
+
+
+def trial_key(pattern_names, TOT_LENGTH, event_table):
+    """
+    Hash of the patterns of a trial. The patterns are built from the events 
+        of the trial, so the pattern names, the pattern length, and the 
+        (scaled) events determine them and the patterns are never built.
+    pattern_names: names of the patterns of the trial
+    TOT_LENGTH: number of pattern steps
+    event_table: events.EventTable of the trial, scaled to its flow type
+    """
+    h = hashlib.sha1(CACHE_VERSION.encode())
+    h.update(repr((list(pattern_names), int(TOT_LENGTH))).encode())
+    h.update(event_table.rows().tobytes())
+    for kind in ('fixture', 'person', 'note'):
+        h.update(repr(event_table.names(kind)).encode())
+    return h.hexdigest()
+
+
+def run_key(net_key, trial_key):
+    """
+    Hash of the inputs of a single run
+    net_key: hash of the network, see network_key
+    trial_key: hash of the patterns of the trial, see trial_key
+    """
+    return hashlib.sha1((net_key + trial_key).encode()).hexdigest()
+
+
+def engine_key(key, engine='epanet'):
+    """
+    Key of a run simulated by an engine, EPANET runs keep the run key. 
+        Summaries of other engines (e.g. 'plugflow' screening runs) are 
+        approximate, they are kept under their own keys so EPANET campaigns
+        never reuse them, and the other way around.
+    key: run key, see run_key
+    engine: 'epanet' or the name of the engine
+    """
+    if key is None or engine == 'epanet':
+        return key
+    return hashlib.sha1((engine + '/' + key).encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Folder of run summaries, one json file per run key
+    """
+    def __init__(self, folder):
+        """
+        Initialize the cache, the folder is created if needed
+        folder: directory of the cache, can be shared between campaigns
+        """
+        self.folder = folder.replace('\\', '/').rstrip('/')
+        os.makedirs(self.folder, exist_ok=True)
+
+
+    def path(self, key):
+        """
+        File of a run key, keys are split over 256 subfolders
+        """
+        return self.folder + '/' + key[:2] + '/' + key + '.json'
+
+
+    def __contains__(self, key):
+        return key is not None and os.path.isfile(self.path(key))
+
+
+    def get(self, key):
+        """
+        Summary of a run key, None if not cached
+        """
+        if key not in self:
+            return None
+        return pd.read_json(self.path(key))
+
+
+    def put(self, key, summary_pd):
+        """
+        Store the summary of a run key. The file is written under a temporary
+            name first, so parallel workers and readers never see a partial
+            file.
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.' + uuid.uuid4().hex + '.tmp'
+        summary_pd.to_json(tmp, double_precision=15)
+        os.replace(tmp, path)
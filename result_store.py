@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+PPMtools result store class and associated functions.
+
+Stores the summaries of many runs as a columnar dataset, partitioned by the
+monte_carlo_setup grid (people, flow type, hwh volume, pipe diameter, pipe
+scaling). Each append writes a new part file in its partition, so workers in
+parallel processes can append without locking. Part files are Parquet when
+pyarrow is installed, NPZ otherwise, and the loader reads only the selected
+partitions and columns.
+
+
+"""
+
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow    # noqa: F401, only needed by pandas for Parquet
+    HAS_PARQUET = True
+except ImportError:
+    HAS_PARQUET = False
+
+PARTITION_KEYS = ['people', 'flow', 'gal', 'diam', 'scaling']
+EVENT_COLUMNS = ['trial', 'start', 'end', 'fixture', 'user', 'hot_rate',
+                 'cold_rate', 'note']
+SUMMARY_COLUMNS = ['hotMass', 'hotVolume', 'coldMass', 'coldVolume',
+                   'hotMean', 'coldMean']
+CONC_COLUMNS = ['hotConc', 'coldConc']
+
+
+def summary_columns(summary_pd, run_id, conc_lists=False):
+    """
+    Flatten a summary from generate_summary into columns
+    summary_pd: dataframe of summary results
+    run_id: name of the run, stored in the 'trial' column
+    conc_lists: keep the concentrations of each event
+    """
+    info = list(summary_pd['patternInfo'])
+    columns = {'trial': np.array([run_id] * len(info), dtype=str),
+               'start': np.array([k[0][0] for k in info], dtype=np.int32),
+               'end': np.array([k[0][1] for k in info], dtype=np.int32),
+               'fixture': np.array([k[1] for k in info], dtype=str),
+               'user': np.array([k[2] for k in info], dtype=str),
+               'hot_rate': np.array([k[3] for k in info], dtype=float),
+               'cold_rate': np.array([k[4] for k in info], dtype=float),
+               'note': np.array([k[5] for k in info], dtype=str)}
+    for name in SUMMARY_COLUMNS:
+        if name in summary_pd.columns:
+            columns[name] = summary_pd[name].to_numpy(dtype=float)
+    if conc_lists:
+        for name in CONC_COLUMNS:
+            if name in summary_pd.columns:
+                columns[name] = [np.asarray(x, dtype=np.float32)
+                                 for x in summary_pd[name]]
+    return columns
+
+
+def parse_value(text):
+    """
+    Convert a partition directory value back to int, float, or str
+    """
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    return text
+
+
+class ResultStore:
+    """
+    Partitioned columnar dataset of run summaries
+    """
+    def __init__(self, root, fmt=None, conc_lists=False):
+        """
+        Initialize the store, files are written when results are appended
+        root: directory of the dataset
+        fmt: 'parquet' or 'npz', defaults to Parquet if pyarrow is installed
+        conc_lists: keep the concentrations of each event (hotConc/coldConc)
+        """
+        if fmt is None:
+            fmt = 'parquet' if HAS_PARQUET else 'npz'
+        if fmt == 'parquet' and not HAS_PARQUET:
+            print('pyarrow is not installed, storing results as npz')
+            fmt = 'npz'
+        self.root = root.replace('\\', '/').rstrip('/')
+        self.fmt = fmt
+        self.conc_lists = conc_lists
+
+
+    def partition_path(self, scenario):
+        """
+        Directory of a partition, e.g. root/people=2/flow=ref/gal=40/...
+        scenario: (people, flow type, hwh gal, pipe diam, pipe scaling)
+        """
+        parts = [key + '=' + str(value).replace(' ', '_') for key, value
+                 in zip(PARTITION_KEYS, scenario)]
+        return '/'.join([self.root] + parts)
+
+
+    def append(self, scenario, summary_pd, run_id):
+        """
+        Write the summary of a run as a new part file of its partition
+        scenario: (people, flow type, hwh gal, pipe diam, pipe scaling)
+        summary_pd: dataframe of summary results
+        run_id: name of the run
+        returns path of the part file
+        """
+        folder = self.partition_path(scenario)
+        os.makedirs(folder, exist_ok=True)
+        columns = summary_columns(summary_pd, run_id, self.conc_lists)
+        return write_part(folder, columns, self.fmt)
+
+
+    def partitions(self, **filters):
+        """
+        List the partitions that match the filters
+        filters: partition key and value or list of values,
+            e.g. people=2, flow=['ref', 'low']
+        returns list of (partition values dict, directory)
+        """
+        found = [({}, self.root)]
+        for key in PARTITION_KEYS:
+            selected = filters.get(key)
+            if selected is not None and not isinstance(selected, (list, tuple)):
+                selected = [selected]
+            next_found = []
+            for values, folder in found:
+                if not os.path.isdir(folder):
+                    continue
+                for entry in sorted(os.listdir(folder)):
+                    if not entry.startswith(key + '='):
+                        continue
+                    value = parse_value(entry.split('=', 1)[1])
+                    if selected is not None and not \
+                       any(value == parse_value(str(x).replace(' ', '_'))
+                           for x in selected):
+                        continue
+                    next_found.append((dict(values, **{key: value}),
+                                       folder + '/' + entry))
+            found = next_found
+        return found
+
+
+    def load(self, columns=None, **filters):
+        """
+        Read the selected columns of the selected partitions
+        columns: list of columns to read, None for all columns. Partition
+            keys are always included.
+        filters: see partitions
+        returns dataframe, one row per event
+        """
+        frames = []
+        for values, folder in self.partitions(**filters):
+            for entry in sorted(os.listdir(folder)):
+                if not entry.startswith('part-'):
+                    continue
+                frame = read_part(folder + '/' + entry, columns)
+                for key, value in values.items():
+                    frame[key] = value
+                frames.append(frame)
+        if len(frames) == 0:
+            return pd.DataFrame(columns=PARTITION_KEYS + (columns or []))
+        frames = pd.concat(frames, ignore_index=True)
+        return frames[PARTITION_KEYS + [x for x in frames.columns
+                                        if x not in PARTITION_KEYS]]
+
+
+    def compact(self, **filters):
+        """
+        Merge the part files of each selected partition into a single file.
+            Only run when no workers are appending.
+        filters: see partitions
+        """
+        for values, folder in self.partitions(**filters):
+            parts = [folder + '/' + x for x in sorted(os.listdir(folder))
+                     if x.startswith('part-')]
+            if len(parts) < 2:
+                continue
+            frame = pd.concat([read_part(x) for x in parts], ignore_index=True)
+            columns = {}
+            for key in frame.columns:
+                if key in CONC_COLUMNS:
+                    columns[key] = [np.asarray(x, dtype=np.float32)
+                                    for x in frame[key]]
+                elif frame[key].dtype.kind in 'iufb':
+                    columns[key] = frame[key].to_numpy()
+                else:
+                    columns[key] = frame[key].to_numpy(dtype=str)
+            write_part(folder, columns, self.fmt)
+            for part in parts:
+                os.remove(part)
+
+
+def write_part(folder, columns, fmt='npz'):
+    """
+    Write columns as a new part file, under a temporary name first so readers
+        never see a partial file
+    folder: partition directory
+    columns: dictionary of column arrays, concentration columns as lists
+    fmt: 'parquet' or 'npz'
+    returns path of the part file
+    """
+    name = 'part-' + uuid.uuid4().hex
+    tmp = folder + '/tmp-' + name
+    if fmt == 'parquet':
+        path = folder + '/' + name + '.parquet'
+        pd.DataFrame(columns).to_parquet(tmp, index=False)
+    else:
+        path = folder + '/' + name + '.npz'
+        arrays = {}
+        for key, values in columns.items():
+            if key in CONC_COLUMNS:
+                # ragged lists as values and offsets
+                lengths = [len(x) for x in values]
+                arrays[key + '_offsets'] = np.cumsum([0] + lengths)
+                arrays[key + '_values'] = np.concatenate(
+                    values + [np.zeros(0, dtype=np.float32)])
+            else:
+                arrays[key] = values
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+    os.replace(tmp, path)
+    return path
+
+
+def read_part(path, columns=None):
+    """
+    Read the selected columns of a single part file
+    path: Parquet or NPZ part file
+    columns: list of columns to read, None for all columns
+    """
+    if path.endswith('.parquet'):
+        if columns is not None:
+            import pyarrow.parquet
+            names = pyarrow.parquet.ParquetFile(path).schema.names
+            columns = [x for x in columns if x in names]
+        return pd.read_parquet(path, columns=columns)
+    with np.load(path) as data:
+        names = [x for x in data.files if not x.endswith('_values')]
+        names = [x[:-len('_offsets')] if x.endswith('_offsets') else x
+                 for x in names]
+        if columns is not None:
+            names = [x for x in names if x in columns]
+        frame = {}
+        for name in names:
+            if name in CONC_COLUMNS:
+                offsets = data[name + '_offsets']
+                values = data[name + '_values']
+                frame[name] = [values[a:b] for a, b in
+                               zip(offsets[:-1], offsets[1:])]
+            else:
+                frame[name] = data[name]
+    return pd.DataFrame(frame)
+
+
+def load_results(root, columns=None, **filters):
+    """
+    Read the selected columns and partitions of a result store
+    root: directory of the dataset
+    columns: list of columns to read, None for all columns
+    filters: partition key and value or list of values,
+        e.g. people=2, flow=['ref', 'low']
+    """
+    return ResultStore(root).load(columns, **filters)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the PPMtools work queue: claims, lease expiry, and queueing runs
+again, on a single machine. No runs are simulated.
+
+Usage:
+    python -m pytest test_PPMtools_queue.py
+
+
+"""
+
+import time
+
+from PPMtools_queue import JobQueue
+
+
+def make_runs(count):
+    # rows of available, only the folder and INP file name are used
+    return [['T-' + str(x), 'events.db', '/runs/', 'T-' + str(x) + '.inp']
+            for x in range(count)]
+
+
+def test_claim(tmp_path):
+    jobs = JobQueue(str(tmp_path / 'queue.db'))
+    assert jobs.submit(make_runs(2)) == 2
+    assert jobs.submit(make_runs(2)) == 0
+    first = jobs.claim('w1')
+    second = jobs.claim('w2')
+    assert first[1][0] == 'T-0' and second[1][0] == 'T-1'
+    assert jobs.claim('w3') is None
+    assert jobs.counts()['running'] == 2
+
+    assert not jobs.complete(first[0], 'w2')
+    assert jobs.complete(first[0], 'w1')
+    assert jobs.complete(second[0], 'w2', error='failed run')
+    counts = jobs.counts()
+    assert counts['done'] == 1 and counts['failed'] == 1
+    assert jobs.failed() == [('/runs/T-1.inp', 'failed run')]
+    assert jobs.requeue_failed() == 1
+    assert jobs.claim('w1')[1][0] == 'T-1'
+
+
+def test_lease_expires(tmp_path):
+    jobs = JobQueue(str(tmp_path / 'queue.db'), lease=0.2)
+    jobs.submit(make_runs(1))
+    job_id, run = jobs.claim('w1')
+    assert jobs.heartbeat(job_id, 'w1')
+    assert jobs.claim('w2') is None
+
+    # w1 stops sending heartbeats, its run is queued again for w2
+    time.sleep(0.3)
+    claimed = jobs.claim('w2')
+    assert claimed is not None and claimed[0] == job_id
+    assert not jobs.heartbeat(job_id, 'w1')
+    assert not jobs.complete(job_id, 'w1')
+    assert jobs.complete(job_id, 'w2')
+    assert jobs.counts()['done'] == 1
+
+
+def test_lease_expires_too_often(tmp_path):
+    jobs = JobQueue(str(tmp_path / 'queue.db'), lease=0.05, max_attempts=2)
+    jobs.submit(make_runs(1))
+    for worker in ('w1', 'w2'):
+        assert jobs.claim(worker) is not None
+        time.sleep(0.1)
+    # the run killed both of its workers, it is marked failed
+    assert jobs.claim('w3') is None
+    assert jobs.counts()['failed'] == 1
+    assert jobs.failed()[0][1] == 'lease expired 2 times'
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+PPMtools EPANET toolkit engine class and associated functions.
+
+Runs trials of a network in memory through the EPANET toolkit. The network is
+opened once, then for each trial the pattern multipliers are replaced and the
+hydraulics and water quality are solved without writing INP, binary, or
+report files. Node quality is collected directly into arrays, in the same
+units and layout as BinReader_Quality.
+
+
+"""
+
+import os
+import ctypes
+
+import numpy as np
+import pandas as pd
+import wntr
+from wntr.epanet.util import FlowUnits, MassUnits, QualParam, QualType
+
+# EPANET toolkit codes
+EN_NODECOUNT = 0
+EN_PATCOUNT = 3
+EN_QUALITY = 12
+EN_DURATION = 0
+EN_PATTERNSTEP = 3
+EN_REPORTSTEP = 5
+EN_REPORTSTART = 6
+EN_MAXID = 31
+
+
+class ToolkitEngine:
+    """
+    EPANET network opened in memory, for running many trials of the same
+    network with new patterns
+    """
+    def __init__(self, inpfile, nodes=None):
+        """
+        Open the network with the EPANET toolkit
+        inpfile: EPANET input file of the network
+        nodes: names of the nodes to collect quality for, None for all nodes
+        """
+        self._en = wntr.epanet.toolkit.ENepanet(version=2.2)
+        self._en.ENopen(inpfile, os.devnull, '')
+        self._lib = self._en.ENlib
+        self._ph = self._en._project
+
+        en = self._en
+        self.duration = en.ENgettimeparam(EN_DURATION)
+        self.pattern_step = en.ENgettimeparam(EN_PATTERNSTEP)
+        self.report_step = en.ENgettimeparam(EN_REPORTSTEP)
+        self.report_start = en.ENgettimeparam(EN_REPORTSTART)
+        # same report times as the binary file
+        self.report_times = np.arange(self.report_start,
+                                      self.duration + self.report_step -
+                                      (self.duration % self.report_step),
+                                      self.report_step)
+        self.flow_units = FlowUnits(en.ENgetflowunits())
+        self.quality_type, self.mass_units = self._quality_info()
+
+        self.node_names = [en.ENgetnodeid(i) for i in
+                           range(1, en.ENgetcount(EN_NODECOUNT) + 1)]
+        self.pattern_names = [self._pattern_id(i) for i in
+                              range(1, en.ENgetcount(EN_PATCOUNT) + 1)]
+        self._pattern_index = {name: i + 1 for i, name in
+                               enumerate(self.pattern_names)}
+        self.set_nodes(nodes)
+
+
+    def _check(self, errcode):
+        # raises the toolkit error of a direct library call
+        self._en.errcode = errcode
+        self._en._error()
+
+
+    def _pattern_id(self, index):
+        buf = ctypes.create_string_buffer(EN_MAXID + 1)
+        self._check(self._lib.EN_getpatternid(self._ph, index, buf))
+        return buf.value.decode('latin-1')
+
+
+    def _quality_info(self):
+        qual = ctypes.c_int()
+        trace = ctypes.c_int()
+        name = ctypes.create_string_buffer(EN_MAXID + 1)
+        units = ctypes.create_string_buffer(EN_MAXID + 1)
+        self._check(self._lib.EN_getqualinfo(self._ph, ctypes.byref(qual),
+                                             name, units, ctypes.byref(trace)))
+        if units.value.decode('latin-1').lower().startswith('ug'):
+            mass_units = MassUnits.ug
+        else:
+            mass_units = MassUnits.mg
+        return QualType(qual.value), mass_units
+
+
+    def set_nodes(self, nodes=None):
+        """
+        Set the nodes to collect quality for
+        nodes: names of the nodes, None for all nodes
+        """
+        if nodes is None:
+            nodes = self.node_names
+        self.nodes = list(nodes)
+        self._node_index = [self._en.ENgetnodeindex(name)
+                            for name in self.nodes]
+
+
+    def set_patterns(self, patterns):
+        """
+        Replace the multipliers of the network patterns, patterns that are
+            not in the network are ignored. Multipliers are rounded to the 6
+            decimals of an INP file, so results match runs of written files.
+        patterns: pattern dictionary {'patname':[pattern]}
+        """
+        for name, multipliers in patterns.items():
+            if name not in self._pattern_index:
+                continue
+            values = np.round(np.asarray(multipliers, dtype=np.float64), 6)
+            ptr = values.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+            self._check(self._lib.EN_setpattern(self._ph,
+                                                self._pattern_index[name],
+                                                ptr, len(values)))
+
+
+    def run(self):
+        """
+        Solve the hydraulics and water quality of the network
+        returns array of node quality (nodes x report times), in the units
+            of the input file and single precision, as in the binary file
+        """
+        ph = self._ph
+        runQ = self._lib.EN_runQ
+        stepQ = self._lib.EN_stepQ
+        getvalue = self._lib.EN_getnodevalue
+        value = ctypes.c_double()
+        value_ref = ctypes.byref(value)
+        t = ctypes.c_long()
+        t_ref = ctypes.byref(t)
+        tleft = ctypes.c_long()
+        tleft_ref = ctypes.byref(tleft)
+        node_index = self._node_index
+
+        self._en.ENsolveH()
+        self._en.ENopenQ()
+        self._en.ENinitQ(0)                 # no binary output
+        quality = np.zeros((len(self.report_times), len(self.nodes)),
+                           dtype=np.float32)
+        num_reports = len(self.report_times)
+        col = 0
+        report_time = self.report_start
+        try:
+            while True:
+                errcode = runQ(ph, t_ref)
+                if errcode > 100:
+                    self._check(errcode)
+                if t.value >= report_time and col < num_reports:
+                    row = quality[col]
+                    for i, index in enumerate(node_index):
+                        getvalue(ph, index, EN_QUALITY, value_ref)
+                        row[i] = value.value
+                    col += 1
+                    report_time += self.report_step
+                errcode = stepQ(ph, tleft_ref)
+                if errcode > 100:
+                    self._check(errcode)
+                if tleft.value <= 0:
+                    break
+            # the last step ends at the duration, which runQ does not return
+            if col < num_reports:
+                row = quality[col]
+                for i, index in enumerate(node_index):
+                    getvalue(ph, index, EN_QUALITY, value_ref)
+                    row[i] = value.value
+        finally:
+            self._en.ENcloseQ()
+        quality = quality.T
+        return quality
+
+
+    def to_si(self, quality):
+        """
+        Convert node quality to SI units, as WNTR's binary reader does
+            (age in seconds, concentration in kg/m3)
+        """
+        if self.quality_type is QualType.Chem:
+            return QualParam.Concentration._to_si(self.flow_units, quality,
+                                                  mass_units=self.mass_units)
+        elif self.quality_type is QualType.Age:
+            return QualParam.WaterAge._to_si(self.flow_units, quality,
+                                             mass_units=self.mass_units)
+        return quality
+
+
+    def quality_frame(self, patterns=None):
+        """
+        Run a trial and return the nodal quality dataframe, with the same
+            layout as BinReader_Quality (nodes x report times, SI units)
+        patterns: pattern dictionary to set before running, optional
+        """
+        if patterns is not None:
+            self.set_patterns(patterns)
+        quality = self.to_si(self.run())
+        return pd.DataFrame(quality, index=self.nodes,
+                            columns=self.report_times)
+
+
+    def close(self):
+        """
+        Close the network and free the toolkit project
+        """
+        self._en.ENclose()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+PPMtools worker tuning class and associated functions.
+
+Chooses how many EPANET runs mp_run_epanet keeps running at once, and how
+many runs are handed to a worker in one task, from measurements of the
+latest finished runs: the memory each run adds to its worker (peak RSS above
+the RSS before the run, see instrument.run_rss) and the duration of each
+run. Concurrency is kept under a memory budget, and raised or lowered as the
+runs grow or shrink. Runs that take longer than the task overhead are handed out
+one at a time, short runs are batched. The chosen settings are saved as JSON
+so later campaigns on the same network start from them.
+
+
+"""
+
+import os
+import json
+
+import numpy as np
+
+
+def default_memory_budget(fraction=0.8):
+    """
+    Memory budget of the workers, a fraction of the physical memory.
+        None if the physical memory is unknown (e.g. on Windows).
+    """
+    try:
+        pages = os.sysconf('SC_PHYS_PAGES')
+        page_size = os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+    return int(fraction * pages * page_size)
+
+
+class ConcurrencyTuner:
+    """
+    Number of concurrent runs and runs per task of a pool of EPANET workers
+    """
+    def __init__(self, max_proc, memory_budget=None, concurrency=None,
+                 chunk=1, warmup=None, task_seconds=2., max_chunk=16,
+                 window=100):
+        """
+        Initialize the tuner, settings change as measurements arrive
+        max_proc: number of worker processes, the most concurrent runs
+        memory_budget: bytes the concurrent runs may use together, defaults
+            to 80% of the physical memory (see default_memory_budget)
+        concurrency: number of concurrent runs until the first runs finish,
+            defaults to 2
+        chunk: runs per task until the first runs finish
+        warmup: number of finished runs before the settings change,
+            defaults to the initial concurrency
+        task_seconds: least duration of a task, shorter runs are batched
+        max_chunk: most runs per task
+        window: number of latest runs the settings are based on
+        """
+        if memory_budget is None:
+            memory_budget = default_memory_budget()
+        self.max_proc = max_proc
+        self.memory_budget = memory_budget
+        if concurrency is None:
+            concurrency = 2
+        self.concurrency = max(1, min(concurrency, max_proc))
+        self.chunk = max(1, min(chunk, max_chunk))
+        self.warmup = self.concurrency if warmup is None else warmup
+        self.task_seconds = task_seconds
+        self.max_chunk = max_chunk
+        self.window = window
+        self.rss = []               # memory added by the latest runs, bytes
+        self.seconds = []           # durations of the latest runs
+        self.completed = 0
+        self.history = [[0, self.concurrency, self.chunk]]
+
+
+    def update(self, stats):
+        """
+        Add the measurements of a finished task and adjust the settings. 
+            The first measurements replace those of an earlier campaign (see
+            load_tuner).
+        stats: {'rss': memory each run of the task added to the worker 
+                       (bytes), see instrument.run_rss,
+                'seconds': duration of each run of the task}
+        returns True if the settings changed
+        """
+        if self.completed == 0:
+            self.rss, self.seconds = [], []
+        self.rss = (self.rss + list(stats.get('rss', [])))[-self.window:]
+        self.seconds = (self.seconds + list(stats['seconds']))[-self.window:]
+        self.completed += len(stats['seconds'])
+        if self.completed < self.warmup:
+            return False
+        return self.adjust()
+
+
+    def adjust(self):
+        """
+        Choose the settings from the latest runs: as many concurrent runs as
+            fit in the memory budget at the most memory a run added, and 
+            enough runs per task to last task_seconds. Old runs leave the 
+            window, so concurrency rises again when the runs shrink.
+        returns True if the settings changed
+        """
+        concurrency = self.max_proc
+        run_rss = self.run_rss
+        if self.memory_budget and run_rss:
+            concurrency = int(self.memory_budget // run_rss)
+        concurrency = max(1, min(concurrency, self.max_proc))
+        chunk = self.chunk
+        run_seconds = self.run_seconds
+        if run_seconds:
+            chunk = int(np.ceil(self.task_seconds / run_seconds))
+            chunk = max(1, min(chunk, self.max_chunk))
+        if (concurrency, chunk) == (self.concurrency, self.chunk):
+            return False
+        self.concurrency = concurrency
+        self.chunk = chunk
+        self.history.append([self.completed, concurrency, chunk])
+        return True
+
+
+    @property
+    def run_rss(self):
+        """
+        Most memory a run of the latest runs added to its worker (bytes), 
+            None before any run was measured
+        """
+        if len(self.rss) == 0:
+            return None
+        return max(self.rss)
+
+
+    @property
+    def run_seconds(self):
+        """
+        Median duration of the latest runs, None before any run finished
+        """
+        if len(self.seconds) == 0:
+            return None
+        return float(np.median(self.seconds))
+
+
+    def settings(self):
+        """
+        Chosen settings and the measurements they are based on
+        """
+        return {'concurrency': self.concurrency,
+                'chunk': self.chunk,
+                'max_proc': self.max_proc,
+                'memory_budget': self.memory_budget,
+                'run_rss': self.run_rss,
+                'run_seconds': self.run_seconds,
+                'completed': self.completed,
+                'history': self.history}
+
+
+    def save(self, filename):
+        """
+        Write the settings as JSON, see load_tuner
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.settings(), f, indent=1)
+
+
+def load_tuner(filename, max_proc, memory_budget=None, **kwargs):
+    """
+    Tuner that starts from the settings of an earlier campaign. The saved
+        measurements apply until the first runs finish, so the concurrency 
+        follows the new memory budget and number of processes right away,
+        then the runs of this campaign replace them.
+    filename: JSON file written by ConcurrencyTuner.save
+    max_proc, memory_budget, kwargs: see ConcurrencyTuner
+    """
+    with open(filename) as f:
+        saved = json.load(f)
+    tuner = ConcurrencyTuner(max_proc, memory_budget, saved['concurrency'],
+                             saved['chunk'], warmup=1, **kwargs)
+    if saved.get('run_rss'):
+        tuner.rss = [saved['run_rss']]
+    if saved.get('run_seconds'):
+        tuner.seconds = [saved['run_seconds']]
+    tuner.adjust()
+    return tuner